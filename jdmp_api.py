@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import pandas as pd
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from jdmp_core import (DEFAULT_MEMORY_BUDGET_MB, MENTIONED_COLS, STANDARD_RIGHTS_TEXT, XLSX_MIME, clean_urns,
+                       crediting_note, export_csv, export_xlsx, mapping_rules, plan_execution, populate_template,
+                       read_crediting_table, read_header, read_inputs, reduce_columns, reference_table,
+                       stream_populate)
+from jdmp_metrics import API_REQUESTS, API_SECONDS, render
+
+# --- local HTTP API for the population pipeline (no UI) ---
+# run with: python jdmp_api.py [--host 127.0.0.1] [--port 8510] [--workers N]
+#
+# POST /populate, multipart/form-data:
+#   urns       URNs Excel (required)
+#   desc       Descriptive Metadata Excel (required)
+#   template   SharedShelf Template Excel (optional - default SharedShelf template otherwise)
+#   crediting  Crediting-Notes Translation Table (optional - default table otherwise)
+#   options    JSON options document, e.g.
+#     {"metadata_type": "Posters", "cataloging_type": "Provisional Records", "geographic_type": "World Judaica",
+#      "columns": {"title": "Title", "start_date": "Start", "end_date": "End", "country": "Country"},
+#      "general_note": {"source": "Descriptive Metadata Column", "column": "Note"},
+#      "rights": {"source": "STANDARD"}, "credit": {"source": "231 Lowe"},
+#      "creator": "", "subject": "", "reduced": true, "format": "xlsx"}
+#     general_note source: "Descriptive Metadata Column" (+ column) / "NO GENERAL NOTE" / "OTHER" (+ text)
+#     rights source: "STANDARD" / "OTHER" (+ text); credit source: a crediting table source / "OTHER" (+ text)
+#     reduced: true = output of the Reduced Version (default), false = all template columns like the Full Version
+# returns the populated template as xlsx / csv; the pipeline messages are in the X-JDMP-Messages header (JSON)
+# and invalid options give a 400 with {"errors": [...]}
+#
+# GET /health: {"status": "ok", "workers": N, "in_flight": N}
+# GET /metrics: request counts / latencies in the Prometheus text format (with JDMP_METRICS=1; the pipeline's
+# stage / export metrics are recorded in the worker processes and are not included)
+
+# the default files next to the apps, wherever the service is started from
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEMPLATE_PATH = os.path.join(APP_DIR, "SharedShelf Template.xlsx")
+DEFAULT_CREDITING_PATH = os.path.join(APP_DIR, "Notes-Crediting - Translation Table - Column DB.xlsx")
+
+CATALOGING_TYPES = ["Full Cataloging", "Provisional Records"]
+GEOGRAPHIC_TYPES = ["Israel", "World Judaica"]
+NOTE_SOURCES = ["Descriptive Metadata Column", "NO GENERAL NOTE", "OTHER"]
+RIGHTS_SOURCES = ["STANDARD", "OTHER"]
+JSON_TYPES = {dict: "object", str: "string", bool: "boolean"}
+
+API_WORKERS = int(os.environ.get("JDMP_API_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# requests beyond workers * API_QUEUE_FACTOR in flight get a 503 instead of piling up in memory
+API_QUEUE_FACTOR = int(os.environ.get("JDMP_API_QUEUE_FACTOR", "4"))
+API_MAX_UPLOAD_MB = int(os.environ.get("JDMP_API_MAX_UPLOAD_MB", "200"))
+
+
+# --- worker side (runs in a pool process; the default tables are memory-mapped once per worker) ---
+@lru_cache(maxsize=4)
+def _default_table(path, mtime, crediting=False):
+    # mtime is part of the key, so an edited default file is picked up; a new worker maps the parsed table
+    # from the on-disk reference cache (its pages are shared by all workers)
+    return reference_table(path, read_crediting_table) if crediting else reference_table(path).head(0)
+
+
+def _default(path, crediting=False):
+    return _default_table(path, os.path.getmtime(path), crediting)
+
+
+def _typed(errors, name, value, kind):
+    # value if it has the JSON type the options document expects (None if missing); otherwise an error
+    if value is None or isinstance(value, kind):
+        return value
+    errors.append(f"{name} must be a JSON {JSON_TYPES[kind]}")
+    return None
+
+
+def api_options(doc, desc_columns, crediting_df):
+    """Translate the JSON options document into populate_template options. Returns (options, errors);
+    options is None when there are errors."""
+    if not isinstance(doc, dict):
+        return None, ["options must be a JSON object"]
+    errors = []
+    columns = _typed(errors, "columns", doc.get("columns"), dict) or {}
+    note = _typed(errors, "general_note", doc.get("general_note"), dict) or {}
+    rights = _typed(errors, "rights", doc.get("rights"), dict) or {}
+    credit = _typed(errors, "credit", doc.get("credit"), dict) or {}
+    for name, value in (("creator", doc.get("creator")), ("subject", doc.get("subject")),
+                        ("general_note.text", note.get("text")), ("rights.text", rights.get("text")),
+                        ("credit.source", credit.get("source")), ("credit.text", credit.get("text"))):
+        _typed(errors, name, value, str)
+    _typed(errors, "reduced", doc.get("reduced"), bool)
+    if doc.get("format", "xlsx") not in ("xlsx", "csv"):
+        errors.append("format must be xlsx or csv")
+
+    # metadata types are whatever the mapping rules (jdmp_rules.json) define
+    metadata_types = mapping_rules()["choices"]["metadata_type"]
+    for key, choices in (("metadata_type", metadata_types), ("geographic_type", GEOGRAPHIC_TYPES)):
+        if doc.get(key) not in choices:
+            errors.append(f"{key} must be one of {choices}")
+    if doc.get("cataloging_type", "Full Cataloging") not in CATALOGING_TYPES:
+        errors.append(f"cataloging_type must be one of {CATALOGING_TYPES}")
+    if note.get("source") not in NOTE_SOURCES:
+        errors.append(f"general_note.source must be one of {NOTE_SOURCES}")
+    if rights.get("source") not in RIGHTS_SOURCES:
+        errors.append(f"rights.source must be one of {RIGHTS_SOURCES}")
+    if credit.get("source") != "OTHER" and credit.get("source") not in crediting_df["source"].tolist():
+        errors.append("credit.source must be a source of the Crediting-Notes Translation Table or OTHER")
+
+    world_judaica = doc.get("geographic_type") == "World Judaica"
+    required_cols = {"columns.title": columns.get("title"), "columns.start_date": columns.get("start_date"),
+                     "columns.end_date": columns.get("end_date")}
+    if world_judaica:
+        required_cols["columns.country"] = columns.get("country")
+    if note.get("source") == "Descriptive Metadata Column":
+        required_cols["general_note.column"] = note.get("column")
+    for key, col in required_cols.items():
+        if col not in desc_columns:
+            errors.append(f"{key} must name a Descriptive Metadata column (got {col!r})")
+    if errors:
+        return None, errors
+
+    if rights.get("source") == "STANDARD":
+        rights_text = STANDARD_RIGHTS_TEXT
+    else:
+        rights_text = rights.get("text") or ""
+    if credit.get("source") == "OTHER":
+        credit_text = credit.get("text") or ""
+    else:
+        credit_text = crediting_note(crediting_df, credit.get("source"))
+
+    options = {
+        "metadata_type": doc.get("metadata_type"), "cataloging_type": doc.get("cataloging_type", "Full Cataloging"),
+        "geographic_type": doc.get("geographic_type"),
+        "artstor_country_col": columns.get("country") if world_judaica else "",
+        "desc_title_col": columns.get("title"), "desc_start_date_col": columns.get("start_date"),
+        "desc_end_date_col": columns.get("end_date"),
+        "desc_source_type": note.get("source"),
+        "desc_note_col": note.get("column") if note.get("source") == "Descriptive Metadata Column" else None,
+        "desc_source_text": (note.get("text") or "") if note.get("source") == "OTHER" else "",
+        "template_creator": doc.get("creator"), "template_subject": doc.get("subject"),
+        "template_rights_type": rights.get("source"), "template_rights_text": rights_text,
+        "template_credit_type": credit.get("source"), "template_credit_text": credit_text,
+        "reduced_version": bool(doc.get("reduced", True)),
+    }
+    return options, errors
+
+
+def populate_request(files, doc, memory_mb):
+    """Run one API request: returns {"data", "messages", "rows"} or {"errors"} for invalid options / uploads."""
+    urns_source, desc_source = io.BytesIO(files["urns"]), io.BytesIO(files["desc"])
+    uploads = {
+        "template": lambda: pd.read_excel(io.BytesIO(files["template"])).head(0),
+        "crediting": lambda: read_crediting_table(io.BytesIO(files["crediting"])),
+        "urns": lambda: read_header(urns_source),
+        "desc": lambda: read_header(desc_source),
+    }
+    parsed, errors = {}, []
+    for name, read in uploads.items():
+        if not files.get(name):
+            continue
+        try:
+            parsed[name] = read()
+        except Exception as e:  # not an Excel file, or not one with the expected sheet / columns
+            errors.append(f"{name} is not a readable Excel file ({type(e).__name__}: {e})")
+    if errors:
+        return {"errors": errors}
+    template_df = parsed["template"] if "template" in parsed else _default(DEFAULT_TEMPLATE_PATH)
+    crediting_df = parsed["crediting"] if "crediting" in parsed else _default(DEFAULT_CREDITING_PATH, crediting=True)
+
+    options, errors = api_options(doc, parsed["desc"], crediting_df)
+    if errors:
+        return {"errors": errors}
+    fmt = doc.get("format", "xlsx")
+    reduced = doc.get("reduced", True)
+
+    # same planner as the apps: batches that do not fit this worker's share of memory are streamed
+    plan = plan_execution(urns_source, desc_source, budget_mb=memory_mb, template_cols=template_df.shape[1],
+                          export_cols=len(MENTIONED_COLS) if reduced else template_df.shape[1])
+    if plan["mode"] == "Streaming":
+        out_dir = tempfile.mkdtemp(prefix="jdmp_api_")
+        try:
+            result = stream_populate(template_df, urns_source, desc_source, options, reduced=reduced, out_dir=out_dir)
+            with open(result[f"{fmt}_path"], "rb") as f:
+                return {"data": f.read(), "messages": result["messages"], "rows": result["rows"]}
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    # parsed once per upload content and memory-mapped, so workers handling the same batch share one copy
+    urns_df, desc_df = read_inputs(files["urns"], files["desc"], workers=1)
+    urns_df = clean_urns(urns_df)
+    template_out, messages = populate_template(template_df, urns_df, desc_df, options)
+    if reduced:
+        template_out = reduce_columns(template_out, template_df.columns.tolist())
+    data = export_xlsx(template_out) if fmt == "xlsx" else export_csv(template_out)
+    return {"data": data, "messages": messages, "rows": len(template_out)}
+
+
+# --- server side ---
+async def _populate(request):
+    state = request.app.state
+    if int(request.headers.get("content-length") or 0) > API_MAX_UPLOAD_MB * 1024 * 1024:
+        return JSONResponse({"errors": [f"upload larger than {API_MAX_UPLOAD_MB} MB"]}, status_code=413)
+    if state.in_flight >= state.workers * API_QUEUE_FACTOR:
+        return JSONResponse({"errors": ["server busy, retry later"]}, status_code=503, headers={"Retry-After": "5"})
+
+    state.in_flight += 1
+    try:
+        async with request.form(max_files=4, max_part_size=API_MAX_UPLOAD_MB * 1024 * 1024) as form:
+            files = {}
+            for name in ("urns", "desc", "template", "crediting"):
+                upload = form.get(name)
+                files[name] = await upload.read() if upload is not None and hasattr(upload, "read") else None
+            options_field = form.get("options")
+            if hasattr(options_field, "read"):  # options sent as a file part
+                options_field = await options_field.read()
+
+        errors = [f"{name} file is required" for name in ("urns", "desc") if not files[name]]
+        try:
+            doc = json.loads(options_field or "{}")
+        except ValueError as e:
+            errors.append(f"options is not valid JSON: {e}")
+        if errors:
+            return JSONResponse({"errors": errors}, status_code=400)
+
+        loop = asyncio.get_running_loop()
+        pool = state.pool
+        try:
+            result = await loop.run_in_executor(pool, populate_request, files, doc, state.memory_mb)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed when out of memory) and took the pool with it: later requests get a new one
+            if state.pool is pool:
+                state.pool = ProcessPoolExecutor(max_workers=state.workers)
+                pool.shutdown(wait=False)
+            return JSONResponse({"errors": ["a worker process stopped; retry the request"]}, status_code=503,
+                                headers={"Retry-After": "1"})
+        except Exception as e:
+            return JSONResponse({"errors": [f"{type(e).__name__}: {e}"]}, status_code=500)
+        if "errors" in result:
+            return JSONResponse(result, status_code=400)
+
+        fmt = doc.get("format", "xlsx")
+        return Response(
+            result["data"],
+            media_type=XLSX_MIME if fmt == "xlsx" else "text/csv",
+            headers={
+                "Content-Disposition": f'attachment; filename="JDMP_Populated_Template.{fmt}"',
+                "X-JDMP-Messages": json.dumps(result["messages"]),
+                "X-JDMP-Rows": str(result["rows"]),
+            },
+        )
+    finally:
+        state.in_flight -= 1
+
+
+async def populate(request):
+    with API_SECONDS.time(route="/populate"):
+        response = await _populate(request)
+    API_REQUESTS.inc(route="/populate", status=response.status_code)
+    return response
+
+
+async def health(request):
+    state = request.app.state
+    return JSONResponse({"status": "ok", "workers": state.workers, "in_flight": state.in_flight})
+
+
+async def metrics(request):
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+def create_app(workers=API_WORKERS, memory_mb=DEFAULT_MEMORY_BUDGET_MB):
+    app = Starlette(routes=[Route("/populate", populate, methods=["POST"]), Route("/health", health),
+                            Route("/metrics", metrics)])
+    app.state.workers = workers
+    app.state.in_flight = 0
+    # each worker plans against its share of the memory budget
+    app.state.memory_mb = max(memory_mb // workers, 64)
+    app.state.pool = ProcessPoolExecutor(max_workers=workers)
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local HTTP API for JDMP template population")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8510)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="population worker processes")
+    parser.add_argument("--memory-budget-mb", type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="memory shared by the workers; a worker streams batches that exceed its share")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.workers, args.memory_budget_mb), host=args.host, port=args.port)
@@ -0,0 +1,91 @@
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# --- load test for jdmp_api.py: POSTs the same batch at increasing concurrency ---
+# python jdmp_api_loadtest.py --urns URNs.xlsx --desc Desc.xlsx --options options.json --concurrency 1,2,4,8
+# compare throughput / latency across levels (and --workers settings of the server) to size the worker pool;
+# 503 responses mean the server's queue limit was hit
+
+
+def multipart_body(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def post(url, body, content_type, timeout):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError as e:  # connection refused / reset / timeout
+        status = type(e).__name__
+    return status, time.perf_counter() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else float("nan")
+
+
+def run_level(url, body, content_type, concurrency, n_requests, timeout):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: post(url, body, content_type, timeout), range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies = [t for status, t in results if status == 200]
+    return {
+        "concurrency": concurrency, "requests": n_requests, "ok": len(latencies),
+        "statuses": dict(Counter(status for status, _ in results if status != 200)),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_s": round(percentile(latencies, 50), 3), "p95_s": round(percentile(latencies, 95), 3),
+        "max_s": round(max(latencies, default=float("nan")), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the JDMP HTTP API")
+    parser.add_argument("--url", default="http://127.0.0.1:8510/populate")
+    parser.add_argument("--urns", required=True, help="URNs Excel")
+    parser.add_argument("--desc", required=True, help="Descriptive Metadata Excel")
+    parser.add_argument("--options", required=True, help="JSON options document (see jdmp_api.py)")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="requests per concurrency level")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    with open(args.urns, "rb") as f:
+        urns_bytes = f.read()
+    with open(args.desc, "rb") as f:
+        desc_bytes = f.read()
+    with open(args.options, encoding="utf-8") as f:
+        options = json.load(f)
+    body, content_type = multipart_body({"options": json.dumps(options)},
+                                        {"urns": ("urns.xlsx", urns_bytes), "desc": ("desc.xlsx", desc_bytes)})
+
+    # one warm-up request, so worker start-up and the default table caches are not measured
+    status, _ = post(args.url, body, content_type, args.timeout)
+    if status != 200:
+        raise SystemExit(f"warm-up request failed with {status}")
+
+    print(f"{'conc':>5} {'ok':>5} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'max s':>8}  other statuses")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        r = run_level(args.url, body, content_type, concurrency, args.requests, args.timeout)
+        print(f"{r['concurrency']:>5} {r['ok']:>5} {r['throughput_rps']:>8} {r['p50_s']:>8} {r['p95_s']:>8} "
+              f"{r['max_s']:>8}  {r['statuses'] or ''}")
@@ -0,0 +1,1630 @@
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from functools import lru_cache, wraps
+from itertools import islice, product
+
+import numpy as np
+import pandas as pd
+
+from jdmp_metrics import (CACHE_MISSES, CACHE_REQUESTS, EXPORT_BYTES, EXPORT_SECONDS, STAGE_CACHE, STAGE_SECONDS,
+                          UPLOAD_ROWS)
+
+# --- shared population pipeline for the JDMP apps (no Streamlit calls in here) ---
+# messages are returned as (level, text) pairs, level being "error" / "warning" / "info",
+# so the apps can surface them with getattr(st, level)(text)
+
+STANDARD_RIGHTS_TEXT = "The President and Fellows of Harvard College make no representation that they are the owner of the copyright; any researcher wishing to make use of an image must therefore assume all responsibility for clearing reproduction rights and for any infringement of Title 17 of the United States Code."
+
+TEMPLATE_FIXED_VAL_COLS = ["SSID", "File Count", "Repository[34349]", "Image Repository[34365]",
+                           "Send To Harvard[34382]", "In House Use Only[34383]", "Export Only In Group[34411]"]
+TEMPLATE_URNS_COLS = ["Filename", "Repository Classification Number[34364]", "Image Classification Number[34369]",
+                      "Repository Number[2560412]"]
+TEMPLATE_DATE_COLS = ["Date Description[34341]", "ARTstor Earliest Date[34342]", "ARTstor Latest Date[34343]",
+                      "Earliest Date[2560433]", "Latest Date[2560435]"]
+TEMPLATE_META_TYPE_COLS = ["Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]"]
+
+# columns explicitly populated by the pipeline (kept by the reduced export even when empty)
+MENTIONED_COLS = [
+    "SSID", "File Count", "Repository[34349]", "Image Repository[34365]",
+    "Send To Harvard[34382]", "In House Use Only[34383]", "Export Only In Group[34411]",
+    "Filename",
+    "Repository Classification Number[34364]", "Image Classification Number[34369]", "Repository Number[2560412]",
+    "Title[34338]",
+    "Date Description[34341]", "ARTstor Earliest Date[34342]", "ARTstor Latest Date[34343]",
+    "Earliest Date[2560433]", "Latest Date[2560435]",
+    "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]",
+    "Description[34357]",
+    "Creator[34336]", "Subject[34358]",
+    "Culture[34337]",
+    "Artstor Country[34356]",
+    "Rights[34363]", "Rights/Access Information[2560402]",
+    "Notes[2560400]",
+]
+
+ALWAYS_KEEP = {
+    "Creator[34336]",
+    "Subject[34358]",
+}
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def clean_urns(urns_df):
+    # drop rows with NaN or blank FILE-URN
+    urns_df = urns_df.dropna(subset=["FILE-URN"]).copy()
+    return urns_df[(urns_df["FILE-URN"].astype(str).str.strip() != "")].reset_index(drop=True)
+
+
+def read_crediting_table(source):
+    # read first two columns only and normalize
+    df = pd.read_excel(source)
+    df = df.iloc[:, :2].copy()
+    df.columns = ["source", "notes"]
+    df["source"] = df["source"].astype(str).str.strip()
+    df["notes"] = df["notes"].astype(str).fillna("").str.strip()
+    df = df.dropna(subset=["source"])
+    return df
+
+
+# reference tables (default template, crediting table) are parsed once per file version and kept as Arrow IPC
+# files in a private cache directory, memory-mapped by every process (see the shared frames section below), so
+# a cold start or a new worker maps the file instead of parsing the workbook again
+REFERENCE_CACHE_DIR = os.environ.get("JDMP_REFERENCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "jdmp_reference"))
+
+
+def reference_table(path, reader=pd.read_excel):
+    """reader(path), cached on disk per (path, size, mtime, reader)."""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{reader.__module__}.{reader.__qualname__}"
+    cache_path = os.path.join(REFERENCE_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest()[:16] + ".arrow")
+    CACHE_REQUESTS.inc(cache="reference")
+    try:
+        return open_shared_frame(cache_path)
+    except Exception:
+        pass  # not cached yet
+    CACHE_MISSES.inc(cache="reference")
+    table = reader(path)
+    if all(isinstance(c, str) for c in table.columns):
+        try:
+            os.makedirs(REFERENCE_CACHE_DIR, mode=0o700, exist_ok=True)
+            write_shared_frame(table, cache_path)
+        except OSError:
+            pass  # read-only filesystem: parse every time
+    return table
+
+
+def crediting_note(crediting_df, source):
+    # first non-blank note for a crediting source ("" if there is none)
+    credit_df_notes = crediting_df.loc[crediting_df["source"] == source, "notes"]
+    return next((t for t in credit_df_notes if t and t.strip()), "")
+
+
+def _add(messages, level, text):
+    # avoid duplicated messages (e.g. per-row date warnings, or the same warning from several chunks)
+    if (level, text) not in messages:
+        messages.append((level, text))
+
+
+# --- date parsing ---
+# catalog date strings ("1948-1950", "ca. 1960", "[196-?]", "1967?", ...) -> earliest / latest year + flag;
+# parsed once per unique value (pd.factorize + lru_cache), since date columns are highly repetitive
+DATE_FLAG_MESSAGE = "**One or more rows have approximate, uncertain or unrecognized dates; check the flagged dates.**"
+
+_APPROX_RE = re.compile(r"\b(?:ca|c|circa|approx(?:imately)?|about|around)\b\.?", re.IGNORECASE)
+_NOISE_RE = re.compile(r"[\[\]()?]")
+_YEAR_RE = re.compile(r"(\d{4})")
+_RANGE_RE = re.compile(r"(\d{4})\s*(?:-|–|—|/|to)\s*(\d{4}|\d{2})", re.IGNORECASE)
+_OR_RE = re.compile(r"(\d{4})\s+or\s+(\d{4})", re.IGNORECASE)
+_DECADE_RE = re.compile(r"(\d{3})(?:-|u|x|0s|0's)", re.IGNORECASE)
+_CENTURY_RE = re.compile(r"(\d{2})(?:--|uu|xx)", re.IGNORECASE)
+_ANY_YEAR_RE = re.compile(r"(?<!\d)(1\d{3}|20\d{2})(?!\d)")
+
+
+@lru_cache(maxsize=65536)
+def parse_date_text(text):
+    """Return (earliest, latest, flag) for one date string; flag is "" for plain years / ranges."""
+    text = text.strip()
+    if not text:
+        return None, None, ""
+    try:  # plain numbers behave exactly like pd.to_numeric
+        number = float(text)
+    except ValueError:
+        pass
+    else:
+        return (None, None, "") if not math.isfinite(number) else (int(number), int(number), "")
+
+    approximate = _APPROX_RE.search(text) is not None
+    questionable = "?" in text
+    core = _NOISE_RE.sub("", _APPROX_RE.sub("", text)).strip().rstrip(".,").strip()
+
+    earliest = latest = None
+    flag = ""
+    if m := _YEAR_RE.fullmatch(core):
+        earliest = latest = int(m.group(1))
+    elif m := _RANGE_RE.fullmatch(core):
+        earliest, end = int(m.group(1)), m.group(2)
+        if len(end) == 4:
+            latest = int(end)
+        else:  # "1948-50", "1898-02"
+            latest = earliest // 100 * 100 + int(end)
+            if int(end) < earliest % 100:
+                latest += 100
+        if latest < earliest:
+            flag = "end year before start year"
+    elif m := _OR_RE.fullmatch(core):
+        earliest, latest = sorted((int(m.group(1)), int(m.group(2))))
+        flag = "one of two years"
+    elif m := _DECADE_RE.fullmatch(core):
+        earliest = int(m.group(1)) * 10
+        latest = earliest + 9
+        flag = "" if core.lower().endswith("s") and not questionable and not approximate else "uncertain decade"
+    elif m := _CENTURY_RE.fullmatch(core):
+        earliest = int(m.group(1)) * 100
+        latest = earliest + 99
+        flag = "uncertain century"
+    elif years := [int(y) for y in _ANY_YEAR_RE.findall(text)]:
+        earliest, latest = min(years), max(years)
+        flag = "unrecognized format"
+    else:
+        return None, None, "no year found"
+
+    if not flag and approximate:
+        flag = "approximate"
+    elif not flag and questionable:
+        flag = "questionable"
+    return earliest, latest, flag
+
+
+def _parse_date_value(value):
+    if hasattr(value, "year"):  # dates / datetimes from Excel date cells
+        return value.year, value.year, ""
+    if isinstance(value, (int, float)):
+        return (int(value), int(value), "") if math.isfinite(value) else (None, None, "")
+    return parse_date_text(str(value))
+
+
+def parse_dates(values):
+    """Earliest / latest year and flag for every value of a date column (DataFrame aligned to values)."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    parsed = [_parse_date_value(v) for v in uniques] + [(None, None, "")]  # code -1 (missing) -> last entry
+    earliest, latest, flag = (pd.Series(x, dtype=d).to_numpy()
+                              for x, d in zip(zip(*parsed), ("float64", "float64", "object")))
+    return pd.DataFrame({"earliest": earliest[codes], "latest": latest[codes], "flag": flag[codes]},
+                        index=values.index)
+
+
+def date_flags(desc_df, start_col, end_col):
+    # rows (1-based) whose start or end date is flagged, with the years read from them
+    start, end = parse_dates(desc_df[start_col]), parse_dates(desc_df[end_col])
+    flagged = ((start["flag"] != "") | (end["flag"] != "")).to_numpy()
+    flags = pd.DataFrame({"Row": np.flatnonzero(flagged) + 1})
+    for col in dict.fromkeys([start_col, end_col]):
+        flags[col] = desc_df[col].to_numpy()[flagged]
+    flags["Earliest"] = start["earliest"].to_numpy()[flagged]
+    flags["Latest"] = end["latest"].fillna(start["latest"]).to_numpy()[flagged]
+    flags[["Earliest", "Latest"]] = flags[["Earliest", "Latest"]].astype("Int64")
+    flags["Flag"] = [
+        "; ".join(f for f in dict.fromkeys((s, e)) if f)
+        for s, e in zip(start["flag"].to_numpy()[flagged], end["flag"].to_numpy()[flagged])
+    ]
+    return flags
+
+
+def assign_dates(start, end, template_date_warnings):
+    """Vectorized date columns from start / end years (float arrays, NaN = blank).
+
+    Both present & different -> "start-end" range (start used when it is later than end); one present -> that
+    year; both blank -> 1900-2025. Returns the values for TEMPLATE_DATE_COLS and adds warnings to the set.
+    """
+    has_start, has_end = ~np.isnan(start), ~np.isnan(end)
+    inverted = has_start & has_end & (start > end)
+    is_range = has_start & has_end & (start < end)
+    only_end = ~has_start & has_end
+    neither = ~has_start & ~has_end
+
+    if inverted.any():
+        template_date_warnings.add("**One or more rows have Start Date later than End Date; Start Date used as default.**")
+    if only_end.any():
+        template_date_warnings.add("**One or more rows have blank Start Date; End Date used as default.**")
+    if neither.any():
+        template_date_warnings.add("**One or more rows have both Start and End Dates missing; defaulted to 1900–2025.**")
+
+    earliest = np.where(neither, 1900, np.where(has_start, start, end))
+    latest = np.where(neither, 2025, np.where(is_range, end, earliest))
+    earliest, latest = np.trunc(earliest).astype("int64"), np.trunc(latest).astype("int64")
+    description = earliest.astype(object)
+    for i in np.flatnonzero(is_range | neither):
+        description[i] = f"{earliest[i]}-{latest[i]}"
+    return [description.tolist(), earliest, latest, earliest, latest]
+
+
+# --- mapping rules (title formats + metadata type fields) ---
+# declared in jdmp_rules.json and compiled once into lookups keyed on (cataloging, geographic, metadata type),
+# "*" standing for a condition a rule leaves out; applying them is one lookup + one columnar operation
+RULES_PATH = os.environ.get("JDMP_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "jdmp_rules.json"))
+# reduced_version is true in the Reduced Version (and the API's reduced output), which leaves Creator alone for
+# Posters / Ephemera where the Full Version blanks it
+RULE_KEYS = ("cataloging_type", "geographic_type", "metadata_type", "reduced_version")
+
+
+def compile_rules(rules):
+    """Compile a rules document ({"title": [...], "fields": [...]}) into lookup tables; raises ValueError."""
+    compiled = {"title": {}, "fields": {}}
+    choices = {k: [] for k in RULE_KEYS}
+    for section in ("title", "fields"):
+        for i, rule in enumerate(rules.get(section, [])):
+            when = rule.get("when", {})
+            unknown = set(when) - set(RULE_KEYS)
+            if unknown:
+                raise ValueError(f"{section} rule {i + 1}: unknown condition(s) {sorted(unknown)}")
+            for k, v in when.items():
+                if v not in choices[k]:
+                    choices[k].append(v)
+
+            if section == "title":
+                parts = rule.get("format", "").split("{title}")
+                if len(parts) != 2:
+                    raise ValueError(f"title rule {i + 1}: format must contain {{title}} exactly once")
+                action = tuple(parts)  # (prefix, suffix)
+            else:
+                action = list(rule.get("set", {}).items())  # [(column, value), ...]
+
+            # the first rule for a key wins, like the first matching branch of an if/elif chain
+            compiled[section].setdefault(tuple(when.get(k, "*") for k in RULE_KEYS), action)
+    compiled["choices"] = choices
+    return compiled
+
+
+@lru_cache(maxsize=4)
+def _load_rules(path, mtime):
+    with open(path, "rb") as f:
+        data = f.read()
+    compiled = compile_rules(json.loads(data))
+    compiled["version"] = hashlib.sha1(data).hexdigest()[:12]
+    return compiled
+
+
+def mapping_rules(path=None):
+    # compiled rules, reloaded only when the file changes
+    path = path or RULES_PATH
+    return _load_rules(path, os.path.getmtime(path))
+
+
+def match_rule(table, opt):
+    # most specific rule first: exact values, then fewer and fewer conditions
+    values = [opt(k) for k in RULE_KEYS]
+    candidates = product(*[(v, "*") for v in values])
+    for key in sorted(candidates, key=lambda c: c.count("*")):
+        if key in table:
+            return table[key]
+    return None
+
+
+# --- population stages ---
+# each stage reads a few options / input columns and returns (assignments, messages); assignments are
+# (column, value, how) applied in stage order to the blank template, how being "loc"
+# (template_out.loc[:, col] = value) or "set" (template_out[col] = value, replaces the column dtype)
+def _stage_fixed(urns_df, desc_df, opt, columns):
+    # category 1: template population - standard fixed values
+    return [
+        ("SSID", "NEW", "loc"),
+        ("File Count", 1, "loc"),
+        ("Repository[34349]", "Judaica Division, Widener Library[9000347138]", "loc"),
+        ("Image Repository[34365]", "Judaica Division, Widener Library[9000347138]", "loc"),
+        ("Send To Harvard[34382]", True, "loc"),
+        ("In House Use Only[34383]", False, "loc"),
+        ("Export Only In Group[34411]", False, "loc"),
+    ], []
+
+
+def _stage_urns(urns_df, desc_df, opt, columns):
+    # category 2: URNs value population - FILE-URN + FILE-OSN
+    assignments, messages = [], []
+    try:
+        assignments.append(("Filename", "drs:" + urns_df["FILE-URN"].astype(str).str.strip(), "loc"))
+
+        osn_transformed = urns_df["OBJ-OSN"].astype(str).str.upper().str.replace("_", "", n=1)
+        assignments.append(("Repository Classification Number[34364]", osn_transformed, "loc"))
+        assignments.append(("Image Classification Number[34369]", osn_transformed, "loc"))
+        assignments.append(("Repository Number[2560412]", osn_transformed + " (classification)", "loc"))
+    except KeyError as e:
+        _add(messages, "error", f"**Template missing expected column(s) for URN-related population: {e}**")
+    return assignments, messages
+
+
+def _stage_dates(urns_df, desc_df, opt, columns):
+    # category 3-1: descriptive metadata population - start/end dates
+    desc_start_date_col = opt("desc_start_date_col")
+    desc_end_date_col = opt("desc_end_date_col")
+    if desc_start_date_col is None or desc_end_date_col is None:
+        return [], []
+
+    # earliest year from the start column, latest from the end column (or the start column's own range)
+    start = parse_dates(desc_df[desc_start_date_col])
+    end = parse_dates(desc_df[desc_end_date_col])
+    template_date_warnings = set()  # avoid duplicated warnings
+    date_values = assign_dates(start["earliest"].to_numpy(), end["latest"].fillna(start["latest"]).to_numpy(),
+                               template_date_warnings)
+    if (start["flag"] != "").any() or (end["flag"] != "").any():
+        template_date_warnings.add(DATE_FLAG_MESSAGE)
+
+    messages = []
+    for msg in sorted(template_date_warnings):
+        _add(messages, "warning", msg)
+
+    date_df = pd.DataFrame(dict(zip(TEMPLATE_DATE_COLS, date_values)))
+    return [(col, date_df[col], "set") for col in date_df.columns], messages
+
+
+def _stage_title(urns_df, desc_df, opt, columns):
+    # category 3-2: descriptive metadata population - title (format from the mapping rules)
+    desc_title_col = opt("desc_title_col")
+    if desc_title_col is None or opt("metadata_type") is None or opt("cataloging_type") is None:
+        return [], []
+    if desc_title_col not in desc_df.columns:
+        return [], [("error", "**Selected Title column not found in Descriptive Metadata.**")]
+
+    titles = desc_df[desc_title_col].astype(str).str.strip()
+    rule = match_rule(mapping_rules()["title"], opt)
+    if rule is None:
+        return [("Title[34338]", "", "loc")], [("warning", "**Unknown Cataloging Type; titles left blank.**")]
+    prefix, suffix = rule
+    populated_titles = prefix + titles + suffix if (prefix or suffix) else titles
+    return [("Title[34338]", populated_titles, "loc")], []
+
+
+def _stage_metadata_type(urns_df, desc_df, opt, columns):
+    # category 3-3: descriptive metadata population - metadata type-related (fields from the mapping rules)
+    fields = match_rule(mapping_rules()["fields"], opt)
+    if fields is None:
+        return [], []
+    return [(col, value, "loc") for col, value in fields], []
+
+
+def _stage_note(urns_df, desc_df, opt, columns):
+    # category 3-4: descriptive metadata population - general note
+    desc_source_type = opt("desc_source_type")
+    if "Description[34357]" not in columns:
+        return [], [("error", "**Template missing expected column for General Note population: 'Description[34357]'**")]
+    if desc_source_type is None:
+        return [], []
+    if desc_source_type == "Descriptive Metadata Column" and opt("desc_note_col"):
+        return [("Description[34357]", desc_df[opt("desc_note_col")].astype(str).str.strip(), "loc")], []
+    elif desc_source_type == "NO GENERAL NOTE":
+        return [("Description[34357]", "", "loc")], []
+    elif desc_source_type == "OTHER" and opt("desc_source_text"):
+        return [("Description[34357]", opt("desc_source_text"), "loc")], []
+    return [], [("warning", "**Please select a valid General Note source or text.**")]
+
+
+def _stage_culture(urns_df, desc_df, opt, columns):
+    # category 3-5: descriptive metadata population - culture
+    if "Culture[34337]" not in columns:
+        return [], [("error", "**Template missing expected column for Culture Type population: 'Culture[34337]'**")]
+    if opt("geographic_type") == "Israel":
+        return [("Culture[34337]", "Israeli", "loc")], []
+    elif opt("geographic_type") == "World Judaica":
+        return [("Culture[34337]", "Jewish", "loc")], []
+    return [], []
+
+
+def _stage_country(urns_df, desc_df, opt, columns):
+    # category 3-6: descriptive metadata population - artstor country
+    if "Artstor Country[34356]" not in columns:
+        return [], [("error", "**Template missing expected column for Country Information population: 'Artstor Country[34356]'**")]
+    artstor_country_col = opt("artstor_country_col")
+    if opt("geographic_type") == "Israel":
+        return [("Artstor Country[34356]", "Israel", "loc")], []
+    elif opt("geographic_type") == "World Judaica" and artstor_country_col is not None:
+        return [("Artstor Country[34356]", desc_df[artstor_country_col].astype(str).str.strip(), "loc")], []
+    return [], []
+
+
+def _stage_creator_subject(urns_df, desc_df, opt, columns):
+    # category 1-2: template population - creator + subject (only when the app collects them)
+    assignments, messages = [], []
+    for text, col in ((opt("template_creator"), "Creator[34336]"), (opt("template_subject"), "Subject[34358]")):
+        if text is None:
+            continue
+        if col not in columns:
+            _add(messages, "error", f"**Template missing expected column: '{col}'**")
+        elif text.strip():
+            assignments.append((col, text.strip(), "loc"))
+    return assignments, messages
+
+
+def _stage_rights_credit(urns_df, desc_df, opt, columns):
+    # category 1-3: template population - copyright + crediting info
+    assignments, messages = [], []
+    if opt("template_rights_type") is not None:
+        template_rights_text = opt("template_rights_text") or ""
+        if template_rights_text != "":
+            assignments.append(("Rights[34363]", template_rights_text, "loc"))
+            assignments.append(("Rights/Access Information[2560402]", template_rights_text, "loc"))
+        else:
+            _add(messages, "warning", "**Please enter Copyright Information.**")
+
+    if opt("template_credit_type") is not None:
+        template_credit_text = opt("template_credit_text") or ""
+        if template_credit_text != "":
+            assignments.append(("Notes[2560400]", template_credit_text, "loc"))
+        else:
+            _add(messages, "error", "**Crediting Note cannot be blank.**")
+    return assignments, messages
+
+
+def _reads_note(opt):
+    return (opt("desc_note_col"),) if opt("desc_source_type") == "Descriptive Metadata Column" else ()
+
+
+def _reads_country(opt):
+    return (opt("artstor_country_col"),) if opt("geographic_type") == "World Judaica" else ()
+
+
+# (name, function, option keys read, urns columns read, desc columns read) in population order;
+# the column readers take options.get since the selected columns are options themselves
+POPULATION_STAGES = [
+    ("fixed values", _stage_fixed, (), (), lambda opt: ()),
+    ("URN fields", _stage_urns, (), ("FILE-URN", "OBJ-OSN"), lambda opt: ()),
+    ("dates", _stage_dates, ("desc_start_date_col", "desc_end_date_col"), (),
+     lambda opt: (opt("desc_start_date_col"), opt("desc_end_date_col"))),
+    # the mapping rules stages read every rule condition (match_rule), whichever ones the rules use
+    ("title", _stage_title, ("desc_title_col", *RULE_KEYS), (), lambda opt: (opt("desc_title_col"),)),
+    ("metadata type", _stage_metadata_type, RULE_KEYS, (), lambda opt: ()),
+    ("general note", _stage_note, ("desc_source_type", "desc_note_col", "desc_source_text"), (), _reads_note),
+    ("culture", _stage_culture, ("geographic_type",), (), lambda opt: ()),
+    ("country", _stage_country, ("geographic_type", "artstor_country_col"), (), _reads_country),
+    ("creator/subject", _stage_creator_subject, ("template_creator", "template_subject"), (), lambda opt: ()),
+    ("rights/credit", _stage_rights_credit,
+     ("template_rights_type", "template_rights_text", "template_credit_type", "template_credit_text"), (), lambda opt: ()),
+]
+
+
+def _blank_template(template_df, target_rows):
+    # initialize blank template aligned to URNs row count
+    template_out = template_df.head(0).copy()
+    return template_out.reindex(range(target_rows)).reset_index(drop=True)
+
+
+def _apply(template_out, assignments):
+    for col, value, how in assignments:
+        if how == "set":
+            template_out[col] = value
+        else:
+            template_out.loc[:, col] = value
+
+
+def _added_cols(columns, assignments):
+    # .loc / [] assignment appends columns the template does not have
+    return columns + [c for c in dict.fromkeys(col for col, _, _ in assignments) if c not in columns]
+
+
+def stage_input_columns(options):
+    # (urns columns, desc columns) the stages read for these options, in first-use order
+    urns_cols, desc_cols = [], []
+    for _, _, _, stage_urns_cols, stage_desc_cols in POPULATION_STAGES:
+        urns_cols += stage_urns_cols
+        desc_cols += [c for c in stage_desc_cols(options.get) if c is not None]
+    return list(dict.fromkeys(urns_cols)), list(dict.fromkeys(desc_cols))
+
+
+def populate_template(template_df, urns_df, desc_df, options, messages=None, progress=None):
+    """Populate a blank copy of template_df from cleaned URNs + descriptive metadata.
+
+    options holds the user's selections, keyed like the app variables (metadata_type, desc_title_col,
+    template_rights_text, ...). progress, if given, is called as progress(stage_name, done, total)
+    before each stage. Returns (template_out, messages).
+    """
+    if messages is None:
+        messages = []
+    template_out = _blank_template(template_df, len(urns_df))
+    for i, (name, stage, _, _, _) in enumerate(POPULATION_STAGES):
+        if progress is not None:
+            progress(name, i, len(POPULATION_STAGES))
+        with STAGE_SECONDS.time(stage=name):
+            assignments, stage_messages = stage(urns_df, desc_df, options.get, template_out.columns.tolist())
+        _apply(template_out, assignments)
+        for level, text in stage_messages:
+            _add(messages, level, text)
+    return template_out, messages
+
+
+def populated_cols(template_out, options):
+    # columns filled so far, in category order (used by the Full Version preview)
+    cols = TEMPLATE_FIXED_VAL_COLS + TEMPLATE_URNS_COLS
+    if options.get("desc_title_col") is not None and options.get("metadata_type") is not None:
+        cols += ["Title[34338]"]
+    if options.get("desc_start_date_col") is not None and options.get("desc_end_date_col") is not None:
+        cols += TEMPLATE_DATE_COLS
+    cols += ["Culture[34337]", "Artstor Country[34356]"]
+    if options.get("metadata_type") is not None:
+        cols += TEMPLATE_META_TYPE_COLS
+    cols += ["Description[34357]", "Rights[34363]", "Rights/Access Information[2560402]", "Notes[2560400]"]
+    return [c for c in cols if c in template_out.columns]
+
+
+# --- template column reduction for export (keep template order) ---
+def reduced_cols(template_order, template_out, non_empty_cols=()):
+    # final keep set:
+    # - any columns with content
+    # - any columns explicitly mentioned in code
+    # - plus Creator/Subject/... (as required) always
+    keep_cols_set = set(non_empty_cols).union(MENTIONED_COLS).union(ALWAYS_KEEP)
+    return [c for c in template_order if (c in keep_cols_set and c in template_out.columns)]
+
+
+def reduce_columns(template_out, template_order):
+    non_empty_cols = set()
+    for col in template_out.columns:
+        series = template_out[col]
+        # fillna first: on pandas >= 3, astype(str) keeps missing values as NaN instead of "nan"
+        has_content = series.fillna("").astype(str).str.strip().replace("nan", "").ne("").any()
+        if has_content:
+            non_empty_cols.add(col)
+
+    keep_cols = reduced_cols(template_order, template_out, non_empty_cols)
+    return template_out.loc[:, keep_cols].copy()
+
+
+# --- export ---
+# openpyxl is imported where a workbook is read or written: it is not needed to start the apps and its import
+# is a large part of a cold start
+@lru_cache(maxsize=1)
+def _cell_styles():
+    # border, alignment and header font shared by the in-memory and streamed XLSX writers
+    from openpyxl.styles import Alignment, Border, Font, Side
+
+    thin = Side(border_style="thin", color="000000")
+    return (Border(top=thin, left=thin, right=thin, bottom=thin),
+            Alignment(vertical="top", horizontal="left", wrap_text=True), Font(bold=True))
+
+
+def _metered_export(fmt):
+    # export latency + bytes metrics (no-ops unless metrics are enabled)
+    def wrap(export):
+        @wraps(export)
+        def metered(*args, **kwargs):
+            with EXPORT_SECONDS.time(format=fmt):
+                data = export(*args, **kwargs)
+            EXPORT_BYTES.inc(len(data), format=fmt)
+            return data
+        return metered
+    return wrap
+
+
+@_metered_export("xlsx")
+def export_xlsx(template_export):
+    border, align_top, header_font = _cell_styles()
+    xlsx_output = io.BytesIO()
+    with pd.ExcelWriter(xlsx_output, engine="openpyxl") as writer:
+        template_export.to_excel(writer, index=False, sheet_name="Sheet1")
+
+        # styling: borders + top alignment + wrap, bold header (whatever header style pandas applied)
+        # resolved once per distinct starting style (header / plain / date cells) and copied onto the rest,
+        # since assigning .border/.alignment re-hashes the style objects for every cell
+        worksheet = writer.sheets["Sheet1"]
+        resolved = {}
+        for row in worksheet.iter_rows(
+            min_row=1, max_row=worksheet.max_row, min_col=1, max_col=worksheet.max_column
+        ):
+            for cell in row:
+                key = (cell.row == 1, tuple(cell._style) if cell.has_style else None)
+                if key not in resolved:
+                    cell.border = border
+                    cell.alignment = align_top
+                    if cell.row == 1:
+                        cell.font = header_font
+                    resolved[key] = copy(cell._style)
+                else:
+                    cell._style = copy(resolved[key])
+    return xlsx_output.getvalue()
+
+
+@_metered_export("csv")
+def export_csv(template_export):
+    # use UTF-8 with BOM so Excel on Windows opens it without mojibake
+    return template_export.to_csv(index=False).encode("utf-8-sig")
+
+
+@_metered_export("csv.gz")
+def export_csv_gz(template_export):
+    # the unmetered writer, so the export is counted once, as csv.gz
+    return gzip.compress(export_csv.__wrapped__(template_export), compresslevel=6)
+
+
+def gzip_file(path, out_path=None):
+    # gzip an exported file on disk in blocks (streaming mode); returns the .gz path
+    out_path = out_path or path + ".gz"
+    with open(path, "rb") as src, gzip.open(out_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    return out_path
+
+
+def _export_shard(args):
+    # worker-process entry point: (shard frame, "xlsx" | "csv") -> bytes; unmetered, the ZIP is counted as a whole
+    shard, fmt = args
+    return export_xlsx.__wrapped__(shard) if fmt == "xlsx" else export_csv.__wrapped__(shard)
+
+
+@_metered_export("zip")
+def export_sharded_zip(template_export, shard_rows=10000, fmt="xlsx", workers=None):
+    """Split template_export into shard_rows-row parts, serialize them in parallel worker processes
+    and return one ZIP (JDMP_Populated_Template_part001.xlsx, ...)."""
+    shards = [template_export.iloc[i:i + shard_rows] for i in range(0, max(len(template_export), 1), shard_rows)]
+    workers = min(workers or os.cpu_count() or 1, len(shards))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_export_shard, [(shard, fmt) for shard in shards]))
+    else:
+        parts = [_export_shard((shard, fmt)) for shard in shards]
+
+    zip_output = io.BytesIO()
+    # .xlsx parts are already deflated, so they are stored as-is
+    compression = zipfile.ZIP_STORED if fmt == "xlsx" else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(zip_output, "w", compression=compression) as zf:
+        for i, part in enumerate(parts, start=1):
+            zf.writestr(f"JDMP_Populated_Template_part{i:03d}.{fmt}", part)
+    return zip_output.getvalue()
+
+
+# --- incremental stage graph ---
+def column_fingerprint(df, col):
+    # (rows, content hash) of one input column; None when the column is missing
+    if col is None or col not in df.columns:
+        return None
+    try:
+        return len(df), int(pd.util.hash_pandas_object(df[col], index=True).sum())
+    except TypeError:  # unhashable cells (lists, dicts): never reused
+        return len(df), object()
+
+
+class StageGraph:
+    """Memoized population pipeline: each stage in POPULATION_STAGES is recomputed only when the options
+    and input columns it reads change, the assembled / reduced frames and the export bytes only when one
+    of their stages did. Keep one instance per session; hits / misses count reuse per node.
+
+    Returned frames are shared with the memo and must not be modified in place.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.memo = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.last_key = None
+
+    def _cached(self, node, key, compute):
+        memo = self.memo.setdefault(node, OrderedDict())
+        if key in memo:
+            self.hits[node] += 1
+            STAGE_CACHE.inc(stage=node, result="hit")
+            memo.move_to_end(key)
+            return memo[key]
+        self.misses[node] += 1
+        STAGE_CACHE.inc(stage=node, result="miss")
+        with STAGE_SECONDS.time(stage=node):
+            value = memo[key] = compute()
+        if len(memo) > self.max_entries:
+            memo.popitem(last=False)
+        return value
+
+    def run(self, template_df, urns_df, desc_df, options):
+        """Same result as populate_template: (template_out, messages). The result's key is kept in last_key."""
+        opt = options.get
+        columns = template_df.columns.tolist()
+        stage_results = []
+        stage_keys = []
+        for name, stage, option_keys, urns_cols, desc_cols in POPULATION_STAGES:
+            key = (
+                tuple(opt(k) for k in option_keys),
+                tuple(column_fingerprint(urns_df, c) for c in urns_cols),
+                tuple(column_fingerprint(desc_df, c) for c in desc_cols(opt)),
+                len(urns_df), tuple(columns), mapping_rules()["version"],
+            )
+            result = self._cached(name, key, lambda: stage(urns_df, desc_df, opt, columns))
+            columns = _added_cols(columns, result[0])
+            stage_results.append(result)
+            stage_keys.append(key)
+
+        def assemble():
+            template_out = _blank_template(template_df, len(urns_df))
+            messages = []
+            for assignments, stage_messages in stage_results:
+                _apply(template_out, assignments)
+                for level, text in stage_messages:
+                    _add(messages, level, text)
+            return template_out, messages
+
+        self.last_key = (tuple(template_df.columns), tuple(map(str, template_df.dtypes)), tuple(stage_keys))
+        template_out, messages = self._cached("assemble", self.last_key, assemble)
+        return template_out, list(messages)
+
+    def reduce(self, template_out, template_order):
+        """reduce_columns of the last run's template_out; the reduced frame's key replaces last_key."""
+        self.last_key = (self.last_key, "reduced")
+        return self._cached("reduce", self.last_key, lambda: reduce_columns(template_out, template_order))
+
+    def export(self, template_export, key, fmt="xlsx"):
+        """Export bytes ("xlsx" / "csv" / "csv.gz") of template_export, the frame run() returned for key."""
+        exporters = {"xlsx": export_xlsx, "csv": export_csv, "csv.gz": export_csv_gz}
+        return self._cached(f"export {fmt}", (key, fmt), lambda: exporters[fmt](template_export))
+
+    def stats(self):
+        # one row per node, in pipeline order
+        nodes = [name for name, *_ in POPULATION_STAGES] + ["assemble", "reduce"]
+        nodes += sorted(n for n in set(self.hits) | set(self.misses) if n.startswith("export"))
+        return pd.DataFrame(
+            [{"Stage": n, "Hits": self.hits[n], "Misses": self.misses[n]} for n in nodes if n in self.memo],
+        )
+
+
+# --- delta export against a previously submitted file ---
+def read_previous_export(source):
+    # everything as text, blanks as "", so cells compare the same way as the normalized current export
+    if hasattr(source, "seek"):
+        source.seek(0)
+    if _source_name(source).endswith(".csv"):
+        return pd.read_csv(source, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    return pd.read_excel(source, dtype=str).fillna("")
+
+
+def _normalized(df, columns):
+    # cell text as it appears in the exported file: blanks -> "", 1950.0 -> "1950", True -> "True"
+    out = df.loc[:, columns].astype(object)
+    out = out.where(out.notna(), "")
+    for col in columns:
+        # only mixed/float columns need the per-cell check; inferring the column type runs in C
+        if pd.api.types.infer_dtype(out[col], skipna=True) in ("string", "empty", "integer", "boolean"):
+            continue
+        floats = out[col].map(lambda v: isinstance(v, float) and v.is_integer())
+        if floats.any():
+            out.loc[floats, col] = out.loc[floats, col].map(int)
+    return out.astype(str).apply(lambda s: s.str.strip())
+
+
+def row_hashes(df, columns, key="Filename"):
+    # one vectorized 64-bit content hash per row, indexed by the key column
+    normalized = _normalized(df, columns)
+    hashes = pd.util.hash_pandas_object(normalized, index=False)
+    hashes.index = normalized[key] if key in columns else _normalized(df, [key])[key]
+    return hashes[~hashes.index.duplicated(keep="first")]
+
+
+def delta_export(template_export, previous_df, key="Filename"):
+    """Rows of template_export that are new or changed compared with previous_df (matched on key).
+
+    Only columns present in both files are compared. Returns (delta_df, status, summary): status is the
+    per-row "new" / "changed" / "unchanged" label for template_export, summary holds the counts and the
+    keys that were in the previous file but are gone now.
+    """
+    if key not in template_export.columns or key not in previous_df.columns:
+        raise KeyError(f"Both files need a '{key}' column for a delta export")
+    columns = [c for c in template_export.columns if c in previous_df.columns]
+
+    current = row_hashes(template_export, columns, key)
+    previous = row_hashes(previous_df, columns, key)
+
+    current_keys = _normalized(template_export, [key])[key]
+    previous_hash = current_keys.map(previous)
+    status = pd.Series("changed", index=template_export.index)
+    status[previous_hash.isna()] = "new"
+    status[previous_hash.eq(current_keys.map(current)).to_numpy()] = "unchanged"
+
+    removed = previous.index.difference(current.index).tolist()
+    summary = {
+        "new": int(status.eq("new").sum()),
+        "changed": int(status.eq("changed").sum()),
+        "unchanged": int(status.eq("unchanged").sum()),
+        "removed": removed,
+        "compared_columns": len(columns),
+    }
+    return template_export.loc[status.ne("unchanged")].copy(), status, summary
+
+
+# --- memory-budget planner: pick in-memory / column-pruned / streaming before a full parse ---
+EXECUTION_MODES = ["Automatic", "In-memory", "Column-pruned", "Streaming"]
+DEFAULT_MEMORY_BUDGET_MB = int(os.environ.get("JDMP_MEMORY_BUDGET_MB", "1024"))
+
+# rough per-cell costs, measured on typical batches (object columns, short strings)
+PARSE_BYTES_PER_CELL = 250   # pd.read_excel: openpyxl cells + intermediate row lists
+FRAME_BYTES_PER_CELL = 100   # parsed DataFrame cell (pointer + boxed str/int)
+EMPTY_BYTES_PER_CELL = 8     # blank template cell (pointer to the shared NaN)
+XLSX_BYTES_PER_CELL = 450    # styled openpyxl cell while building the export workbook
+CSV_BYTES_PER_CELL = 40      # encoded CSV output
+XLSX_FILE_BYTES_PER_CELL = 12  # compressed .xlsx on disk, used when the sheet has no usable dimension
+PRUNED_INPUT_COLS = 8        # match field, FILE-URN, OBJ-OSN, title, dates, note, country
+
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension ref="([A-Z]+[0-9]+(?::[A-Z]+[0-9]+)?)"')
+_SHEET_RE = re.compile(rb'<(?:\w+:)?sheet\b[^>]*?r:id="([^"]+)"')
+
+
+def _source_size(source):
+    if hasattr(source, "size"):  # streamlit UploadedFile
+        return source.size
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes
+    return os.path.getsize(source)
+
+
+def _first_sheet_path(zf):
+    rid = _SHEET_RE.search(zf.read("xl/workbook.xml"))
+    rels = zf.read("xl/_rels/workbook.xml.rels")
+    if rid:
+        target = re.search(rb'<Relationship\b[^>]*Id="' + re.escape(rid.group(1)) + rb'"[^>]*Target="([^"]+)"', rels) \
+            or re.search(rb'<Relationship\b[^>]*Target="([^"]+)"[^>]*Id="' + re.escape(rid.group(1)) + rb'"', rels)
+        if target:
+            path = target.group(1).decode()
+            return path.lstrip("/") if path.startswith("/") else "xl/" + path
+    return "xl/worksheets/sheet1.xml"
+
+
+def sheet_dimensions(source):
+    """(rows, cols, basis) of the first sheet without parsing it.
+
+    For .xlsx the <dimension> element at the top of the sheet XML is used; when it is missing or bogus
+    (A1 only), rows are estimated from the file size. For .csv the lines are counted.
+    """
+    if hasattr(source, "seek"):
+        source.seek(0)
+    if _source_name(source).endswith(".csv"):
+        cols = len(read_header(source))
+        if hasattr(source, "seek"):
+            source.seek(0)
+            rows = sum(block.count(b"\n") for block in iter(lambda: source.read(1 << 20), b""))
+        else:
+            with open(source, "rb") as f:
+                rows = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+        return max(rows - 1, 0), cols, "line count"
+
+    with zipfile.ZipFile(source) as zf:
+        with zf.open(_first_sheet_path(zf)) as f:
+            head = f.read(4096)
+    match = _DIMENSION_RE.search(head)
+    if match and b":" in match.group(1):
+        from openpyxl.utils.cell import range_boundaries
+
+        min_col, min_row, max_col, max_row = range_boundaries(match.group(1).decode())
+        return max_row - min_row, max_col - min_col + 1, "dimension metadata"
+
+    cols = len(read_header(source)) or 1
+    return _source_size(source) // (XLSX_FILE_BYTES_PER_CELL * cols), cols, "file size"
+
+
+def plan_execution(urns_source, desc_source, budget_mb=DEFAULT_MEMORY_BUDGET_MB, template_cols=112, export_cols=28,
+                   chunk_rows=5000):
+    """Estimate peak memory per execution mode and pick the cheapest-to-run mode that fits the budget.
+
+    Returns a dict with mode, estimates_mb (per mode), rows, budget_mb and a summary for the UI.
+    """
+    inputs = []
+    for label, source in (("URNs", urns_source), ("Descriptive Metadata", desc_source)):
+        if source is not None:
+            rows, cols, basis = sheet_dimensions(source)
+            inputs.append((label, rows, cols, basis))
+    rows = max((r for _, r, _, _ in inputs), default=0)
+
+    input_cells = sum(r * c for _, r, c, _ in inputs)
+    pruned_cells = sum(r * min(c, PRUNED_INPUT_COLS) for _, r, c, _ in inputs)
+    largest_parse = max((r * c for _, r, c, _ in inputs), default=0) * PARSE_BYTES_PER_CELL
+
+    def pipeline(n_rows):
+        # template_out + template_export + styled workbook + CSV bytes
+        return (n_rows * template_cols * EMPTY_BYTES_PER_CELL
+                + n_rows * export_cols * (FRAME_BYTES_PER_CELL + XLSX_BYTES_PER_CELL + CSV_BYTES_PER_CELL))
+
+    mb = 1024 * 1024
+    estimates = {
+        "In-memory": (largest_parse + input_cells * FRAME_BYTES_PER_CELL + pipeline(rows)) / mb,
+        "Column-pruned": (pruned_cells * FRAME_BYTES_PER_CELL + pipeline(rows)) / mb,
+        # FILE-URN + the two match fields stay in memory, everything else lives in one chunk at a time
+        "Streaming": (rows * 3 * FRAME_BYTES_PER_CELL + pipeline(min(rows, chunk_rows))) / mb,
+    }
+
+    mode = next((m for m in ("In-memory", "Column-pruned") if estimates[m] <= budget_mb), "Streaming")
+    dims = "; ".join(f"{label}: ~{r:,} rows x {c} cols ({basis})" for label, r, c, basis in inputs)
+    summary = (f"Execution plan: **{mode}** — estimated peak {estimates[mode]:,.0f} MB of {budget_mb:,} MB budget "
+               f"(in-memory ~{estimates['In-memory']:,.0f} MB). {dims}")
+    if estimates[mode] > budget_mb:
+        summary += " Even streaming exceeds the budget; lower the rows per chunk or raise the budget."
+    return {"mode": mode, "estimates_mb": estimates, "rows": rows, "budget_mb": budget_mb, "inputs": inputs,
+            "summary": summary}
+
+
+# --- streaming mode: chunked input -> chunked population -> incremental export on disk ---
+def _source_name(source):
+    return str(getattr(source, "name", source)).lower()
+
+
+def _header_names(raw):
+    # mimic pandas header handling: blank -> "Unnamed: i", duplicates -> "name.1", "name.2", ...
+    names, seen = [], {}
+    for i, name in enumerate(raw):
+        name = f"Unnamed: {i}" if name is None or str(name).strip() == "" else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _convert_cell(value):
+    # same as pandas' openpyxl reader: integral floats come back as int
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _xlsx_rows(source):
+    from openpyxl import load_workbook
+
+    if hasattr(source, "seek"):
+        source.seek(0)
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()  # some writers store a bogus sheet dimension
+        yield from ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def read_header(source):
+    if _source_name(source).endswith(".csv"):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return pd.read_csv(source, nrows=0).columns.tolist()
+    return _header_names(next(_xlsx_rows(source), ()))
+
+
+def iter_sheet_chunks(source, chunk_rows=5000, usecols=None):
+    """Yield the first sheet of an .xlsx (read-only) or .csv as DataFrames of at most chunk_rows rows."""
+    if _source_name(source).endswith(".csv"):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        wanted = None if usecols is None else set(usecols)
+        yield from pd.read_csv(source, chunksize=chunk_rows, usecols=None if wanted is None else (lambda c: c in wanted))
+        return
+
+    rows = _xlsx_rows(source)
+    header = _header_names(next(rows, ()))
+    width = len(header)
+    keep = None if usecols is None else [i for i, c in enumerate(header) if c in set(usecols)]
+    columns = header if keep is None else [header[i] for i in keep]
+
+    batch, blanks = [], []
+    for raw in rows:
+        values = [_convert_cell(v) for v in islice(raw, width)]
+        values += [None] * (width - len(values))
+        if all(v is None or v == "" for v in values):
+            blanks.append(values if keep is None else [None] * len(keep))  # trailing blank rows are dropped, blank rows in between are kept
+            continue
+        if keep is not None:
+            values = [values[i] for i in keep]
+        batch.extend(blanks)
+        blanks = []
+        batch.append(values)
+        if len(batch) >= chunk_rows:
+            yield pd.DataFrame(batch[:chunk_rows], columns=columns)
+            batch = batch[chunk_rows:]
+    if batch:
+        yield pd.DataFrame(batch, columns=columns)
+
+
+def read_columns(source, columns, chunk_rows=20000):
+    # read only the given columns (e.g. FILE-URN for the preview, match keys for validation)
+    chunks = list(iter_sheet_chunks(source, chunk_rows, usecols=columns))
+    if not chunks:
+        return pd.DataFrame(columns=[c for c in columns if c in read_header(source)])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _rechunk(chunks, chunk_rows):
+    # regroup a chunk stream into exact chunk_rows-sized frames with a fresh 0..n-1 index
+    buffer, size = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        while size >= chunk_rows:
+            merged = pd.concat(buffer, ignore_index=True)
+            yield merged.iloc[:chunk_rows].reset_index(drop=True)
+            buffer, size = [merged.iloc[chunk_rows:]], size - chunk_rows
+    if size:
+        yield pd.concat(buffer, ignore_index=True)
+
+
+def _xlsx_styler(ws):
+    # resolve the border/alignment styles once and copy the style array onto each cell;
+    # assigning .border/.alignment per cell re-hashes the style objects for every cell
+    from openpyxl.cell import WriteOnlyCell
+
+    border, align_top, header_font = _cell_styles()
+    styled = {}
+    for header in (False, True):
+        cell = WriteOnlyCell(ws)
+        cell.border = border
+        cell.alignment = align_top
+        if header:
+            cell.font = header_font
+        styled[header] = cell._style
+
+    def make_cell(value, header=False):
+        if value is not None and pd.isna(value):
+            value = None
+        elif hasattr(value, "item"):
+            value = value.item()  # numpy scalar -> python
+        cell = WriteOnlyCell(ws, value=value)
+        cell._style = copy(styled[header])
+        return cell
+
+    return make_cell
+
+
+def stream_populate(template_df, urns_source, desc_source, options, chunk_rows=5000, reduced=True, out_dir=None,
+                    progress=None):
+    """Populate and export in row chunks so peak memory stays bounded by chunk_rows.
+
+    Both inputs are paired by position after URN cleaning, exactly like the in-memory pipeline. The CSV
+    and styled XLSX are written incrementally to out_dir (a new temp dir by default). progress, if given,
+    is called as progress("rows", rows_done, None) after each chunk.
+    Returns a dict with csv_path, xlsx_path, rows, preview (first rows) and messages.
+    """
+    out_dir = out_dir or tempfile.mkdtemp(prefix="jdmp_")
+    csv_path = os.path.join(out_dir, "JDMP_Populated_Template.csv")
+    xlsx_path = os.path.join(out_dir, "JDMP_Populated_Template.xlsx")
+
+    messages = []
+    urns_chunks = _rechunk((clean_urns(c) for c in iter_sheet_chunks(urns_source, chunk_rows)), chunk_rows)
+    desc_chunks = _rechunk(iter_sheet_chunks(desc_source, chunk_rows), chunk_rows)
+    desc_empty = pd.DataFrame(columns=read_header(desc_source))
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    xlsx_cell = _xlsx_styler(ws)
+    columns, preview, rows = None, None, 0
+
+    with open(csv_path, "w", encoding="utf-8-sig", newline="") as csv_file:
+        for urns_chunk in urns_chunks:
+            desc_chunk = next(desc_chunks, desc_empty)  # shorter metadata -> blank rows, like the in-memory path
+            template_out, messages = populate_template(template_df, urns_chunk, desc_chunk, options, messages)
+
+            if columns is None:
+                # the populated column set depends only on the options, so it is fixed by the first chunk
+                columns = reduced_cols(template_df.columns.tolist(), template_out) if reduced else template_out.columns.tolist()
+                ws.append([xlsx_cell(c, header=True) for c in columns])
+            chunk_export = template_out.reindex(columns=columns)
+
+            chunk_export.to_csv(csv_file, index=False, header=(rows == 0))
+            for values in chunk_export.itertuples(index=False, name=None):
+                ws.append([xlsx_cell(v) for v in values])
+
+            if rows < 10:
+                preview = pd.concat([preview, chunk_export.head(10 - rows)], ignore_index=True)
+            rows += len(chunk_export)
+            if progress is not None:
+                progress("rows", rows, None)
+
+        if columns is None:  # no URN rows at all: header-only output
+            template_out, messages = populate_template(template_df, pd.DataFrame(columns=["FILE-URN", "OBJ-OSN"]), desc_empty, options, messages)
+            columns = reduced_cols(template_df.columns.tolist(), template_out) if reduced else template_out.columns.tolist()
+            ws.append([xlsx_cell(c, header=True) for c in columns])
+            preview = template_out.reindex(columns=columns)
+            preview.to_csv(csv_file, index=False)
+
+    wb.save(xlsx_path)
+    UPLOAD_ROWS.observe(rows, input="urns")
+    for fmt, path in (("csv", csv_path), ("xlsx", xlsx_path)):
+        EXPORT_BYTES.inc(os.path.getsize(path), format=fmt)
+    return {"csv_path": csv_path, "xlsx_path": xlsx_path, "rows": rows, "preview": preview, "messages": messages}
+
+
+# --- parallel ingestion ---
+# the URNs and Descriptive Metadata workbooks - and, optionally, every sheet of the metadata workbook - are
+# parsed in separate worker processes, so the wall time is about that of the largest sheet
+SOURCE_SHEET_COL = "Source Sheet"
+
+
+def _source_bytes(source):
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return f.read()
+    source.seek(0)
+    return source.read()
+
+
+def _read_sheet(args):
+    # worker-process entry point: (workbook bytes, sheet name or index) -> shared_frame() result, so a sheet is
+    # parsed once per workbook content and comes back as a file path instead of a pickled frame
+    data, sheet = args
+    key = f"sheet|{hashlib.sha1(data).hexdigest()}|{sheet}"
+    return shared_frame(key, lambda: pd.read_excel(io.BytesIO(data), sheet_name=sheet))
+
+
+def sheet_names(source):
+    from openpyxl import load_workbook
+
+    if hasattr(source, "seek"):
+        source.seek(0)
+    wb = load_workbook(source, read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def read_inputs(urns_source=None, desc_source=None, all_desc_sheets=False, workers=None):
+    """Parse the URNs and Descriptive Metadata workbooks concurrently; returns (urns_df, desc_df), None for a
+    source not given. With all_desc_sheets every sheet of the metadata workbook is parsed in parallel and the
+    non-empty sheets are concatenated in workbook order, SOURCE_SHEET_COL naming the sheet each row came from."""
+    tasks = []
+    if urns_source is not None:
+        tasks.append((_source_bytes(urns_source), 0))
+    desc_sheets = []
+    if desc_source is not None:
+        desc_bytes = _source_bytes(desc_source)
+        desc_sheets = sheet_names(io.BytesIO(desc_bytes)) if all_desc_sheets else [0]
+        tasks += [(desc_bytes, sheet) for sheet in desc_sheets]
+
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            frames = [open_shared_frame(shared) for shared in pool.map(_read_sheet, tasks)]
+    else:
+        frames = [open_shared_frame(_read_sheet(task)) for task in tasks]
+
+    urns_df = frames.pop(0) if urns_source is not None else None
+    if urns_df is not None:
+        UPLOAD_ROWS.observe(len(urns_df), input="urns")
+    for frame in frames:
+        UPLOAD_ROWS.observe(len(frame), input="desc")
+    if desc_source is None:
+        return urns_df, None
+    if not all_desc_sheets:
+        return urns_df, frames[0]
+
+    sheets = [(sheet, frame) for sheet, frame in zip(desc_sheets, frames) if len(frame.columns)]
+    if not sheets:
+        return urns_df, pd.DataFrame(columns=[SOURCE_SHEET_COL])
+    desc_df = pd.concat([frame for _, frame in sheets], ignore_index=True)
+    desc_df[SOURCE_SHEET_COL] = np.repeat([sheet for sheet, _ in sheets], [len(frame) for _, frame in sheets])
+    return urns_df, desc_df
+
+
+# --- column mapping suggestions ---
+# a bounded head sample of each sheet is scored per column: key overlap between URNs and Descriptive Metadata
+# columns from hashed (k-minimum-values) sketches, year-like values for dates, text length / cardinality for
+# title, note and country; a matching header word adds a bonus to columns whose data fits the role. Population is
+# positional, so the first rows of both sheets describe the same objects and their keys overlap
+SUGGEST_SAMPLE_ROWS = 2000
+SKETCH_SIZE = 256
+MIN_KEY_OVERLAP = 0.3
+MAPPING_HINTS = {
+    "title": {"title", "name"},
+    "start_date": {"start", "begin", "from", "earliest", "date"},
+    "end_date": {"end", "to", "until", "latest"},
+    "note": {"note", "notes", "description", "comment", "comments"},
+    "country": {"country", "countries", "nation"},
+}
+
+
+def sample_rows(source, rows=SUGGEST_SAMPLE_ROWS):
+    # first rows of a DataFrame or of the first sheet of an upload (read-only parse, stops after rows)
+    if isinstance(source, pd.DataFrame):
+        return source.head(rows)
+    return next(iter_sheet_chunks(source, rows), pd.DataFrame(columns=read_header(source)))
+
+
+def _sample_values(series):
+    values = series.dropna().astype(str).str.strip()
+    return values[values != ""]
+
+
+def key_sketch(series, k=SKETCH_SIZE):
+    # the k smallest 64-bit hashes of the distinct values: a uniform sample of the value set
+    hashes = np.unique(pd.util.hash_array(_sample_values(series).to_numpy(dtype=object)))
+    return hashes[:k]
+
+
+def sketch_similarity(a, b, k=SKETCH_SIZE):
+    # Jaccard estimate: share of the k smallest hashes of the union that are in both sketches
+    union = np.union1d(a, b)[:k]
+    if not len(union):
+        return 0.0
+    return float(np.isin(union, a).sum() + np.isin(union, b).sum() - len(union)) / len(union)
+
+
+def _header_words(col):
+    return set(re.findall(r"[a-z]+", str(col).lower()))
+
+
+def _column_profile(series):
+    values = _sample_values(series)
+    n = len(values)
+    if not n:
+        return None
+    dates = parse_dates(values)
+    year_like = dates["earliest"].between(1000, 2100) & (dates["flag"] != "unrecognized format")
+    return {
+        "filled": n / max(len(series), 1),
+        "distinct": values.nunique() / n,
+        "years": float(year_like.mean()),
+        "median_year": float(dates["earliest"][year_like].median()) if year_like.any() else None,
+        "alpha": float(values.str.contains(r"[^\W\d_]", regex=True).mean()),
+        "length": float(values.str.len().mean()),
+        "words": float(values.str.split().str.len().mean()),
+        "values": values.nunique(),
+    }
+
+
+def suggest_mapping(urns_sample, desc_sample):
+    """Suggest the match fields and the Descriptive Metadata columns from row samples. Returns a dict with
+    urns_key_col, desc_key_col, desc_title_col, desc_start_date_col, desc_end_date_col, desc_note_col and
+    artstor_country_col; None where no column scores well enough."""
+    suggestion = dict.fromkeys(["urns_key_col", "desc_key_col", "desc_title_col", "desc_start_date_col",
+                                "desc_end_date_col", "desc_note_col", "artstor_country_col"])
+
+    # match fields: the most similar pair of mostly-distinct columns
+    desc_sketches = {c: key_sketch(desc_sample[c]) for c in desc_sample.columns}
+    best = MIN_KEY_OVERLAP
+    for u in urns_sample.columns:
+        u_sketch = key_sketch(urns_sample[u])
+        for d, d_sketch in desc_sketches.items():
+            score = sketch_similarity(u_sketch, d_sketch)
+            if score > best:
+                best, suggestion["urns_key_col"], suggestion["desc_key_col"] = score, u, d
+
+    profiles = {c: p for c in desc_sample.columns
+                if c != suggestion["desc_key_col"] and (p := _column_profile(desc_sample[c])) is not None}
+    hint = {c: {role for role, words in MAPPING_HINTS.items() if words & _header_words(c)} for c in profiles}
+
+    def pick(role, score, minimum=0.5):
+        # data score, plus a bonus for a matching header word when the data fits at all
+        taken = set(suggestion.values())
+        scored = [(s + 0.5 * (role in hint[c]) if s > 0 else 0, c)
+                  for c, p in profiles.items() if c not in taken for s in [score(p)]]
+        scored = [(s, c) for s, c in scored if s >= minimum]
+        # highest score, first column on ties
+        return max(scored, key=lambda sc: (sc[0], -list(profiles).index(sc[1])))[1] if scored else None
+
+    # dates: the two most year-like columns, the earlier values being the start
+    start = pick("start_date", lambda p: p["years"])
+    if start is not None:
+        suggestion["desc_start_date_col"] = start
+        end = pick("end_date", lambda p: p["years"])
+        if end is not None and (profiles[end]["median_year"] or 0) < (profiles[start]["median_year"] or 0):
+            start, end = end, start
+        if end is not None and "start_date" in hint[end] and "end_date" in hint[start]:
+            start, end = end, start
+        suggestion["desc_start_date_col"], suggestion["desc_end_date_col"] = start, end or start
+
+    # title: mostly distinct short text; note: the longest text; country: short text from a small vocabulary
+    def text(p):
+        return p["alpha"] * (p["years"] < 0.5)
+
+    suggestion["desc_title_col"] = pick("title", lambda p: text(p) * p["distinct"] * (1 <= p["words"] <= 30))
+    suggestion["desc_note_col"] = pick("note", lambda p: text(p) * min(p["length"] / 40, 1) * (p["distinct"] > 0.2))
+    suggestion["artstor_country_col"] = pick(
+        "country", lambda p: text(p) * (1 - p["distinct"]) * (p["length"] < 40) * (p["values"] <= 300))
+    return suggestion
+
+
+# --- paged preview of the full output ---
+# only one page of rows leaves the server: an in-memory result is sliced (iloc - the frame is not copied),
+# a streamed CSV result is read up to the page; searches return row positions, which are kept with the
+# result so paging through the matches only takes those rows
+PREVIEW_PAGE_ROWS = 50
+PREVIEW_MATCHES = ["contains", "equals", "is blank"]
+PREVIEW_CHUNK_ROWS = 50000
+
+
+def _output_chunks(source, columns=None, chunk_rows=PREVIEW_CHUNK_ROWS, raw_text=False):
+    # (position of the first row, chunk) over a DataFrame or a CSV file; raw_text keeps CSV cells as the text
+    # written (no "nan" / "NA" -> NaN conversion, blank cells are "")
+    if isinstance(source, pd.DataFrame):
+        for first in range(0, len(source), chunk_rows):
+            chunk = source.iloc[first:first + chunk_rows]
+            yield first, chunk if columns is None else chunk[columns]
+        return
+    first = 0
+    text_kwargs = {"dtype": str, "keep_default_na": False} if raw_text else {}
+    for chunk in pd.read_csv(source, chunksize=chunk_rows, usecols=columns, **text_kwargs):
+        yield first, chunk
+        first += len(chunk)
+
+
+def match_rows(source, query="", column=None, how="contains", columns=None, chunk_rows=PREVIEW_CHUNK_ROWS):
+    """Positions of the output rows (DataFrame or CSV path) whose column - or any of columns, all when None -
+    contains / equals query (case-insensitive) or is blank."""
+    query = str(query).strip().lower()
+    positions = []
+    for first, chunk in _output_chunks(source, [column] if column is not None else columns, chunk_rows):
+        hit = np.zeros(len(chunk), dtype=bool)
+        for col in chunk.columns:
+            text = chunk[col].fillna("").astype(str).str.strip()
+            if how == "is blank":
+                hit |= (text == "").to_numpy(dtype=bool)
+            elif how == "equals":
+                hit |= (text.str.lower() == query).to_numpy(dtype=bool)
+            else:
+                hit |= text.str.lower().str.contains(query, regex=False).to_numpy(dtype=bool)
+        positions.append(np.flatnonzero(hit) + first)
+    return np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+
+
+def output_page(source, page, page_rows=PREVIEW_PAGE_ROWS, positions=None, columns=None,
+                chunk_rows=PREVIEW_CHUNK_ROWS):
+    """Page `page` (0-based) of the output rows - or of the rows at positions, from match_rows - with 1-based
+    row numbers as the index."""
+    start = page * page_rows
+    wanted = np.arange(start, start + page_rows) if positions is None else positions[start:start + page_rows]
+    if isinstance(source, pd.DataFrame):
+        window = source.iloc[start:start + page_rows] if positions is None else source.take(wanted)
+        window = window if columns is None else window[columns]
+    elif positions is None:
+        window = pd.read_csv(source, skiprows=range(1, start + 1), nrows=page_rows, usecols=columns)
+    else:
+        parts = []
+        for first, chunk in _output_chunks(source, columns, chunk_rows):
+            inside = wanted[(wanted >= first) & (wanted < first + len(chunk))]
+            parts.append(chunk.iloc[inside - first])
+            if not len(wanted) or first + len(chunk) > wanted[-1]:
+                break  # the rest of the file is not needed
+        window = pd.concat(parts) if parts else pd.read_csv(source, nrows=0, usecols=columns)
+    if columns is not None:
+        window = window[columns]
+    return window.set_axis(wanted[:len(window)] + 1)
+
+
+# --- row-level QA over the populated output ---
+# one vectorized pass over the output (in chunks, so a streamed CSV result works too) gives a rows x rules
+# issue matrix (True = the row has that issue) and the issue list behind it; the text rules are evaluated
+# once per distinct value of a column, not once per cell
+QA_RULES = {
+    "Inverted dates": "Start Date later than End Date in the Descriptive Metadata (Start Date was used)",
+    "Blank title": "Title is empty, or only the fixed text of the title format",
+    "Literal nan": 'a cell is just the text "nan" / "None" - a missing value that was turned into text',
+    "Malformed OSN": "Repository Classification Number is blank or not letters / digits joined by _ . -",
+    "Duplicate Filename": "the same Filename is on more than one row",
+}
+QA_ISSUE_COLS = ["Row", "Issue", "Column", "Value"]
+# the columns the stages fill with input text (astype(str) turns a missing value into "nan" there)
+QA_TEXT_COLS = ["Filename", "Title[34338]", "Description[34357]", "Artstor Country[34356]"]
+QA_OSN_COL = "Repository Classification Number[34364]"
+OSN_PATTERN = r"[A-Z0-9]+(?:[._-][A-Z0-9]+)*"  # and at least one digit
+NAN_TEXT_VALUES = ["nan", "NaN", "None"]
+
+
+def _per_value(series, test, missing):
+    # test (vectorized str methods) over the distinct values only; missing = result for NaN / None cells
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    hits = np.append(test(pd.Series(uniques, dtype=str)).to_numpy(dtype=bool), missing)  # code -1 -> last entry
+    return hits[codes]
+
+
+def _cell_text(series):
+    # cells as shown in Excel: whole-number floats (a numeric column with blanks) without ".0", blanks empty
+    if series.dtype.kind == "f" and (series.dropna() % 1 == 0).all():
+        series = series.astype("Int64")
+    return series.astype(str).where(series.notna(), "")
+
+
+def _inverted_dates(desc_df, start_col, end_col):
+    # same comparison as the date stage, which resolves these rows (and so hides them in the output)
+    start, end = parse_dates(desc_df[start_col]), parse_dates(desc_df[end_col])
+    inverted = (start["earliest"] > end["latest"].fillna(start["latest"])).to_numpy()
+    values = _cell_text(desc_df[start_col]) + " / " + _cell_text(desc_df[end_col])
+    return inverted, values.to_numpy(dtype=object)
+
+
+def qa_report(source, options=None, desc_df=None, chunk_rows=PREVIEW_CHUNK_ROWS):
+    """QA of a populated template (DataFrame or streamed CSV path). options (the populate options) give the
+    title format and the date columns; desc_df, aligned with the output rows, adds the inverted date ranges.
+    Returns (matrix, issues): a boolean DataFrame with one column per QA_RULES entry and one row per output row,
+    and the issue list (QA_ISSUE_COLS, Row 1-based) with the column and value behind every issue."""
+    opt = (options or {}).get
+    header = source.columns if isinstance(source, pd.DataFrame) else pd.read_csv(source, nrows=0).columns
+    qa_cols = [c for c in QA_TEXT_COLS + [QA_OSN_COL] if c in header]
+
+    fixed_title = ""
+    if opt("metadata_type") is not None and opt("cataloging_type") is not None:
+        rule = match_rule(mapping_rules()["title"], opt)
+        fixed_title = "".join(rule).strip() if rule is not None else ""
+    start_col, end_col = opt("desc_start_date_col"), opt("desc_end_date_col")
+    inverted = None
+    if desc_df is not None and start_col in desc_df.columns and end_col in desc_df.columns:
+        inverted, date_values = _inverted_dates(desc_df, start_col, end_col)
+
+    flags = {rule: [] for rule in QA_RULES}
+    issues = []  # one (Row, Issue, Column, Value) frame per rule / column with hits
+    filenames = []
+
+    def found(rows, issue, col, values):
+        if len(rows):
+            issues.append(pd.DataFrame({"Row": rows + 1, "Issue": issue, "Column": col,
+                                        "Value": np.asarray(values, dtype=object)}, columns=QA_ISSUE_COLS))
+
+    for first, chunk in _output_chunks(source, qa_cols, chunk_rows, raw_text=True):
+        rows = np.arange(first, first + len(chunk))
+        hits = {rule: np.zeros(len(chunk), dtype=bool) for rule in QA_RULES}
+
+        if inverted is not None:  # output rows past the end of desc_df have nothing to compare
+            inside = inverted[first:first + len(chunk)]
+            hits["Inverted dates"][:len(inside)] = inside
+            found(rows[:len(inside)][inside], "Inverted dates", f"{start_col} / {end_col}",
+                  date_values[first:first + len(chunk)][inside])
+
+        if "Title[34338]" in chunk.columns:
+            title = chunk["Title[34338]"]
+            hits["Blank title"] = _per_value(title, lambda v: v.str.strip().isin(["", fixed_title]), True)
+            found(rows[hits["Blank title"]], "Blank title", "Title[34338]", title.to_numpy()[hits["Blank title"]])
+
+        for col in [c for c in QA_TEXT_COLS if c in chunk.columns]:
+            hit = _per_value(chunk[col], lambda v: v.str.strip().isin(NAN_TEXT_VALUES), False)
+            if hit.any():
+                hits["Literal nan"] |= hit
+                found(rows[hit], "Literal nan", col, chunk[col].to_numpy()[hit])
+
+        if QA_OSN_COL in chunk.columns:
+            osn = chunk[QA_OSN_COL]
+            hits["Malformed OSN"] = _per_value(osn, lambda v: ~(v.str.fullmatch(OSN_PATTERN) & v.str.contains(r"\d")),
+                                               True)
+            found(rows[hits["Malformed OSN"]], "Malformed OSN", QA_OSN_COL, osn.to_numpy()[hits["Malformed OSN"]])
+
+        if "Filename" in chunk.columns:
+            filenames.append(chunk["Filename"].fillna("").astype(str).str.strip().to_numpy(dtype=object))
+        for rule, hit in hits.items():
+            flags[rule].append(hit)
+
+    matrix = pd.DataFrame({rule: np.concatenate(hits) if hits else np.zeros(0, dtype=bool)
+                           for rule, hits in flags.items()})
+    if filenames:  # duplicates are looked for across all chunks
+        names = pd.Series(np.concatenate(filenames))
+        matrix["Duplicate Filename"] = (names.duplicated(keep=False) & (names != "")).to_numpy()
+        dup_rows = np.flatnonzero(matrix["Duplicate Filename"].to_numpy())
+        found(dup_rows, "Duplicate Filename", "Filename", names.to_numpy()[dup_rows])
+
+    issue_list = pd.concat(issues, ignore_index=True) if issues else pd.DataFrame(columns=QA_ISSUE_COLS)
+    rule_order = issue_list["Issue"].map({rule: i for i, rule in enumerate(QA_RULES)})
+    issue_list = issue_list.iloc[np.lexsort((rule_order.to_numpy(), issue_list["Row"].to_numpy()))]
+    return matrix, issue_list.reset_index(drop=True)
+
+
+def qa_summary(matrix):
+    # rows per QA rule, with what the rule checks
+    return pd.DataFrame({"Issue": list(QA_RULES), "Rows": [int(matrix[rule].sum()) for rule in QA_RULES],
+                         "Check": list(QA_RULES.values())})
+
+
+# --- shared read-only frames (Arrow IPC, memory-mapped) ---
+# a parsed frame is written once as an uncompressed Arrow IPC (Feather v2) file and memory-mapped by every
+# process that needs it: text and numeric columns stay backed by the file's pages, which the OS shares
+# between all workers instead of each one unpickling or re-parsing its own copy. Object columns holding
+# several cell types (e.g. years as int + ranges as str) are stored as text + the type of every cell and
+# rebuilt in each process
+SHARED_FRAMES_DIR = os.environ.get("JDMP_SHARED_FRAMES_DIR", os.path.join(tempfile.gettempdir(), "jdmp_shared"))
+SHARED_FRAMES_TTL_HOURS = float(os.environ.get("JDMP_SHARED_FRAMES_TTL_HOURS", "24"))
+_CELL_TYPES = {"int": "int64", "float": "float64", "bool": "bool"}
+# Excel date / time cells of a mixed column, rebuilt one by one from their text; any other type comes back as text
+_CELL_PARSERS = {"datetime": datetime.datetime.fromisoformat, "Timestamp": pd.Timestamp,
+                 "date": datetime.date.fromisoformat, "time": datetime.time.fromisoformat}
+
+
+def frame_to_arrow(df):
+    """pyarrow Table of df (str column labels); the original column order / dtypes are kept in its metadata."""
+    import pyarrow as pa
+
+    columns, mixed = {}, []
+    for col in df.columns:
+        values = df[col]
+        try:
+            columns[col] = pa.array(values, from_pandas=True)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            present = values.notna()
+            columns[col] = pa.array(values.astype(str).where(present, None), type=pa.string())
+            columns[f"{col}::type"] = pa.array(values.map(lambda v: type(v).__name__).where(present, None),
+                                               type=pa.string()).dictionary_encode()
+            mixed.append(col)
+    meta = {"columns": list(df.columns), "mixed": mixed, "object": [c for c in df.columns if df[c].dtype == object]}
+    return pa.table(columns).replace_schema_metadata({"jdmp": json.dumps(meta)})
+
+
+def frame_from_arrow(table, restore_object=True):
+    """DataFrame of a frame_to_arrow table. restore_object=False leaves all-text object columns as (Arrow
+    backed) str columns - no copy out of a memory-mapped file; all-blank object columns are object either way."""
+    import pyarrow as pa
+
+    meta = json.loads(table.schema.metadata[b"jdmp"])
+    df = table.to_pandas()
+    for col in meta["mixed"]:
+        text, types = df[col], df.pop(f"{col}::type")
+        values = text.to_numpy(dtype=object, na_value=np.nan)
+        for name, dtype in _CELL_TYPES.items():
+            cells = (types == name).to_numpy()
+            if cells.any():
+                typed = text[cells] == "True" if dtype == "bool" else text[cells].astype(dtype)
+                values[cells] = typed.to_numpy().astype(object)  # Python int / float / bool, as they were
+        for name, parse in _CELL_PARSERS.items():
+            cells = (types == name).to_numpy()
+            if cells.any():
+                values[cells] = [parse(v) for v in values[cells]]
+        df[col] = values
+    for col in meta["object"]:
+        if restore_object or pa.types.is_null(table.schema.field(col).type):
+            df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+    return df[meta["columns"]]
+
+
+def write_shared_frame(df, path):
+    import pyarrow as pa
+
+    table = frame_to_arrow(df)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def open_shared_frame(shared):
+    # a shared_frame() result as a DataFrame; memory-mapped, so the columns are views of the file's pages
+    import pyarrow as pa
+
+    if isinstance(shared, pd.DataFrame):
+        return shared
+    return frame_from_arrow(pa.ipc.open_file(pa.memory_map(shared)).read_all(), restore_object=False)
+
+
+def _purge_shared_frames(cutoff):
+    for name in os.listdir(SHARED_FRAMES_DIR):
+        path = os.path.join(SHARED_FRAMES_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)  # processes that mapped it keep their mapping
+        except OSError:
+            pass
+
+
+def shared_path(key):
+    return os.path.join(SHARED_FRAMES_DIR, hashlib.sha1(key.encode()).hexdigest() + ".arrow")
+
+
+def shared_frame(key, build):
+    """Path of the shared file for key (e.g. a content hash), written from build() unless it exists - or the
+    built DataFrame itself when it cannot be shared (non-str column labels, read-only filesystem). Either way
+    open_shared_frame() gives the frame; a path is cheap to hand to another process."""
+    path = shared_path(key)
+    CACHE_REQUESTS.inc(cache="shared frames")
+    try:
+        os.utime(path)  # in use: not purged
+        return path
+    except OSError:
+        pass  # not written yet (or just purged)
+    CACHE_MISSES.inc(cache="shared frames")
+    df = build()
+    if not all(isinstance(c, str) for c in df.columns):
+        return df
+    try:
+        os.makedirs(SHARED_FRAMES_DIR, mode=0o700, exist_ok=True)
+        _purge_shared_frames(time.time() - SHARED_FRAMES_TTL_HOURS * 3600)
+        write_shared_frame(df, path)
+    except OSError:
+        return df
+    return path
@@ -0,0 +1,277 @@
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from jdmp_core import (STANDARD_RIGHTS_TEXT, clean_urns, crediting_note, export_csv, export_xlsx, mapping_rules,
+                       populate_template, read_crediting_table, read_inputs, reduce_columns, reference_table,
+                       stream_populate)
+
+# --- golden-output regression + performance check for the population pipeline ---
+# python jdmp_golden.py [--repeat 3] [--scale 1] [--streaming] [--history golden_history.jsonl] [--update]
+# every metadata x cataloging x geographic type combination of the mapping rules is run on fixed synthetic
+# inputs (date fallbacks and flagged dates, title prefixes, OSN underscore removal, blank notes / countries),
+# with an entered creator and - in the VARIANTS cases - without one, in the Full and the Reduced Version,
+# the way the API runs a batch: read_inputs -> clean_urns -> populate_template -> reduce_columns -> export.
+# The output is compared cell for cell (as exported text) with the golden files in golden/:
+#   <case>.csv       the populated template with all columns
+#   manifest.json    per case: messages, Reduced Version columns and the cell types of every column (what
+#                    the Excel export writes as numbers / booleans / text); plus the hash of the inputs
+# --scale N repeats the inputs N times (the output must be the golden output repeated N times) to time
+# larger batches; --streaming also checks stream_populate's output against the same files. The populate /
+# export medians of every case are printed next to those of the last --history run at the same scale;
+# --update rewrites the golden files after an intended output change. Exits 1 when any case differs.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(APP_DIR, "golden")
+DEFAULT_TEMPLATE_PATH = os.path.join(APP_DIR, "SharedShelf Template.xlsx")
+DEFAULT_CREDITING_PATH = os.path.join(APP_DIR, "Notes-Crediting - Translation Table - Column DB.xlsx")
+CREDIT_SOURCE = "231 Lowe"
+STREAM_CHUNK_ROWS = 7  # small, so chunk boundaries fall inside the inputs
+
+# synthetic inputs: row i takes value i % len(...) of every list, the lengths chosen so the combinations vary
+OSNS = ["jud_00123", "JUD_00124_A", "jud00125", "Jud_00_126", "42"]
+TITLES = ["Poster for Independence Day", "  Leading and trailing spaces  ", "", "כרזה לחג העצמאות",
+          "Title with nan inside", "Ephemera, 1948 (copy 2)", "[Untitled]"]
+DATES = [  # (start, end)
+    (1948, 1950), (1950, 1948), (None, 1967), (None, None), (1973, None), (1960, 1960), ("ca. 1948", None),
+    ("1948-50", None), ("195-?", "195-?"), ("19--", None), ("1948 or 1949", ""), ("undated", "undated"),
+    ("[1936?]", 1939), (pd.Timestamp("1956-10-29"), 1957),
+]
+# case name suffix -> options changed from case_options: a blank creator leaves the Creator column to the
+# mapping rules (blanked for every metadata type in the Full Version, except Posters / Ephemera when reduced)
+VARIANTS = {"": {}, "blank_creator": {"template_creator": ""},
+            "reduced_version": {"template_creator": "", "reduced_version": True}}
+NOTES = ["Printed in Tel Aviv.", "", "  Hebrew and English.  ", None, "Gift of the artist; nan"]
+COUNTRIES = ["Israel", "United States", "", "  Poland ", None, "Argentina"]
+
+
+def synthetic_inputs(scale=1):
+    """(urns_df, desc_df): the fixed inputs, repeated scale times."""
+    rows = len(DATES) * len(NOTES)  # 70
+    urns = pd.DataFrame({
+        "FILE-URN": [f"URN-3:HUL.JUD:{400000 + i}" for i in range(rows)],
+        "OBJ-OSN": [OSNS[i % len(OSNS)] for i in range(rows)],
+        "FILE-OSN": [f"{OSNS[i % len(OSNS)]}_{i:04d}" for i in range(rows)],
+    })
+    desc = pd.DataFrame({
+        "FILE-OSN": urns["FILE-OSN"],
+        "Title": [TITLES[i % len(TITLES)] for i in range(rows)],
+        "Start": [DATES[i % len(DATES)][0] for i in range(rows)],
+        "End": [DATES[i % len(DATES)][1] for i in range(rows)],
+        "Note": [NOTES[i % len(NOTES)] for i in range(rows)],
+        "Country": [COUNTRIES[i % len(COUNTRIES)] for i in range(rows)],
+    })
+    return (pd.concat([urns] * scale, ignore_index=True), pd.concat([desc] * scale, ignore_index=True))
+
+
+def inputs_hash(urns_df, desc_df):
+    digest = hashlib.sha256()
+    for df in (urns_df, desc_df):
+        digest.update(df.to_csv(index=False).encode())
+    return digest.hexdigest()
+
+
+def cases():
+    choices = mapping_rules()["choices"]
+    return list(itertools.product(choices["metadata_type"], choices["cataloging_type"], choices["geographic_type"],
+                                  VARIANTS))
+
+
+def case_name(metadata_type, cataloging_type, geographic_type, variant=""):
+    return "-".join(t.lower().replace(" ", "_") for t in (metadata_type, cataloging_type, geographic_type, variant)
+                    if t)
+
+
+def case_options(metadata_type, cataloging_type, geographic_type, variant, crediting_df):
+    world_judaica = geographic_type == "World Judaica"
+    return {
+        "metadata_type": metadata_type, "cataloging_type": cataloging_type, "geographic_type": geographic_type,
+        "artstor_country_col": "Country" if world_judaica else "",
+        "desc_title_col": "Title", "desc_start_date_col": "Start", "desc_end_date_col": "End",
+        "desc_source_type": "Descriptive Metadata Column", "desc_note_col": "Note", "desc_source_text": "",
+        "template_creator": "Golden Creator", "template_subject": "",
+        "template_rights_type": "STANDARD", "template_rights_text": STANDARD_RIGHTS_TEXT,
+        "template_credit_type": CREDIT_SOURCE, "template_credit_text": crediting_note(crediting_df, CREDIT_SOURCE),
+        **VARIANTS[variant],
+    }
+
+
+def cell_types(df):
+    # Python type names per column, as the Excel export sees the cells (blank cells left out)
+    return {col: sorted({type(v).__name__ for v in df[col].tolist() if not pd.isna(v)}) for col in df.columns}
+
+
+def as_text(source):
+    # exported CSV (bytes or path) -> all-text frame, exactly as written
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return pd.read_csv(source, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+
+
+def differences(actual, expected, limit=5):
+    """Human-readable differences between two all-text frames (empty list when equal)."""
+    if list(actual.columns) != list(expected.columns):
+        missing = [c for c in expected.columns if c not in actual.columns]
+        extra = [c for c in actual.columns if c not in expected.columns]
+        return [f"columns differ (missing {missing}, extra {extra})" if missing or extra else "column order differs"]
+    if len(actual) != len(expected):
+        return [f"{len(actual)} rows instead of {len(expected)}"]
+    diff = actual.to_numpy() != expected.to_numpy()
+    rows, cols = diff.nonzero()
+    found = [f"{diff.sum()} cells differ"] if len(rows) else []
+    for r, c in list(zip(rows, cols))[:limit]:
+        found.append(f"  row {r + 1}, {actual.columns[c]}: {expected.iat[r, c]!r} -> {actual.iat[r, c]!r}")
+    return found
+
+
+def median(samples):
+    return round(statistics.median(samples), 4)
+
+
+def run_case(template_df, urns_path, desc_path, options, repeat):
+    # the API's in-memory path; returns (full output, reduced output, messages, csv bytes, timings)
+    populate_s, export_s = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        urns_df, desc_df = read_inputs(urns_path, desc_path, workers=1)
+        template_out, messages = populate_template(template_df, clean_urns(urns_df), desc_df, options)
+        reduced = reduce_columns(template_out, template_df.columns.tolist())
+        populate_s.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        csv_data = export_csv(template_out)
+        export_csv(reduced)
+        export_xlsx(reduced)
+        export_s.append(time.perf_counter() - start)
+    return template_out, reduced, messages, csv_data, {"populate_s": median(populate_s), "export_s": median(export_s)}
+
+
+def check_case(name, golden, full_text, reduced_cols, messages, types, scale):
+    # differences of one run against the case's golden files
+    found = differences(full_text, pd.concat([as_text(os.path.join(GOLDEN_DIR, f"{name}.csv"))] * scale,
+                                             ignore_index=True))
+    if reduced_cols != golden["reduced_columns"]:
+        found.append(f"Reduced Version columns differ: {reduced_cols} instead of {golden['reduced_columns']}")
+    if messages != golden["messages"]:
+        found.append(f"messages differ: {messages} instead of {golden['messages']}")
+    if types is not None and types != golden["cell_types"]:
+        changed = [c for c in golden["cell_types"] if types.get(c) != golden["cell_types"][c]]
+        found.append(f"cell types differ in {changed}")
+    return found
+
+
+def last_history(path, scale):
+    # {case: timings} of the previous run at the same scale in the history file
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    runs = [run for run in runs if run["scale"] == scale]
+    return {r["case"]: r for r in runs[-1]["results"]} if runs else {}
+
+
+def ratio(now, before):
+    return f"{before / now:.2f}x" if before and now else ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Golden-output regression + performance check for the JDMP pipeline")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--scale", type=int, default=1, help="repeat the synthetic inputs this many times")
+    parser.add_argument("--streaming", action="store_true", help="also check stream_populate's output")
+    parser.add_argument("--history", help="append the timings as one JSON line to this file")
+    parser.add_argument("--update", action="store_true", help="rewrite the golden files from this run")
+    args = parser.parse_args()
+    if args.update and args.scale != 1:
+        parser.error("--update writes the golden files from unscaled inputs; leave out --scale")
+
+    template_df = reference_table(DEFAULT_TEMPLATE_PATH).head(0)
+    crediting_df = reference_table(DEFAULT_CREDITING_PATH, read_crediting_table)
+    urns_df, desc_df = synthetic_inputs(args.scale)
+    input_hash = inputs_hash(*synthetic_inputs())
+
+    manifest_path = os.path.join(GOLDEN_DIR, "manifest.json")
+    if args.update:
+        manifest = {"inputs_sha256": input_hash, "rows": len(urns_df), "cases": {}}
+    else:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["inputs_sha256"] != input_hash:
+            raise SystemExit("the synthetic inputs changed since the golden files were written; "
+                             "rerun with --update if that was intended")
+
+    previous = last_history(args.history, args.scale)
+    results, failed = [], []
+    with tempfile.TemporaryDirectory(prefix="jdmp_golden_") as work_dir:
+        urns_path, desc_path = os.path.join(work_dir, "urns.xlsx"), os.path.join(work_dir, "desc.xlsx")
+        urns_df.to_excel(urns_path, index=False)
+        desc_df.to_excel(desc_path, index=False)
+
+        for case in cases():
+            name = case_name(*case)
+            options = case_options(*case, crediting_df)
+            template_out, reduced, messages, csv_data, timings = run_case(template_df, urns_path, desc_path,
+                                                                          options, args.repeat)
+            messages = [list(m) for m in messages]
+            full_text, reduced_cols, types = as_text(csv_data), reduced.columns.tolist(), cell_types(template_out)
+
+            if args.update:
+                os.makedirs(GOLDEN_DIR, exist_ok=True)
+                full_text.to_csv(os.path.join(GOLDEN_DIR, f"{name}.csv"), index=False)
+                manifest["cases"][name] = {"options": [t for t in case if t], "messages": messages,
+                                           "reduced_columns": reduced_cols, "cell_types": types}
+                found = []
+            elif name not in manifest["cases"]:
+                found = ["no golden files for this case; rerun with --update"]
+            else:
+                golden = manifest["cases"][name]
+                found = check_case(name, golden, full_text, reduced_cols, messages, types, args.scale)
+                if args.streaming:
+                    start = time.perf_counter()
+                    for reduced_run in (False, True):
+                        result = stream_populate(template_df, urns_path, desc_path, options,
+                                                 chunk_rows=STREAM_CHUNK_ROWS, reduced=reduced_run, out_dir=work_dir)
+                        stream_text = as_text(result["csv_path"])
+                        label = "streaming (reduced)" if reduced_run else "streaming"
+                        golden_text = full_text if not reduced_run else full_text[reduced_cols]
+                        found += [f"{label}: {d}" for d in differences(stream_text, golden_text)]
+                        stream_messages = [list(m) for m in result["messages"]]
+                        if stream_messages != golden["messages"]:
+                            found.append(f"{label}: messages differ: {stream_messages}")
+                    timings["streaming_s"] = round((time.perf_counter() - start) / 2, 4)
+
+            results.append({"case": name, "rows": len(template_out), "ok": not found, **timings})
+            if found:
+                failed.append(name)
+                print(f"DIFF {name}", *found, sep="\n  ", file=sys.stderr)
+
+    if args.update:
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+
+    print(f"{'case':<48} {'rows':>6} {'result':>6} {'populate s':>11} {'export s':>9} {'vs last':>8}")
+    for r in results:
+        before = previous.get(r["case"], {})
+        speedup = ratio(r["populate_s"] + r["export_s"], before.get("populate_s", 0) + before.get("export_s", 0))
+        print(f"{r['case']:<48} {r['rows']:>6} {'ok' if r['ok'] else 'DIFF':>6} {r['populate_s']:>11} "
+              f"{r['export_s']:>9} {speedup:>8}")
+    total = sum(r["populate_s"] + r["export_s"] for r in results)
+    print(f"{len(results)} cases, {len(failed)} differing, {total:.3f} s per pass (populate + export medians)")
+
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                                "pandas": pd.__version__, "scale": args.scale, "results": results}) + "\n")
+
+    if failed:
+        raise SystemExit(f"output differs from the golden files: {', '.join(failed)}")
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import pandas as pd
+
+from jdmp_core import frame_from_arrow, frame_to_arrow
+
+# --- batch history (no Streamlit calls in here) ---
+# every applied run is recorded as a small JSON manifest under HISTORY_DIR/batches: time, label, options,
+# mode, messages and the keys of its objects. Objects live once under HISTORY_DIR/objects, named by the
+# SHA-256 of their content, so an upload or reference table used by many batches is stored once:
+#   input uploads      the original Excel bytes (their keys are the batches' input hashes)
+#   reference tables   template / crediting table as Parquet
+#   output             the exported table as Parquet (zstd); reloading reads it back (memory-mapped)
+#                      without touching any Excel file
+# tables go through jdmp_core.frame_to_arrow, so object columns with mixed cell types (e.g. Date Description:
+# years as int, ranges as str) come back exactly as they were exported
+
+HISTORY_DIR = os.environ.get("JDMP_HISTORY_DIR", os.path.join(tempfile.gettempdir(), "jdmp_history"))
+HISTORY_ENABLED = os.environ.get("JDMP_HISTORY", "1") != "0"
+HISTORY_RETENTION_DAYS = float(os.environ.get("JDMP_HISTORY_RETENTION_DAYS", "180"))
+HISTORY_CHUNK_ROWS = 50000
+
+
+def _write_json(path, data):
+    # write + rename, so readers in other processes never see a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class BatchHistory:
+    """Content-addressed, deduplicated store of applied batches. Safe to share between processes."""
+
+    def __init__(self, root=HISTORY_DIR, retention_days=HISTORY_RETENTION_DAYS):
+        self.root = root
+        self.retention_days = retention_days
+        self.objects_dir = os.path.join(root, "objects")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+        self.purge()
+
+    def object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def _store(self, write):
+        # write(f) fills a temp file; it is kept under its SHA-256 unless that object exists already
+        tmp_path = os.path.join(self.objects_dir, f"{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            write(f)
+        digest = hashlib.sha256()
+        with open(tmp_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        key = digest.hexdigest()
+        path = self.object_path(key)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            os.utime(path)  # fresh again: collect_garbage() leaves it alone until a manifest refers to it
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return key
+
+    def put_bytes(self, data):
+        return self._store(lambda f: f.write(data))
+
+    def put_file(self, path):
+        def write(f):
+            with open(path, "rb") as src:
+                shutil.copyfileobj(src, f)
+
+        return self._store(write)
+
+    def put_table(self, source):
+        """Store a DataFrame - or a CSV file, read in chunks as written (text cells) - as Parquet; returns the key."""
+        import pyarrow.parquet as pq
+
+        def write(f):
+            if isinstance(source, pd.DataFrame):
+                pq.write_table(frame_to_arrow(source), f, compression="zstd")
+                return
+            writer = None
+            for chunk in pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=HISTORY_CHUNK_ROWS):
+                table = frame_to_arrow(chunk)
+                if writer is None:
+                    writer = pq.ParquetWriter(f, table.schema, compression="zstd")
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
+
+        return self._store(write)
+
+    def read_table(self, key):
+        import pyarrow.parquet as pq
+
+        return frame_from_arrow(pq.read_table(self.object_path(key), memory_map=True))
+
+    def read_bytes(self, key):
+        with open(self.object_path(key), "rb") as f:
+            return f.read()
+
+    def record(self, label, options, inputs, tables, output, messages=(), mode="", app="", files=None):
+        """Record one applied run and return its batch id.
+
+        inputs: {name: upload bytes}; tables: {name: reference DataFrame or None}; output: the exported
+        DataFrame, or the path of a streamed CSV; files: {format: path} of export files kept as they are
+        (streamed Excel output)."""
+        batch_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        output_key = self.put_table(output)
+        rows = len(output) if isinstance(output, pd.DataFrame) else None
+        manifest = {
+            "id": batch_id, "label": label, "time": time.time(), "app": app, "mode": mode, "options": options,
+            "inputs": {name: self.put_bytes(data) for name, data in inputs.items() if data is not None},
+            "tables": {name: self.put_table(df) for name, df in tables.items() if df is not None},
+            "output": output_key,
+            "files": {fmt: self.put_file(path) for fmt, path in (files or {}).items()},
+            "messages": [list(m) for m in messages],
+        }
+        if rows is None:
+            import pyarrow.parquet as pq
+
+            rows = pq.ParquetFile(self.object_path(output_key)).metadata.num_rows
+        manifest["rows"] = rows
+        _write_json(os.path.join(self.batches_dir, f"{batch_id}.json"), manifest)
+        return batch_id
+
+    def batch(self, batch_id):
+        with open(os.path.join(self.batches_dir, f"{batch_id}.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def list_batches(self):
+        # newest first
+        batches = []
+        for name in os.listdir(self.batches_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                batches.append(self.batch(name[:-5]))
+            except (OSError, ValueError):
+                continue  # being written or removed
+        return sorted(batches, key=lambda b: b["time"], reverse=True)
+
+    def load(self, batch_id):
+        """(manifest, output DataFrame) of a recorded batch - no Excel file is parsed."""
+        manifest = self.batch(batch_id)
+        return manifest, self.read_table(manifest["output"])
+
+    def _referenced(self):
+        keys = set()
+        for manifest in self.list_batches():
+            keys.update(manifest["inputs"].values(), manifest["tables"].values(), manifest["files"].values())
+            keys.add(manifest["output"])
+        return keys
+
+    def delete(self, batch_id):
+        os.remove(os.path.join(self.batches_dir, f"{batch_id}.json"))
+        self.collect_garbage()
+
+    def collect_garbage(self):
+        # drop the objects no batch refers to any more, and temp files of interrupted writes; objects written
+        # in the last hour are kept, as their batch (possibly in another process) may still be recording
+        referenced = self._referenced()
+        cutoff = time.time() - 3600
+        for dirpath, _, names in os.walk(self.objects_dir):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if name not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+
+    def purge(self):
+        # drop batches older than the retention period
+        cutoff = time.time() - self.retention_days * 86400
+        old = [b["id"] for b in self.list_batches() if b["time"] < cutoff]
+        for batch_id in old:
+            os.remove(os.path.join(self.batches_dir, f"{batch_id}.json"))
+        if old:
+            self.collect_garbage()
+
+    def stats(self):
+        # batches, stored objects and their size on disk
+        sizes = [os.path.getsize(os.path.join(d, n)) for d, _, names in os.walk(self.objects_dir)
+                 for n in names if not n.endswith(".tmp")]
+        return {"batches": len(os.listdir(self.batches_dir)), "objects": len(sizes), "bytes": sum(sizes)}
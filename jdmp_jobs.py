@@ -0,0 +1,274 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from jdmp_core import (DEFAULT_MEMORY_BUDGET_MB, MENTIONED_COLS, clean_urns, export_csv, export_xlsx, plan_execution,
+                       populate_template, read_columns, read_inputs, reduce_columns, stage_input_columns,
+                       stream_populate)
+
+# --- background population jobs (no Streamlit calls in here) ---
+# every job lives in its own directory under JOBS_DIR: the uploads, job.json (options, state, progress)
+# and the exported files, so results survive browser refreshes and can be downloaded from any session
+
+JOBS_DIR = os.environ.get("JDMP_JOBS_DIR", os.path.join(tempfile.gettempdir(), "jdmp_jobs"))
+JOB_WORKERS = int(os.environ.get("JDMP_JOB_WORKERS", "2"))
+# memory shared by all running jobs; a job is only started while its estimate fits next to the running ones
+JOB_MEMORY_MB = int(os.environ.get("JDMP_JOB_MEMORY_MB", str(2 * DEFAULT_MEMORY_BUDGET_MB)))
+MAX_QUEUED_JOBS = int(os.environ.get("JDMP_MAX_QUEUED_JOBS", "20"))
+JOB_RETENTION_HOURS = float(os.environ.get("JDMP_JOB_RETENTION_HOURS", "72"))
+# every JobQueue instance has a random id and keeps a heartbeat file under JOBS_DIR/.instances fresh; jobs
+# claimed by an instance whose heartbeat stopped are failed. (Not a pid check: in containers pids are reused
+# at once, so a restarted server could take its dead predecessor's pid and keep its orphans "running".)
+INSTANCE_TIMEOUT = 30
+
+JOB_OUTPUTS = {"xlsx": "JDMP_Populated_Template.xlsx", "csv": "JDMP_Populated_Template.csv"}
+
+
+def _write_json(path, data):
+    # write + rename, so readers in other processes never see a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_job(job_dir):
+    with open(os.path.join(job_dir, "job.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _update_job(job_dir, **fields):
+    job = read_job(job_dir)
+    job.update(fields)
+    _write_json(os.path.join(job_dir, "job.json"), job)
+    return job
+
+
+# --- worker side (runs in a pool process) ---
+def run_job(job_dir):
+    """Run one queued job: populate, export XLSX + CSV into job_dir and record progress in job.json."""
+    job = _update_job(job_dir, state="running", started=time.time(), stage="reading inputs", progress=0.0)
+    options, mode = job["options"], job["mode"]
+    urns_path = os.path.join(job_dir, "urns.xlsx")
+    desc_path = os.path.join(job_dir, "desc.xlsx")
+
+    def stage_progress(stage, done, total):
+        # reading inputs = 10%, population stages up to 60%, exports the rest
+        _update_job(job_dir, stage=stage, progress=round(0.1 + 0.5 * done / total, 3))
+
+    def row_progress(stage, done, total):
+        _update_job(job_dir, stage=f"{done:,} of ~{job['rows']:,} rows",
+                    progress=round(min(0.95, done / max(job["rows"], 1)), 3))
+
+    try:
+        with open(os.path.join(job_dir, "template.json"), encoding="utf-8") as f:
+            template_df = pd.DataFrame(columns=json.load(f))
+        if mode == "Streaming":
+            result = stream_populate(template_df, urns_path, desc_path, options, chunk_rows=job["chunk_rows"],
+                                     reduced=job["reduced"], out_dir=job_dir, progress=row_progress)
+            rows, messages = result["rows"], result["messages"]
+        else:
+            if mode == "Column-pruned":
+                urns_cols, desc_cols = stage_input_columns(options)
+                urns_df, desc_df = read_columns(urns_path, urns_cols), read_columns(desc_path, desc_cols)
+            else:
+                urns_df, desc_df = read_inputs(urns_path, desc_path, all_desc_sheets=job.get("all_desc_sheets", False))
+            urns_df = clean_urns(urns_df)
+
+            template_out, messages = populate_template(template_df, urns_df, desc_df, options,
+                                                       progress=stage_progress)
+            del urns_df, desc_df
+            if job["reduced"]:
+                _update_job(job_dir, stage="reducing columns", progress=0.6)
+                template_out = reduce_columns(template_out, template_df.columns.tolist())
+            rows = len(template_out)
+
+            _update_job(job_dir, stage="writing Excel", progress=0.65)
+            with open(os.path.join(job_dir, JOB_OUTPUTS["xlsx"]), "wb") as f:
+                f.write(export_xlsx(template_out))
+            _update_job(job_dir, stage="writing CSV", progress=0.95)
+            with open(os.path.join(job_dir, JOB_OUTPUTS["csv"]), "wb") as f:
+                f.write(export_csv(template_out))
+
+        _update_job(job_dir, state="done", finished=time.time(), stage="done", progress=1.0, rows=rows,
+                    messages=messages)
+    except Exception as e:
+        _update_job(job_dir, state="failed", finished=time.time(), error=f"{type(e).__name__}: {e}")
+    finally:
+        # the uploads are not needed once the job has finished
+        for name in ("urns.xlsx", "desc.xlsx", "template.json"):
+            if os.path.exists(os.path.join(job_dir, name)):
+                os.remove(os.path.join(job_dir, name))
+
+
+# --- server side: queue, admission control, scheduling ---
+class JobQueue:
+    """Process-pool job queue with memory-based admission control.
+
+    Jobs start in submission order. A job is admitted while the estimates of the running jobs plus its own
+    stay within memory_mb; otherwise it (and everything behind it) waits. A job whose estimate alone exceeds
+    memory_mb runs only when nothing else does. Keep one instance per server process.
+    """
+
+    def __init__(self, root=JOBS_DIR, workers=JOB_WORKERS, memory_mb=JOB_MEMORY_MB, max_queued=MAX_QUEUED_JOBS,
+                 retention_hours=JOB_RETENTION_HOURS):
+        self.root = root
+        self.workers = workers
+        self.memory_mb = memory_mb
+        self.max_queued = max_queued
+        self.retention_hours = retention_hours
+        os.makedirs(root, mode=0o700, exist_ok=True)
+
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.running = {}  # job_id -> estimated MB
+        self.wakeup = threading.Event()
+
+        self.instance_id = uuid.uuid4().hex
+        self.instances_dir = os.path.join(root, ".instances")
+        os.makedirs(self.instances_dir, mode=0o700, exist_ok=True)
+        self._heartbeat()
+        self._recover()
+        self.purge()
+        threading.Thread(target=self._schedule_loop, daemon=True).start()
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def submit(self, template_df, urns_bytes, desc_bytes, options, reduced=True, chunk_rows=5000, label="",
+               all_desc_sheets=False):
+        """Queue a fully configured population job and return its id. Raises RuntimeError when the queue is full."""
+        if sum(job["state"] == "queued" for job in self.list_jobs()) >= self.max_queued:
+            raise RuntimeError(f"the job queue is full ({self.max_queued} jobs waiting); try again later")
+
+        job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        job_dir = self._job_dir(job_id)
+        os.makedirs(job_dir, mode=0o700)
+        with open(os.path.join(job_dir, "urns.xlsx"), "wb") as f:
+            f.write(urns_bytes)
+        with open(os.path.join(job_dir, "desc.xlsx"), "wb") as f:
+            f.write(desc_bytes)
+        _write_json(os.path.join(job_dir, "template.json"), template_df.columns.tolist())  # only the header is used
+
+        # each job is planned against its share of the memory, so big batches are streamed instead of
+        # holding a whole worker's worth of memory
+        plan = plan_execution(os.path.join(job_dir, "urns.xlsx"), os.path.join(job_dir, "desc.xlsx"),
+                              budget_mb=max(self.memory_mb // self.workers, 64), template_cols=template_df.shape[1],
+                              export_cols=len(MENTIONED_COLS) if reduced else template_df.shape[1],
+                              chunk_rows=chunk_rows)
+        # all metadata sheets are only read in memory
+        mode = "In-memory" if all_desc_sheets else plan["mode"]
+        _write_json(os.path.join(job_dir, "job.json"), {
+            "id": job_id, "label": label, "state": "queued", "stage": "queued", "progress": 0.0,
+            "submitted": time.time(), "options": options, "reduced": reduced, "chunk_rows": chunk_rows,
+            "all_desc_sheets": all_desc_sheets, "mode": mode, "estimate_mb": round(plan["estimates_mb"][mode], 1),
+            "rows": plan["rows"],
+        })
+        self.wakeup.set()
+        return job_id
+
+    def list_jobs(self):
+        # newest first
+        jobs = []
+        for job_id in os.listdir(self.root):
+            if job_id.startswith("."):
+                continue
+            try:
+                jobs.append(read_job(self._job_dir(job_id)))
+            except (OSError, ValueError):
+                continue  # being created or removed
+        return sorted(jobs, key=lambda job: job["submitted"], reverse=True)
+
+    def output_path(self, job_id, fmt="xlsx"):
+        return os.path.join(self._job_dir(job_id), JOB_OUTPUTS[fmt])
+
+    def _claim(self, job_id):
+        # exclusive claim file, so several servers sharing JOBS_DIR never run the same job twice
+        try:
+            os.close(os.open(os.path.join(self._job_dir(job_id), "claimed"), os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return False
+        _update_job(self._job_dir(job_id), state="running", owner=self.instance_id, stage="starting")
+        return True
+
+    def _schedule(self):
+        with self.lock:
+            queued = sorted((j for j in self.list_jobs() if j["state"] == "queued"), key=lambda j: j["submitted"])
+            for job in queued:
+                in_use = sum(self.running.values())
+                if len(self.running) >= self.workers:
+                    break
+                if self.running and in_use + job["estimate_mb"] > self.memory_mb:
+                    break  # keep submission order: smaller jobs behind it do not overtake
+                if not self._claim(job["id"]):
+                    continue
+                try:
+                    future = self.pool.submit(run_job, self._job_dir(job["id"]))
+                except BrokenProcessPool as e:  # a worker was killed (e.g. out of memory): start a new pool
+                    _update_job(self._job_dir(job["id"]), state="failed", finished=time.time(), error=repr(e))
+                    self.pool.shutdown(wait=False)
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                    continue
+                self.running[job["id"]] = job["estimate_mb"]
+                future.add_done_callback(lambda future, job_id=job["id"]: self._finished(job_id, future))
+
+    def _finished(self, job_id, future):
+        with self.lock:
+            self.running.pop(job_id, None)
+        if future.exception() is not None:  # the worker process itself died (e.g. killed when out of memory)
+            _update_job(self._job_dir(job_id), state="failed", finished=time.time(), error=repr(future.exception()))
+        self.wakeup.set()
+
+    def _schedule_loop(self):
+        # woken up by submit() / finished jobs; the timeout also picks up jobs queued by other servers and
+        # the orphans of servers that stopped meanwhile
+        while True:
+            self.wakeup.wait(timeout=2.0)
+            self.wakeup.clear()
+            try:
+                self._heartbeat()
+                self._schedule()
+                self._recover()
+            except Exception:
+                pass  # a broken job dir must not stop the scheduler
+
+    def _heartbeat(self):
+        path = os.path.join(self.instances_dir, self.instance_id)
+        with open(path, "a"):
+            pass
+        os.utime(path)
+
+    def _instance_alive(self, instance_id):
+        try:
+            beat = os.path.getmtime(os.path.join(self.instances_dir, str(instance_id)))
+        except OSError:
+            return False
+        return time.time() - beat < INSTANCE_TIMEOUT
+
+    def _recover(self):
+        # jobs claimed by a server instance that stopped will never finish
+        for job in self.list_jobs():
+            if job["state"] in ("queued", "running") and "owner" in job and not self._instance_alive(job["owner"]):
+                _update_job(self._job_dir(job["id"]), state="failed", finished=time.time(),
+                            error="interrupted by a server restart")
+
+    def purge(self):
+        # drop finished jobs (and their files) after the retention period, and the heartbeats of stopped servers
+        for name in os.listdir(self.instances_dir):
+            if not self._instance_alive(name):
+                try:
+                    os.remove(os.path.join(self.instances_dir, name))
+                except OSError:
+                    pass
+        cutoff = time.time() - self.retention_hours * 3600
+        for job in self.list_jobs():
+            if job["state"] in ("done", "failed") and job.get("finished", job["submitted"]) < cutoff:
+                shutil.rmtree(self._job_dir(job["id"]), ignore_errors=True)
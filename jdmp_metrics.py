@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Prometheus-style metrics (no Streamlit calls in here) ---
+# counters and histograms kept in process memory and rendered in the Prometheus text format, served on
+# http://<JDMP_METRICS_HOST>:<JDMP_METRICS_PORT>/metrics and/or written to JDMP_METRICS_FILE every
+# JDMP_METRICS_INTERVAL seconds (e.g. for node_exporter's textfile collector). Collection is on when a port
+# or file is configured, or JDMP_METRICS=1 (render() only, e.g. the API's /metrics route or a quick check);
+# otherwise every inc / observe / time call returns immediately
+METRICS_PORT = int(os.environ.get("JDMP_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("JDMP_METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.environ.get("JDMP_METRICS_FILE", "")
+METRICS_INTERVAL = float(os.environ.get("JDMP_METRICS_INTERVAL", "15"))
+ENABLED = bool(METRICS_PORT or METRICS_FILE or os.environ.get("JDMP_METRICS") == "1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ROW_BUCKETS = (10, 100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter per label combination: COUNTER.inc(amount, label=value, ...)."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label combination: HISTOGRAM.observe(value, label=value, ...), or
+    `with HISTOGRAM.time(label=value):` for durations in seconds."""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels) if ENABLED else nullcontext()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = _labels(self.labelnames, key, [("le", _number(bound))])
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {counts[-2]}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(counts[-1])}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {counts[-2]}")
+        return lines
+
+
+def render():
+    # all metrics in the Prometheus text exposition format
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+def dump(path=None):
+    # write + rename, so a scraper never reads a half-written file
+    path = path or METRICS_FILE
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+# --- the app's metrics ---
+UPLOAD_ROWS = Histogram("jdmp_upload_rows", "Rows per parsed upload.", ["input"], buckets=ROW_BUCKETS)
+STAGE_SECONDS = Histogram("jdmp_stage_seconds", "Population stage latency in seconds (computed, not cached).",
+                          ["stage"])
+STAGE_CACHE = Counter("jdmp_stage_cache_total", "Stage graph lookups by node and result (hit / miss).",
+                      ["stage", "result"])
+# hit ratio = 1 - misses / requests
+CACHE_REQUESTS = Counter("jdmp_cache_requests_total", "Template / crediting / ingestion / reference cache lookups.",
+                         ["cache"])
+CACHE_MISSES = Counter("jdmp_cache_misses_total", "Cache lookups that had to parse the file.", ["cache"])
+EXPORT_BYTES = Counter("jdmp_export_bytes_total", "Bytes of exported files by format.", ["format"])
+EXPORT_SECONDS = Histogram("jdmp_export_seconds", "Export latency in seconds by format.", ["format"])
+IMAGE_FETCH_SECONDS = Histogram("jdmp_image_fetch_seconds", "Latency of image / URN requests to the resolver.",
+                                ["kind"])
+IMAGE_FETCH_FAILURES = Counter("jdmp_image_fetch_failures_total", "Failed image / URN requests by reason.",
+                               ["kind", "reason"])
+API_REQUESTS = Counter("jdmp_api_requests_total", "HTTP API requests by route and status.", ["route", "status"])
+API_SECONDS = Histogram("jdmp_api_request_seconds", "HTTP API request latency in seconds.", ["route"])
+
+
+# --- exposition (started once per process) ---
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # no access log on stderr for every scrape
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def serve_metrics():
+    """Start the /metrics endpoint and / or the file writer configured by the environment; no-op when
+    disabled or already started. Returns the server (or None)."""
+    global _started
+    with _start_lock:
+        if _started or not ENABLED:
+            return None
+        _started = True
+    server = None
+    if METRICS_PORT:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if METRICS_FILE:
+        os.makedirs(os.path.dirname(os.path.abspath(METRICS_FILE)), exist_ok=True)
+
+        def write_loop():
+            while True:
+                try:
+                    dump()
+                except OSError:
+                    pass  # e.g. the directory was removed; try again next time
+                time.sleep(METRICS_INTERVAL)
+
+        threading.Thread(target=write_loop, daemon=True).start()
+    return server
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# --- cold-start benchmark for the JDMP apps ---
+# python jdmp_startup_bench.py [--repeat 5] [--history startup_history.jsonl] [--max-render-s 5]
+# every sample runs in a fresh interpreter, so nothing is imported or cached in memory yet:
+#   import <module>   time to import one JDMP module
+#   first render      wall time from starting the interpreter to the end of an app's first script run without
+#                     uploads (Streamlit's AppTest runs the script like the server does) - what a user waits for
+#                     after a container cold start
+# the modules that should only load on demand (openpyxl, requests, Pillow) are listed when the first render
+# imported them anyway. --history appends one JSON line per run, to track the numbers across changes;
+# --max-render-s exits 1 when an app's median first render is slower, e.g. to guard a CI job
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULES = ["jdmp_core", "jdmp_jobs", "jdmp_urns", "jdmp_api"]
+APPS = ["jdmp_v1.py", "jdmp_v2.py"]
+ON_DEMAND_MODULES = ["openpyxl", "requests", "PIL"]
+
+IMPORT_SCRIPT = "import time\nt = time.perf_counter()\nimport {module}\nprint(time.perf_counter() - t)\n"
+RENDER_SCRIPT = (
+    "import json, sys\n"
+    "from streamlit.testing.v1 import AppTest\n"
+    "at = AppTest.from_file({app!r}, default_timeout=300).run()\n"
+    "print(json.dumps({{'exceptions': [e.value for e in at.exception],\n"
+    "                  'loaded': [m for m in {modules!r} if m in sys.modules]}}))\n"
+)
+
+
+def run_python(code):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout.strip().splitlines()[-1]
+
+
+def import_time(module):
+    _, out = run_python(IMPORT_SCRIPT.format(module=module))
+    return float(out)
+
+
+def first_render(app):
+    elapsed, out = run_python(RENDER_SCRIPT.format(app=app, modules=ON_DEMAND_MODULES))
+    return elapsed, json.loads(out)
+
+
+def summary(name, samples, note=""):
+    return {"name": name, "median_s": round(statistics.median(samples), 3), "min_s": round(min(samples), 3),
+            "max_s": round(max(samples), 3), "samples": [round(s, 3) for s in samples], "note": note}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for the JDMP apps")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per measurement")
+    parser.add_argument("--history", help="append the results as one JSON line to this file")
+    parser.add_argument("--max-render-s", type=float, help="exit 1 if an app's median first render is slower")
+    args = parser.parse_args()
+
+    # one unmeasured run, so .pyc compilation is not part of the numbers (a deployed image has them)
+    for app in APPS:
+        first_render(app)
+
+    results = []
+    for module in MODULES:
+        results.append(summary(f"import {module}", [import_time(module) for _ in range(args.repeat)]))
+    for app in APPS:
+        samples, details = [], None
+        for _ in range(args.repeat):
+            elapsed, details = first_render(app)
+            samples.append(elapsed)
+        note = "; ".join(filter(None, [
+            f"exceptions: {details['exceptions']}" if details["exceptions"] else "",
+            f"loaded on start: {', '.join(details['loaded'])}" if details["loaded"] else "",
+        ]))
+        results.append(summary(f"first render {app}", samples, note))
+
+    print(f"{'measurement':<28} {'median s':>9} {'min s':>8} {'max s':>8}  note")
+    for r in results:
+        print(f"{r['name']:<28} {r['median_s']:>9} {r['min_s']:>8} {r['max_s']:>8}  {r['note']}")
+
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                                "results": results}) + "\n")
+
+    slow = [r["name"] for r in results
+            if args.max_render_s and r["name"].startswith("first render") and r["median_s"] > args.max_render_s]
+    if slow:
+        raise SystemExit(f"first render slower than {args.max_render_s} s: {', '.join(slow)}")
@@ -0,0 +1,271 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from jdmp_metrics import IMAGE_FETCH_FAILURES, IMAGE_FETCH_SECONDS
+
+# --- URN resolution checks against the NRS resolver (no Streamlit calls in here) ---
+# every unique FILE-URN is requested from <base url><URN> by a bounded thread pool sharing one keep-alive
+# session; requests are rate limited, retried on connection errors / 429 / 5xx, and results are cached
+# for URN_CACHE_TTL seconds so re-checking a batch only hits the resolver for new URNs
+
+NRS_BASE_URL = os.environ.get("JDMP_NRS_BASE_URL", "http://nrs.harvard.edu/")
+URN_CHECK_WORKERS = int(os.environ.get("JDMP_URN_CHECK_WORKERS", "8"))
+URN_CHECK_RATE = float(os.environ.get("JDMP_URN_CHECK_RATE", "10"))  # requests per second, all workers together
+URN_CHECK_RETRIES = 3
+URN_CHECK_TIMEOUT = 10
+URN_CACHE_TTL = int(os.environ.get("JDMP_URN_CACHE_TTL", "3600"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+URN_STATUS_COLS = ["FILE-URN", "URN Status", "HTTP Status", "Resolves To", "Detail"]
+
+
+def _session(pool_size):
+    # requests (and Pillow below) are imported on first use, so importing this module costs the apps nothing
+    # at start-up; one connection pool per host, sized to the worker count, so connections are reused
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class RateLimiter:
+    # token bucket shared by the worker threads
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class URNChecker:
+    """Concurrent, rate-limited, cached URN resolution checks. Keep one instance per base URL and process."""
+
+    def __init__(self, base_url=NRS_BASE_URL, workers=URN_CHECK_WORKERS, rate=URN_CHECK_RATE,
+                 retries=URN_CHECK_RETRIES, timeout=URN_CHECK_TIMEOUT, ttl=URN_CACHE_TTL):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.ttl = ttl
+        self.limiter = RateLimiter(rate, burst=workers)
+
+        self.session = _session(workers)  # keep-alive connections shared by the worker threads
+
+        self.cache = {}  # URN -> (checked at, result)
+        self.cache_lock = threading.Lock()
+
+    def _request(self, url):
+        # HEAD is enough to see whether the resolver knows the URN; fall back to GET where HEAD is refused
+        response = self.session.head(url, allow_redirects=False, timeout=self.timeout)
+        if response.status_code in (405, 501):
+            response = self.session.get(url, allow_redirects=False, timeout=self.timeout, stream=True)
+            response.close()
+        return response
+
+    def check_one(self, urn):
+        from requests import RequestException
+
+        with self.cache_lock:
+            cached = self.cache.get(urn)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+
+        url = self.base_url + urn
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                with IMAGE_FETCH_SECONDS.time(kind="urn check"):
+                    response = self._request(url)
+            except RequestException as e:
+                IMAGE_FETCH_FAILURES.inc(kind="urn check", reason=type(e).__name__)
+                result = {"URN Status": "Unreachable", "HTTP Status": None, "Resolves To": "",
+                          "Detail": f"{type(e).__name__}: {e}"}
+                retry_after = None
+            else:
+                code = response.status_code
+                if code >= 400:
+                    IMAGE_FETCH_FAILURES.inc(kind="urn check", reason=f"HTTP {code}")
+                if code < 400:
+                    status = "OK"
+                elif code in (404, 410):
+                    status = "Not Found"
+                else:
+                    status = "Error"
+                result = {"URN Status": status, "HTTP Status": code,
+                          "Resolves To": response.headers.get("Location", ""),
+                          "Detail": "" if code < 400 else response.reason or ""}
+                if code not in RETRY_STATUSES:
+                    break
+                retry_after = response.headers.get("Retry-After")
+            if attempt < self.retries:
+                # exponential backoff, or the server's Retry-After (seconds) when it sends one
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt
+                time.sleep(min(delay, 30))
+
+        if result["URN Status"] in ("OK", "Not Found"):  # transient failures are not cached
+            with self.cache_lock:
+                self.cache[urn] = (time.time(), result)
+        return result
+
+    def check(self, urns, progress=None):
+        """Check every unique URN; returns one row per unique URN (URN_STATUS_COLS).
+        progress, if given, is called as progress(done, total) after each URN."""
+        unique_urns = list(dict.fromkeys(str(u).strip() for u in urns if str(u).strip()))
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {urn: pool.submit(self.check_one, urn) for urn in unique_urns}
+            for done, (urn, future) in enumerate(futures.items(), start=1):
+                results[urn] = future.result()
+                if progress is not None:
+                    progress(done, len(unique_urns))
+        report = pd.DataFrame([{"FILE-URN": urn, **results[urn]} for urn in unique_urns], columns=URN_STATUS_COLS)
+        report["HTTP Status"] = report["HTTP Status"].astype("Int64")
+        return report
+
+
+def urn_status_column(urns, report):
+    # per-row status for a FILE-URN column, from a check() report
+    statuses = dict(zip(report["FILE-URN"], report["URN Status"]))
+    return urns.astype(str).str.strip().map(statuses).fillna("Not Checked")
+
+
+# --- contact-sheet thumbnails ---
+# images for a page of URNs are fetched by a thread pool, downscaled in a process pool (decoding is CPU
+# bound) and kept on disk as small JPEGs keyed by URN + size, so revisiting a page sends no new requests
+THUMB_DIR = os.environ.get("JDMP_THUMB_DIR", os.path.join(tempfile.gettempdir(), "jdmp_thumbs"))
+THUMB_SIZE = 200
+THUMB_FETCH_WORKERS = int(os.environ.get("JDMP_THUMB_FETCH_WORKERS", "8"))
+THUMB_MAX_BYTES = 50 * 1024 * 1024
+THUMB_CACHE_MAX_MB = float(os.environ.get("JDMP_THUMB_CACHE_MAX_MB", "500"))
+
+
+def _thumbnail(args):
+    # runs in a pool process: image bytes -> JPEG thumbnail at out_path
+    from PIL import Image
+
+    data, out_path, size = args
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("RGB", (size, size))  # JPEG: decode at reduced scale directly
+            img.thumbnail((size, size))
+            tmp_path = f"{out_path}.{os.getpid()}.tmp"
+            img.convert("RGB").save(tmp_path, "JPEG", quality=80)
+        os.replace(tmp_path, out_path)
+        return None
+    except Exception as e:  # not an image, e.g. a login page for restricted objects
+        return f"not a readable image ({type(e).__name__})"
+
+
+class ThumbnailCache:
+    """Fetch + downscale URN images into an on-disk thumbnail cache. Keep one instance per base URL and process."""
+
+    def __init__(self, base_url=NRS_BASE_URL, cache_dir=THUMB_DIR, size=THUMB_SIZE, fetch_workers=THUMB_FETCH_WORKERS,
+                 workers=None, timeout=URN_CHECK_TIMEOUT, max_mb=THUMB_CACHE_MAX_MB):
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.cache_dir = cache_dir
+        self.size = size
+        self.fetch_workers = fetch_workers
+        self.timeout = timeout
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+        self.purge()
+
+        self.session = _session(fetch_workers)
+        self.pool = ProcessPoolExecutor(max_workers=workers or min(os.cpu_count() or 1, 4))
+
+    def path(self, urn):
+        key = hashlib.sha1(f"{self.base_url}{urn}|{self.size}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def _fetch(self, urn):
+        with IMAGE_FETCH_SECONDS.time(kind="thumbnail"):
+            with self.session.get(self.base_url + urn, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                data = response.raw.read(THUMB_MAX_BYTES + 1, decode_content=True)
+        if len(data) > THUMB_MAX_BYTES:
+            raise ValueError("image larger than 50 MB")
+        return data
+
+    def thumbnails(self, urns, progress=None):
+        """Return {URN: (thumbnail path or None, error)} for urns; only URNs without a cached thumbnail are fetched.
+        progress, if given, is called as progress(done, total)."""
+        urns = list(dict.fromkeys(str(u).strip() for u in urns))
+        results = {}
+        for urn in urns:
+            try:
+                os.utime(self.path(urn))  # mark as recently used for purge
+            except FileNotFoundError:
+                continue
+            results[urn] = (self.path(urn), "")
+        missing = [urn for urn in urns if urn not in results]
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetch_pool:
+            fetches = {fetch_pool.submit(self._fetch, urn): urn for urn in missing}
+            downscales = {}
+            # hand every image to the process pool as soon as it has arrived
+            for future in as_completed(fetches):
+                urn = fetches[future]
+                try:
+                    downscales[urn] = self.pool.submit(_thumbnail, (future.result(), self.path(urn), self.size))
+                except Exception as e:
+                    IMAGE_FETCH_FAILURES.inc(kind="thumbnail", reason=type(e).__name__)
+                    results[urn] = (None, f"{type(e).__name__}: {e}")
+                    if progress is not None:
+                        progress(len(results), len(urns))
+            for urn, future in downscales.items():
+                error = future.result()
+                if error:
+                    IMAGE_FETCH_FAILURES.inc(kind="thumbnail", reason="unreadable image")
+                results[urn] = (None, error) if error else (self.path(urn), "")
+                if progress is not None:
+                    progress(len(results), len(urns))
+        self.purge(keep={self.path(urn) for urn in urns})
+        return {urn: results[urn] for urn in urns}
+
+    def purge(self, keep=()):
+        # drop the least recently used thumbnails (and abandoned temp files) until the cache fits in max_bytes
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".tmp") and stat.st_mtime > time.time() - 3600:
+                continue  # still being written
+            entries.append((not name.endswith(".tmp"), stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, _, size, _ in entries)
+        for finished, _, size, path in sorted(entries):
+            if finished and total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
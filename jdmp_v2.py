@@ -1,9 +1,25 @@
+import io
+import os
+import shutil
+import time
+from pathlib import Path
+
 import streamlit as st
 import pandas as pd
-import io
-from openpyxl.styles import Border, Side, Alignment
+
+from jdmp_core import (DEFAULT_MEMORY_BUDGET_MB, EXECUTION_MODES, MENTIONED_COLS, PREVIEW_MATCHES, PREVIEW_PAGE_ROWS,
+                       SOURCE_SHEET_COL, STANDARD_RIGHTS_TEXT, XLSX_MIME, StageGraph, clean_urns, crediting_note,
+                       date_flags, delta_export, export_csv, export_sharded_zip, export_xlsx, gzip_file,
+                       mapping_rules, match_rows, output_page, plan_execution, qa_report, qa_summary, read_columns,
+                       read_crediting_table, read_header, read_inputs, read_previous_export, reference_table,
+                       sample_rows, stream_populate, suggest_mapping)
+from jdmp_history import HISTORY_ENABLED, BatchHistory
+from jdmp_jobs import JobQueue
+from jdmp_metrics import CACHE_MISSES, CACHE_REQUESTS, serve_metrics
+from jdmp_urns import NRS_BASE_URL, ThumbnailCache, URNChecker, urn_status_column
 
 st.set_page_config(page_title="JDMP Reduced", layout="centered")
+serve_metrics()  # /metrics endpoint and / or metrics file, when configured (started once per process)
 
 st.title("Judaica Digital Metadata Parser (Reduced Version)")
 st.header("Exporting SharedShelf template with selected columns only")
@@ -16,10 +32,11 @@ with st.expander("**📤 Optional Uploads (click to expand)**"):
     template_file = st.file_uploader("Upload SharedShelf Template Excel (optional - if none uploaded, will use default SharedShelf template)", type=["xlsx"])
 
 # --- template file handling ---
-    # cached function: loads template (or any Excel) file once, then reuses result
+    # cached function: loads template (or any Excel) file once, then reuses result (also across restarts)
     @st.cache_data
     def load_template(path: str):
-        return pd.read_excel(path)
+        CACHE_MISSES.inc(cache="template")  # only runs when Streamlit's cache misses
+        return reference_table(path)
 
     if template_file: # if user uploads a new template
         try:
@@ -28,73 +45,165 @@ with st.expander("**📤 Optional Uploads (click to expand)**"):
         except Exception as e:
             st.error(f"**Could not read the uploaded Template: {e}**")
             template_df = None
-    else: # fallback to default stored template
+    elif urns_file or desc_file: # fallback to default stored template (loaded once it is needed)
         try:
+            CACHE_REQUESTS.inc(cache="template")
             template_df = load_template("SharedShelf Template.xlsx")
             #st.info("No template uploaded. Using default SharedShelf template.")
             st.success(f"Default SharedShelf Template: {template_df.shape[1]} columns detected")
         except Exception as e:
             st.error(f"**Default Template not found or unreadable: {e}**")
             template_df = None
+    else:
+        template_df = None
 
 # --- crediting file handling ---
     crediting_file = st.file_uploader("Upload Crediting-Notes Translation Table (optional)", type=["xlsx"])
 
     @st.cache_data
-    def load_crediting_table(path):
-        # read first two columns only and normalize
-        df = pd.read_excel(path)
-        df = df.iloc[:, :2].copy()
-        df.columns = ["source", "notes"]
-        df["source"] = df["source"].astype(str).str.strip()
-        df["notes"] = df["notes"].astype(str).fillna("").str.strip()
-        df = df.dropna(subset=["source"])
-        return df
+    def load_crediting_table(source):
+        CACHE_MISSES.inc(cache="crediting")
+        if isinstance(source, str):  # default table
+            return reference_table(source, read_crediting_table)
+        return read_crediting_table(source)
 
     if crediting_file:  # if user uploads a new table
         try:
+            CACHE_REQUESTS.inc(cache="crediting")
             crediting_df = load_crediting_table(crediting_file)
             st.success(f"Custom Crediting-Notes Translation Table loaded: {len(crediting_df)} sources")
         except Exception as e:
             st.error(f"**Could not read the uploaded file: {e}**")
             crediting_df = None
-    else:  # fallback to default table
+    elif urns_file or desc_file:  # fallback to default table (loaded once it is needed)
         try:
+            CACHE_REQUESTS.inc(cache="crediting")
             crediting_df = load_crediting_table("Notes-Crediting - Translation Table - Column DB.xlsx")
             st.success(f"Default Crediting-Notes Translation Table: {len(crediting_df)} sources")
         except Exception as e:
             st.error(f"**Default file not found or unreadable: {e}**")
             crediting_df = None
+    else:
+        crediting_df = None
+
+# --- previous export handling (delta export) ---
+    previous_file = st.file_uploader("Upload Previously Exported JDMP_Populated_Template (optional - if uploaded, a delta export with only new/changed rows is offered)", type=["xlsx", "csv"])
+
+# --- execution mode (very large batches) ---
+    execution_mode = st.radio(
+        "Execution mode", EXECUTION_MODES, horizontal=True,
+        help="Automatic estimates memory from the uploads' sheet dimensions and picks In-memory, Column-pruned "
+             "(only the selected columns are parsed) or Streaming (row chunks, exported to disk).")
+    memory_budget_mb = st.number_input("Memory budget (MB)", min_value=64, value=DEFAULT_MEMORY_BUDGET_MB, step=64)
+    chunk_rows = st.number_input("Rows per chunk (streaming)", min_value=500, max_value=100000, value=5000, step=500)
+
+# --- multi-sheet metadata ---
+    all_desc_sheets = st.toggle(
+        "Read all sheets of the Descriptive Metadata workbook",
+        help="For batches split across several sheets: every sheet is parsed in parallel and the rows are combined, "
+             f"with a '{SOURCE_SHEET_COL}' column naming the sheet each row came from. Uses In-memory mode.")
+
+# --- execution plan (pre-flight, before any full parse) ---
+if execution_mode == "Automatic" and (urns_file or desc_file):
+    template_cols = template_df.shape[1] if template_df is not None else 112
+    try:
+        plan = plan_execution(urns_file, desc_file, memory_budget_mb, template_cols=template_cols,
+                              export_cols=len(MENTIONED_COLS), chunk_rows=int(chunk_rows))
+        execution_mode = plan["mode"]
+        st.info(plan["summary"])
+    except Exception as e:
+        st.warning(f"**Could not inspect the uploads for an execution plan ({e}); using In-memory.**")
+        execution_mode = "In-memory"
+if all_desc_sheets and execution_mode != "In-memory":
+    st.info("Reading all Descriptive Metadata sheets: using In-memory mode.")
+    execution_mode = "In-memory"
+streaming_mode = execution_mode == "Streaming"
+pruned_mode = execution_mode == "Column-pruned"
+
+
+# --- parallel ingestion (in-memory mode: both uploads are parsed at once, in worker processes) ---
+@st.cache_data(show_spinner="Reading uploads...")
+def load_inputs(urns_bytes, desc_bytes, all_desc_sheets):
+    CACHE_MISSES.inc(cache="ingestion")
+    return read_inputs(urns_bytes, desc_bytes, all_desc_sheets=all_desc_sheets)
+
+
+if not (streaming_mode or pruned_mode) and (urns_file or desc_file):
+    CACHE_REQUESTS.inc(cache="ingestion")
+    urns_input_df, desc_input_df = load_inputs(urns_file.getvalue() if urns_file else None,
+                                               desc_file.getvalue() if desc_file else None, all_desc_sheets)
+
+
+# streaming / column-pruned modes read single columns of an upload; once per upload and column set, since
+# every rerun (widget click, page change, download) would otherwise read the whole workbook again
+@st.cache_data(show_spinner="Reading columns...", max_entries=16)
+def load_columns(data, columns):
+    return read_columns(io.BytesIO(data), columns)
+
+# --- suggested column mapping (from row samples, once per pair of uploads; every selection can be changed) ---
+mapping_suggestion = {}
+if urns_file and desc_file:
+    suggestion_key = (getattr(urns_file, "file_id", None), getattr(desc_file, "file_id", None), all_desc_sheets)
+    cached_suggestion = st.session_state.get("mapping_suggestion")
+    if cached_suggestion is None or cached_suggestion[0] != suggestion_key:
+        try:
+            in_memory = not (streaming_mode or pruned_mode)
+            cached_suggestion = (suggestion_key, suggest_mapping(sample_rows(urns_input_df if in_memory else urns_file),
+                                                                 sample_rows(desc_input_df if in_memory else desc_file)))
+        except Exception:
+            cached_suggestion = (suggestion_key, {})  # no suggestions; the selections start blank
+        st.session_state["mapping_suggestion"] = cached_suggestion
+    mapping_suggestion = cached_suggestion[1]
+
+
+def suggested_index(options, key, default=0):
+    # preselect the suggested column, if it is one of the options
+    value = mapping_suggestion.get(key)
+    return options.index(value) if value in options else default
+
 
 # --- URNs file handling ---
 missing_selections = []
 
 if urns_file:
-    urns_df = pd.read_excel(urns_file)
+    # streaming / column-pruned modes parse only the header here; the needed columns are read after selection
+    urns_df = pd.DataFrame(columns=read_header(urns_file)) if (streaming_mode or pruned_mode) else urns_input_df
     st.subheader("URNs")
 
-    # drop rows with NaN or blank FILE-URN
-    if "FILE-URN" in urns_df.columns:
-        urns_df = urns_df.dropna(subset=["FILE-URN"]).copy()
-        urns_df = urns_df[(urns_df["FILE-URN"].astype(str).str.strip() != "")].reset_index(drop=True)
-        st.success(f"Cleaned URNs: {len(urns_df)} rows remaining")
-    else:
-        st.error("**Column 'FILE-URN' not found in URNs file.**")
-
     urns_cols = urns_df.columns.tolist()
     urns_cols_with_none = [None] + urns_cols
 
     # select match field
-    urns_key_col = st.selectbox("**Select Match Field from URNs Spreadsheet (usually FILE-OSN)**", urns_cols_with_none)
+    urns_key_col = st.selectbox("**Select Match Field from URNs Spreadsheet (usually FILE-OSN)**", urns_cols_with_none,
+                                index=suggested_index(urns_cols_with_none, "urns_key_col"))
 
     if urns_key_col is None:
         missing_selections.append("Match Field for URNs Spreadsheet")
 
+    if streaming_mode and "FILE-URN" in urns_cols:
+        # only FILE-URN + match field are kept in memory (image preview + validation)
+        urns_df = load_columns(urns_file.getvalue(), list(dict.fromkeys(["FILE-URN", urns_key_col or "FILE-URN"])))
+    elif pruned_mode:
+        urns_df = load_columns(urns_file.getvalue(),
+                               list(dict.fromkeys(["FILE-URN", "OBJ-OSN", urns_key_col or "FILE-URN"])))
+
+    # drop rows with NaN or blank FILE-URN
+    if "FILE-URN" in urns_df.columns:
+        urns_df = clean_urns(urns_df)
+        st.success(f"Cleaned URNs: {len(urns_df)} rows remaining")
+    else:
+        st.error("**Column 'FILE-URN' not found in URNs file.**")
+
+    # resolver of the image preview, the contact sheet and the URN check (e.g. a local stand-in resolver)
+    nrs_base_url = st.text_input("Resolver base URL", value=NRS_BASE_URL).strip()
+    if not nrs_base_url.endswith("/"):
+        nrs_base_url += "/"
+
 # --- URNs image preview utility ---
 if urns_file and "FILE-URN" in urns_df.columns:
     with st.expander("🖼️ Preview URN Images (click to expand)"):
         urns_df["FILE-URN"] = urns_df["FILE-URN"].astype(str).str.strip()
-        urns_df["image_url"] = "http://nrs.harvard.edu/" + urns_df["FILE-URN"] + "?"
+        urns_df["image_url"] = nrs_base_url + urns_df["FILE-URN"] + "?"
         st.success(f"{len(urns_df)} URNs processed. Preview associated images below.")
 
         if len(urns_df) == 0:
@@ -151,36 +260,131 @@ if urns_file and "FILE-URN" in urns_df.columns:
             except Exception as e:
                 st.warning(f"**Could not load image for URN {row['FILE-URN']}: {e}**")
 
+# --- URN contact sheet (paginated thumbnail grid) ---
+@st.cache_resource
+def get_thumbnail_cache(base_url):
+    # one on-disk thumbnail cache + worker pools per resolver, shared by all sessions
+    return ThumbnailCache(base_url)
+
+
+if urns_file and "FILE-URN" in urns_df.columns and len(urns_df) > 0:
+    with st.expander("🗂️ Contact Sheet (click to expand)"):
+        show_sheet = st.toggle("Show thumbnails", help="Only the images of the current page are fetched.")
+        sheet_cols = 6
+        per_page = st.selectbox("Thumbnails per page", [24, 48, 96])
+        n_pages = (len(urns_df) - 1) // per_page + 1
+        page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+
+        if show_sheet:
+            start = (page - 1) * per_page
+            page_urns = urns_df["FILE-URN"].astype(str).str.strip().iloc[start:start + per_page].tolist()
+            sheet_bar = st.progress(0.0, text="Loading thumbnails...")
+            thumbs = get_thumbnail_cache(nrs_base_url).thumbnails(
+                page_urns,
+                progress=lambda done, total: sheet_bar.progress(done / total, text=f"Loaded {done} of {total} thumbnails"),
+            )
+            sheet_bar.empty()
+
+            for row_start in range(0, len(page_urns), sheet_cols):
+                row_urns = page_urns[row_start:row_start + sheet_cols]
+                for col, (n, urn) in zip(st.columns(sheet_cols), enumerate(row_urns, start=start + row_start + 1)):
+                    thumb_path, error = thumbs[urn]
+                    with col:
+                        if thumb_path:
+                            st.image(thumb_path, caption=f"{n}. {urn}")
+                        else:
+                            st.caption(f"{n}. {urn}  \n⚠️ {error}")
+
+# --- URN resolution check (every FILE-URN against the NRS resolver) ---
+@st.cache_resource
+def get_urn_checker(base_url):
+    # one checker per resolver: its connection pool and result cache are shared by all sessions
+    return URNChecker(base_url)
+
+
+if urns_file and "FILE-URN" in urns_df.columns:
+    with st.expander("🔗 Check URN Resolution (click to expand)"):
+        urn_check_key = (nrs_base_url, len(urns_df), int(pd.util.hash_pandas_object(urns_df["FILE-URN"]).sum()))
+
+        if st.button("Check URNs"):
+            check_bar = st.progress(0.0, text="Checking URNs...")
+            report = get_urn_checker(nrs_base_url).check(
+                urns_df["FILE-URN"],
+                progress=lambda done, total: check_bar.progress(done / total, text=f"Checked {done} of {total} URNs"),
+            )
+            check_bar.empty()
+            st.session_state["urn_check"] = (urn_check_key, report)
+
+        urn_check = st.session_state.get("urn_check")
+        if urn_check is not None and urn_check[0] == urn_check_key:
+            report = urn_check[1]
+            # one row per URNs row, in upload order
+            row_cols = [c for c in dict.fromkeys([urns_key_col, "FILE-URN"]) if c in urns_df.columns]
+            report_rows = urns_df[row_cols].copy()
+            report_rows["FILE-URN"] = report_rows["FILE-URN"].astype(str).str.strip()
+            report_rows["URN Status"] = urn_status_column(report_rows["FILE-URN"], report)
+            report_rows = report_rows.merge(report.drop(columns="URN Status"), on="FILE-URN", how="left")
+
+            failed = (report_rows["URN Status"] != "OK").sum()
+            if failed:
+                st.warning(f"**{failed} of {len(report_rows)} rows have a URN that did not resolve.**")
+            else:
+                st.success(f"All {len(report_rows)} URNs resolve.")
+            st.dataframe(report_rows)
+            st.download_button(
+                label="Download URN Check Report (CSV)",
+                data=export_csv(report_rows),
+                file_name="JDMP_URN_Check_Report.csv",
+                mime="text/csv",
+            )
+        elif urn_check is not None:
+            st.info("URNs or resolver changed since the last check. Click **Check URNs** to check again.")
+
 # --- descriptive metadata file handling (relevant selections included) ---
 if desc_file:
-    desc_df = pd.read_excel(desc_file)
+    desc_df = pd.DataFrame(columns=read_header(desc_file)) if (streaming_mode or pruned_mode) else desc_input_df
     st.subheader("Descriptive Metadata")
 
     desc_cols = desc_df.columns.tolist()
     desc_cols_with_none = [None] + desc_cols
 
-    # select types
-    metadata_type = st.selectbox("**Select Metadata Type**", [None, "Posters", "Ephemera", "Memorabilia", "Photographs"])
-    cataloging_type = st.radio("**Select Cataloging Type**", [ "Full Cataloging", "Provisional Records"], horizontal=True)
-    geographic_type = st.selectbox("**Select Geographic Type**", [None, "Israel", "World Judaica"])
-    if geographic_type == "World Judaica":
-        artstor_country_col = st.selectbox("**Select Country Column from Desc Metadata Spreadsheet**", desc_cols_with_none)
-    else:
+    if mapping_suggestion:
+        st.caption("Match fields and columns are pre-selected from a sample of the uploads; please check them.")
+
+    # mapping + template options live in one form: nothing reruns until "Apply Configuration" is clicked
+    config_form = st.form("configuration")
+    with config_form:
+        # select types
+        metadata_type = st.selectbox("**Select Metadata Type**", [None] + mapping_rules()["choices"]["metadata_type"])
+        cataloging_type = st.radio("**Select Cataloging Type**", [ "Full Cataloging", "Provisional Records"], horizontal=True)
+        geographic_type = st.selectbox("**Select Geographic Type**", [None, "Israel", "World Judaica"])
+        artstor_country_col = st.selectbox("**Select Country Column from Desc Metadata Spreadsheet** (World Judaica only)", desc_cols_with_none,
+                                           index=suggested_index(desc_cols_with_none, "artstor_country_col"))
+
+        # select columns
+        desc_key_col = st.selectbox("**Select Match Field from Desc Metadata Spreadsheet**", desc_cols_with_none,
+                                    index=suggested_index(desc_cols_with_none, "desc_key_col",
+                                                          default=min(2, len(desc_cols))))  # fallback: 2nd column
+        desc_title_col = st.selectbox("**Select Title Column from Desc Metadata Spreadsheet**", desc_cols_with_none,
+                                      index=suggested_index(desc_cols_with_none, "desc_title_col"))
+        desc_start_date_col = st.selectbox("**Select Start Date Column from Desc Metadata Spreadsheet**", desc_cols_with_none,
+                                           index=suggested_index(desc_cols_with_none, "desc_start_date_col"))
+        desc_end_date_col = st.selectbox("**Select End Date Column from Desc Metadata Spreadsheet**", desc_cols_with_none,
+                                         index=suggested_index(desc_cols_with_none, "desc_end_date_col"))
+
+        # select general note (inputs for every source are shown, since a form only updates on submit)
+        desc_source_type = st.selectbox("**Select Source for General Note / Shareshelf Description**",
+                                        [None, "Descriptive Metadata Column", "NO GENERAL NOTE", "OTHER"])
+        desc_note_col = st.selectbox("Select the Note Column (used with Descriptive Metadata Column)", desc_cols_with_none,
+                                     index=suggested_index(desc_cols_with_none, "desc_note_col"))
+        desc_source_text = st.text_area("Enter Custom General Note (used with OTHER)")
+
+    if geographic_type != "World Judaica":
         artstor_country_col = ""
-
-    # select columns
-    desc_key_col = st.selectbox("**Select Match Field from Desc Metadata Spreadsheet**", desc_cols_with_none, index=2)  # default: 2nd column
-    desc_title_col = st.selectbox("**Select Title Column from Desc Metadata Spreadsheet**", desc_cols_with_none)
-    desc_start_date_col = st.selectbox("**Select Start Date Column from Desc Metadata Spreadsheet**", desc_cols_with_none)
-    desc_end_date_col = st.selectbox("**Select End Date Column from Desc Metadata Spreadsheet**", desc_cols_with_none)
-
-    # select general note
-    desc_source_type = st.selectbox("**Select Source for General Note / Shareshelf Description**",
-                                    [None, "Descriptive Metadata Column", "NO GENERAL NOTE", "OTHER"])
-    if desc_source_type == "Descriptive Metadata Column":
-        desc_note_col = st.selectbox("Select the Note Column", [None] + desc_cols)
-    elif desc_source_type == "OTHER":
-        desc_source_text = st.text_area("Enter Custom General Note")
+    if desc_source_type != "Descriptive Metadata Column":
+        desc_note_col = None
+    if desc_source_type != "OTHER":
+        desc_source_text = ""
 
     # check if user made all required selections
     if metadata_type is None:
@@ -200,42 +404,54 @@ if desc_file:
     if desc_source_type is None:
         missing_selections.append("Source for General Note")
 
+    if streaming_mode and desc_key_col is not None:
+        # only the match field is kept in memory (validation)
+        desc_df = load_columns(desc_file.getvalue(), [desc_key_col])
+    elif pruned_mode:
+        # only the selected columns are parsed
+        pruned_cols = [c for c in [desc_key_col, desc_title_col, desc_start_date_col, desc_end_date_col, desc_note_col,
+                                   artstor_country_col] if c]
+        desc_df = load_columns(desc_file.getvalue(), pruned_cols)
+
 # --- template-related selections ---
 if urns_file and desc_file and template_df is not None:
-    st.subheader("Template Population")
-
-    # enter creator & subject info
-    template_creator = st.text_area("**Enter Creator Information**")
-    template_subject = st.text_area("**Enter Subject Information**")
-
-    # select copyright info
-    template_rights_type = st.selectbox("**Select Source for Rights**", [None, "STANDARD", "OTHER"])
-    if template_rights_type == "STANDARD":
-        template_rights_text = "The President and Fellows of Harvard College make no representation that they are the owner of the copyright; any researcher wishing to make use of an image must therefore assume all responsibility for clearing reproduction rights and for any infringement of Title 17 of the United States Code."
-    elif template_rights_type == "OTHER":
-        template_rights_text = st.text_area("Enter Custom Copyright Information")
+    with config_form:
+        st.subheader("Template Population")
+
+        # enter creator & subject info
+        template_creator = st.text_area("**Enter Creator Information**")
+        template_subject = st.text_area("**Enter Subject Information**")
+
+        # select copyright info
+        template_rights_type = st.selectbox("**Select Source for Rights**", [None, "STANDARD", "OTHER"])
+        template_rights_custom = st.text_area("Enter Custom Copyright Information (used with OTHER)")
+        template_rights_text = ""
+        if template_rights_type == "STANDARD":
+            template_rights_text = STANDARD_RIGHTS_TEXT
+        elif template_rights_type == "OTHER":
+            template_rights_text = template_rights_custom
     
-    # select crediting info
-    template_credit_type = None
-    template_credit_text = ""
-
-    if crediting_df is not None and not crediting_df.empty:
-        crediting_df_source = crediting_df["source"].tolist()
-
-        template_credit_type = st.selectbox(
-            "**Select Source for Crediting**",
-            [None] + crediting_df_source + ["OTHER"]
-        )
-
-        if template_credit_type and template_credit_type != "OTHER":
-            credit_df_notes = crediting_df.loc[crediting_df["source"] == template_credit_type, "notes"]
-            template_credit_text = next((t for t in credit_df_notes if t and t.strip()), "")
-            if not template_credit_text:
-                st.warning("**Selected source has no corresponding note in the table.**")
-        elif template_credit_type == "OTHER":
-            template_credit_text = st.text_area("Enter Custom Crediting Information")
-    else:
-        st.error("**No valid Crediting-Notes Traslation Table available. Upload one or include the default file in the app repo.**")
+        # select crediting info
+        template_credit_type = None
+        template_credit_text = ""
+
+        if crediting_df is not None and not crediting_df.empty:
+            crediting_df_source = crediting_df["source"].tolist()
+
+            template_credit_type = st.selectbox(
+                "**Select Source for Crediting**",
+                [None] + crediting_df_source + ["OTHER"]
+            )
+            template_credit_custom = st.text_area("Enter Custom Crediting Information (used with OTHER)")
+
+            if template_credit_type and template_credit_type != "OTHER":
+                template_credit_text = crediting_note(crediting_df, template_credit_type)
+                if not template_credit_text:
+                    st.warning("**Selected source has no corresponding note in the table.**")
+            elif template_credit_type == "OTHER":
+                template_credit_text = template_credit_custom
+        else:
+            st.error("**No valid Crediting-Notes Traslation Table available. Upload one or include the default file in the app repo.**")
 
     # check if user made all required selections
     if template_rights_type is None:
@@ -243,6 +459,15 @@ if urns_file and desc_file and template_df is not None:
     if template_credit_type is None:
         missing_selections.append("Source for Crediting")
 
+# --- apply configuration ---
+config_applied = job_submitted = False
+if desc_file:
+    with config_form:
+        config_applied = st.form_submit_button("Apply Configuration", type="primary")
+        job_submitted = st.form_submit_button(
+            "Run as Background Job", help="Queue the batch on the server instead of running it here; the results can "
+                                          "be downloaded later from any session under Background Jobs.")
+
 # --- validation ---
 if urns_file and desc_file:
     if urns_key_col is not None and desc_key_col is not None:
@@ -272,280 +497,184 @@ if urns_file and desc_file:
     else:
         st.info("Please select Match Fields for validation to run.")
 
-# --- template population pipeline ---
-if urns_file and desc_file and template_df is not None:
-    st.subheader("Populated SharedShelf Template")
+# --- background job queue (one per server process, shared by all sessions) ---
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
 
-    # initialize blank template aligned to URNs row count
-    target_rows = len(urns_df)
-    template_out = template_df.head(0).copy()
-    template_out = template_out.reindex(range(target_rows)).reset_index(drop=True)
 
-    # category 1: template population - standard fixed values
-    try:
-        template_out.loc[:, "SSID"] = "NEW"
-        template_out.loc[:, "File Count"] = 1
-        template_out.loc[:, "Repository[34349]"] = "Judaica Division, Widener Library[9000347138]"
-        template_out.loc[:, "Image Repository[34365]"] = "Judaica Division, Widener Library[9000347138]"
-        template_out.loc[:, "Send To Harvard[34382]"] = True
-        template_out.loc[:, "In House Use Only[34383]"] = False
-        template_out.loc[:, "Export Only In Group[34411]"] = False
-        
-        template_fixed_val_cols = ["SSID", "File Count", "Repository[34349]", "Image Repository[34365]",
-                          "Send To Harvard[34382]", "In House Use Only[34383]", "Export Only In Group[34411]"]
-    except KeyError as e:
-        st.error(f"**Template missing expected column(s) for fixed value population: {e}**")
-
-    # category 2: URNs value population - FILE-URN + FILE-OSN
-    try:
-        template_out.loc[:, "Filename"] = "drs:" + urns_df["FILE-URN"].astype(str).str.strip()
-
-        urns_df["FILE-OSN_transformed"] = urns_df["OBJ-OSN"].astype(str).str.upper().str.replace("_", "", n=1)
-        template_out.loc[:, "Repository Classification Number[34364]"] = urns_df["FILE-OSN_transformed"]
-        template_out.loc[:, "Image Classification Number[34369]"] = urns_df["FILE-OSN_transformed"]
-        template_out.loc[:, "Repository Number[2560412]"] = urns_df["FILE-OSN_transformed"] + " (classification)"
-
-        template_urns_cols = ["Filename", "Repository Classification Number[34364]", "Image Classification Number[34369]",
-                              "Repository Number[2560412]"]
-    except KeyError as e:
-        st.error(f"**Template missing expected column(s) for URN-related population: {e}**")
-
-    # category 3-1: descriptive metadata population - start/end dates
-    if desc_start_date_col is not None and desc_end_date_col is not None:
-        start = pd.to_numeric(desc_df[desc_start_date_col], errors="coerce")
-        end   = pd.to_numeric(desc_df[desc_end_date_col], errors="coerce")
-        template_date_cols = ["Date Description[34341]", "ARTstor Earliest Date[34342]", "ARTstor Latest Date[34343]",
-                              "Earliest Date[2560433]", "Latest Date[2560435]"]
-
-        def assign_dates(start, end, template_date_warnings):
-            if pd.notna(start) and pd.notna(end) and (start != end):  # both present & different
-                if start > end:
-                    template_date_warnings.add("**One or more rows have Start Date later than End Date; Start Date used as default.**")
-                    return int(start), int(start), int(start), int(start), int(start)
-                return f"{int(start)}-{int(end)}", int(start), int(end), int(start), int(end)
-            elif pd.notna(start) and pd.notna(end) and (start == end):  # both present & identical
-                return int(start), int(start), int(end), int(start), int(end)
-            elif pd.notna(start) and pd.isna(end):  # start present, end blank
-                return int(start), int(start), int(start), int(start), int(start)
-            elif pd.isna(start) and pd.notna(end):  # start blank, end present
-                template_date_warnings.add("**One or more rows have blank Start Date; End Date used as default.**")
-                return int(end), int(end), int(end), int(end), int(end)
-            else:  # both blank
-                template_date_warnings.add("**One or more rows have both Start and End Dates missing; defaulted to 1900–2025.**")
-                return "1900-2025", 1900, 2025, 1900, 2025
-        
-        template_date_warnings = set()  # avoid duplicated warnings
-        date_values = [assign_dates(s, e, template_date_warnings) for s, e in zip(start, end)]
-
-        for msg in template_date_warnings:
-            st.warning(msg)
-
-        date_df = pd.DataFrame(date_values, columns=template_date_cols)
-        for col in date_df.columns:
-            try:
-                template_out[col] = date_df[col]
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Start/End Date Population: {e}**")
-
-    # category 3-2: descriptive metadata population - title
-    if (desc_title_col and metadata_type and cataloging_type) is not None:
-        if desc_title_col not in desc_df.columns:
-            st.error("**Selected Title column not found in Descriptive Metadata.**")
-            #st.stop()
-        
-        titles = desc_df[desc_title_col].astype(str).str.strip()
-
-        if cataloging_type == "Full Cataloging":
-            populated_titles = titles
-
-        elif cataloging_type == "Provisional Records" and geographic_type == "Israel":
-            if metadata_type == "Posters":
-                populated_titles = "Israel Poster Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Ephemera":
-                populated_titles = "Israel Ephemera Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Memorabilia":
-                populated_titles = "Israel Realia Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Photographs":
-                populated_titles = "Israel Photograph Collection - " + titles + " [CATALOGING IN PROCESS.]"
-        
-        elif cataloging_type == "Provisional Records" and geographic_type == "World Judaica":
-            if metadata_type == "Posters":
-                populated_titles = "Judaica Poster Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Ephemera":
-                populated_titles = "Judaica Ephemera Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Memorabilia":
-                populated_titles = "Judaica Realia Collection - " + titles + " [CATALOGING IN PROCESS.]"
-            elif metadata_type == "Photographs":
-                populated_titles = "Judaica Photograph Collection - " + titles + " [CATALOGING IN PROCESS.]"
+# --- batch history (one store per server process; every applied run is recorded) ---
+@st.cache_resource
+def get_batch_history():
+    return BatchHistory()
 
-        else:
-            st.warning("**Unknown Cataloging Type; titles left blank.**")
-            populated_titles = ""
 
-        try:
-            template_out.loc[:, "Title[34338]"] = populated_titles
-        except KeyError as e:
-            st.error(f"**Template missing expected column for Title population: {e}**")
+@st.cache_data(max_entries=2)
+def load_batch(batch_id):
+    return get_batch_history().load(batch_id)
 
-    # category 3-3: descriptive metadata population - metadata type-related
-    if metadata_type is not None:
-        if metadata_type == "Posters":
-            try:
-                #template_out.loc[:, "Creator[34336]"] = ""
-                template_out.loc[:, "Materials/Techniques[34345]"] = "posters"
-                template_out.loc[:, "Work Type[34348]"] = "posters"
-                template_out.loc[:, "Materials Techniques Note[2560408]"] = "posters"
-
-                template_meta_type_cols = ["Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]"]
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Metadata Type-related population: {e}**")
-        
-        elif metadata_type == "Ephemera":
-            try:
-                #template_out.loc[:, "Creator[34336]"] = ""
-                template_out.loc[:, "Materials/Techniques[34345]"] = "ephemera"
-                template_out.loc[:, "Work Type[34348]"] = "ephemera"
-                template_out.loc[:, "Materials Techniques Note[2560408]"] = "ephemera"
-
-                template_meta_type_cols = ["Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]"]
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Metadata Type-related population: {e}**")
-        
-        elif metadata_type == "Memorabilia":
-            try:
-                template_out.loc[:, "Creator[34336]"] = ""
-                template_out.loc[:, "Materials/Techniques[34345]"] = "xxx (placeholder)"
-                template_out.loc[:, "Work Type[34348]"] = "xxx (placeholder)"
-                template_out.loc[:, "Materials Techniques Note[2560408]"] = "xxx (placeholder)"
-
-                template_meta_type_cols = ["Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]"]
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Metadata Type-related population: {e}**")
-        
-        elif metadata_type == "Photographs":
-            try:
-                template_out.loc[:, "Creator[34336]"] = ""
-                template_out.loc[:, "Materials/Techniques[34345]"] = "photographs"
-                template_out.loc[:, "Work Type[34348]"] = "photographs"
-                template_out.loc[:, "Materials Techniques Note[2560408]"] = "photographs"
-
-                template_meta_type_cols = ["Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]"]
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Metadata Type-related population: {e}**")
-
-    # category 3-4: descriptive metadata population - general note
-    if "Description[34357]" in template_out.columns:
-        if desc_source_type is not None:
-            if desc_source_type == "Descriptive Metadata Column" and desc_note_col:
-                template_out.loc[:, "Description[34357]"] = desc_df[desc_note_col].astype(str).str.strip()
-            elif desc_source_type == "NO GENERAL NOTE":
-                template_out.loc[:, "Description[34357]"] = ""
-            elif desc_source_type == "OTHER" and desc_source_text:
-                template_out.loc[:, "Description[34357]"] = desc_source_text
-            else:
-                st.warning("**Please select a valid General Note source or text.**")
-    else:
-        st.error("**Template missing expected column for General Note population: 'Description[34357]'**")
-
-    # category 3-5: descriptive metadata population - culture
-    if "Culture[34337]" in template_out.columns:
-        if geographic_type is not None:
-            if geographic_type == "Israel":
-                template_out.loc[:, "Culture[34337]"] = "Israeli"
-            elif geographic_type == "World Judaica":
-                template_out.loc[:, "Culture[34337]"] = "Jewish"
-    else:
-        st.error("**Template missing expected column for Culture Type population: 'Culture[34337]'**")
-
-    # category 3-6: descriptive metadata population - artstor country
-    if "Artstor Country[34356]" in template_out.columns:
-        if geographic_type is not None:
-            if geographic_type == "Israel":
-                template_out.loc[:, "Artstor Country[34356]"] = "Israel"
-            elif geographic_type == "World Judaica" and artstor_country_col is not None:
-                template_out.loc[:, "Artstor Country[34356]"] = desc_df[artstor_country_col].astype(str).str.strip()
-    else:
-        st.error("**Template missing expected column for Country Information population: 'Artstor Country[34356]'**")
 
-    # category 1-2: template population - creator + subject
-    if "Creator[34336]" in template_out.columns:
-        if template_creator and template_creator.strip():
-            template_out.loc[:, "Creator[34336]"] = template_creator.strip()
-    else:
-        st.error("**Template missing expected column: 'Creator[34336]'**")
+# --- template population pipeline (runs only when the configuration is applied) ---
+if urns_file and desc_file and template_df is not None:
+    st.subheader("Populated SharedShelf Template")
 
-    if "Subject[34358]" in template_out.columns:
-        if template_subject and template_subject.strip():
-            template_out.loc[:, "Subject[34358]"] = template_subject.strip()
-    else:
-        st.error("**Template missing expected column: 'Subject[34358]'**")
+    options = {
+        "metadata_type": metadata_type, "cataloging_type": cataloging_type, "geographic_type": geographic_type,
+        "artstor_country_col": artstor_country_col,
+        "desc_title_col": desc_title_col, "desc_start_date_col": desc_start_date_col, "desc_end_date_col": desc_end_date_col,
+        "desc_source_type": desc_source_type, "desc_note_col": desc_note_col, "desc_source_text": desc_source_text,
+        "template_creator": template_creator, "template_subject": template_subject,
+        "template_rights_type": template_rights_type, "template_rights_text": template_rights_text,
+        "template_credit_type": template_credit_type, "template_credit_text": template_credit_text,
+        "reduced_version": True,
+    }
 
-    # category 1-3: template population - copyright + crediting info
-    if template_rights_type is not None:
-        if template_rights_text != "":
-            try:
-                template_out.loc[:, "Rights[34363]"] = template_rights_text
-                template_out.loc[:, "Rights/Access Information[2560402]"] = template_rights_text
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Copyright Information population: {e}**")
+    # identifies the uploads + options a result was built from
+    config_signature = repr((
+        [getattr(f, "file_id", None) for f in (urns_file, desc_file, template_file, crediting_file)],
+        urns_key_col, sorted(options.items(), key=str), execution_mode, int(chunk_rows), all_desc_sheets,
+    ))
+
+    if job_submitted:
+        if missing_selections:
+            st.warning(f"**Please select value(s) for {', '.join(missing_selections)} before submitting a background job.**")
         else:
-            st.warning("**Please enter Copyright Information.**")
-    
-    if template_credit_type is not None:
-        if template_credit_text != "":
             try:
-                template_out.loc[:, "Notes[2560400]"] = template_credit_text
-            except KeyError as e:
-                st.error(f"**Template missing expected column(s) for Crediting Note population: {e}**")
+                job_id = get_job_queue().submit(template_df, urns_file.getvalue(), desc_file.getvalue(), options,
+                                                reduced=True, chunk_rows=int(chunk_rows), label=urns_file.name,
+                                                all_desc_sheets=all_desc_sheets)
+                st.success(f"Background job {job_id} queued. Its results stay available under **Background Jobs** "
+                           "below, also after a browser refresh.")
+                st.session_state["jobs_expander"] = True  # open the job list below
+            except Exception as e:
+                st.error(f"**Could not queue the background job: {e}**")
+
+    if config_applied:
+        stream_result = graph_key = None
+        if streaming_mode:
+            # drop the previous run's files before writing new ones
+            if st.session_state.get("stream_dir"):
+                shutil.rmtree(st.session_state["stream_dir"], ignore_errors=True)
+            stream_result = stream_populate(template_df, urns_file, desc_file, options, chunk_rows=int(chunk_rows))
+            st.session_state["stream_dir"] = os.path.dirname(stream_result["csv_path"])
+            messages = stream_result["messages"]
+            template_export = stream_result["preview"]
         else:
-            st.error("**Crediting Note cannot be blank.**")
-
-    # save intermediate for future categories
-    st.session_state["template_out"] = template_out
-
-# --- template column reduction for export (keep template order) ---
-    template_order = template_df.columns.tolist()
-    mentioned_cols = set()
-    for name in [
-        "SSID", "File Count", "Repository[34349]", "Image Repository[34365]",
-        "Send To Harvard[34382]", "In House Use Only[34383]", "Export Only In Group[34411]",
-        "Filename",
-        "Repository Classification Number[34364]", "Image Classification Number[34369]", "Repository Number[2560412]",
-        "Title[34338]",
-        "Date Description[34341]", "ARTstor Earliest Date[34342]", "ARTstor Latest Date[34343]",
-        "Earliest Date[2560433]", "Latest Date[2560435]",
-        "Materials/Techniques[34345]", "Work Type[34348]", "Materials Techniques Note[2560408]",
-        "Description[34357]",
-        "Creator[34336]", "Subject[34358]",
-        "Culture[34337]",
-        "Artstor Country[34356]",
-        "Rights[34363]", "Rights/Access Information[2560402]",
-        "Notes[2560400]",
-    ]:
-        mentioned_cols.add(name)
-
-    non_empty_cols = set()
-    for col in template_out.columns:
-        series = template_out[col]
-        has_content = series.astype(str).str.strip().replace("nan", "").ne("").any()
-        if has_content:
-            non_empty_cols.add(col)
-
-    always_keep = {
-        "Creator[34336]",
-        "Subject[34358]",
-    }
-
-    # final keep set:
-    # - any columns with content
-    # - any columns explicitly mentioned in code
-    # - plus Creator/Subject/... (as required) always
-    keep_cols_set = non_empty_cols.union(mentioned_cols).union(always_keep)
-    keep_cols = [c for c in template_order if (c in keep_cols_set and c in template_out.columns)]
-    template_export = template_out.loc[:, keep_cols].copy()    
+            # stages are only recomputed when the options / input columns they read changed
+            stage_graph = st.session_state.setdefault("stage_graph", StageGraph())
+            template_out, messages = stage_graph.run(template_df, urns_df, desc_df, options)
+
+            # save intermediate for future categories
+            st.session_state["template_out"] = template_out
+
+            # template column reduction for export (keep template order)
+            template_export = stage_graph.reduce(template_out, template_df.columns.tolist())
+            graph_key = stage_graph.last_key
+
+        # rows whose dates were approximate / uncertain / unrecognized (only the two date columns are needed)
+        date_flag_rows = date_source = None
+        if desc_start_date_col is not None and desc_end_date_col is not None:
+            date_cols = list(dict.fromkeys([desc_start_date_col, desc_end_date_col]))
+            date_source = load_columns(desc_file.getvalue(), date_cols) if streaming_mode else desc_df
+            date_flag_rows = date_flags(date_source, desc_start_date_col, desc_end_date_col)
+
+        # row-level QA of the whole output (the streamed CSV in streaming mode), once per applied configuration
+        qa_source = stream_result["csv_path"] if streaming_mode else template_export
+        qa_matrix, qa_issues = qa_report(qa_source, options, date_source)
+
+        st.session_state["pipeline_result"] = {
+            "signature": config_signature, "messages": messages, "template_export": template_export,
+            "stream_result": stream_result, "graph_key": graph_key, "date_flags": date_flag_rows,
+            "qa_summary": qa_summary(qa_matrix), "qa_rows": int(qa_matrix.any(axis=1).sum()), "qa_issues": qa_issues,
+            "chunk_rows": int(chunk_rows),
+            "missing_selections": list(missing_selections),
+        }
+
+        # the exported table, options, upload hashes and reference tables, to reload this batch later
+        if HISTORY_ENABLED:
+            try:
+                get_batch_history().record(
+                    urns_file.name, options, {"urns": urns_file.getvalue(), "desc": desc_file.getvalue()},
+                    {"template": template_df, "crediting": crediting_df},
+                    stream_result["csv_path"] if streaming_mode else template_export, messages, mode=execution_mode,
+                    app="Reduced", files={"xlsx": stream_result["xlsx_path"]} if streaming_mode else None)
+            except Exception as e:
+                st.warning(f"**Could not record the batch in the history: {e}**")
+
+    # the last applied result stays visible until the configuration is applied again
+    pipeline_result = st.session_state.get("pipeline_result")
+    if pipeline_result is None:
+        st.info("Make your selections above and click **Apply Configuration** to populate the template.")
+    elif pipeline_result["signature"] != config_signature:
+        st.info("Uploads or selections changed since the last run. Click **Apply Configuration** to refresh the result below.")
+
+if urns_file and desc_file and template_df is not None and pipeline_result is not None:
+    messages = pipeline_result["messages"]
+    template_export = pipeline_result["template_export"]
+    stream_result = pipeline_result["stream_result"]
+    missing_selections = pipeline_result["missing_selections"]
+    stage_graph = st.session_state.get("stage_graph")
+
+    for level, msg in messages:
+        getattr(st, level)(msg)
+
+    date_flag_rows = pipeline_result["date_flags"]
+    if date_flag_rows is not None and len(date_flag_rows) > 0:
+        with st.expander(f"Flagged dates: {len(date_flag_rows)} rows (click to expand)"):
+            st.caption("Row = data row in the Descriptive Metadata sheet. Earliest / Latest = years read from the dates.")
+            st.dataframe(date_flag_rows, hide_index=True)
+            st.download_button(
+                label="Download Flagged Dates (CSV)",
+                data=export_csv(date_flag_rows),
+                file_name="JDMP_Flagged_Dates.csv",
+                mime="text/csv",
+            )
+
+    qa_issues = pipeline_result["qa_issues"]
+    with st.expander(f"Data quality check: {pipeline_result['qa_rows']} rows with issues (click to expand)"):
+        st.caption("Rows per check over the whole populated template. The issue list names the row (as in the "
+                   "search below), the column and the value of every issue.")
+        st.dataframe(pipeline_result["qa_summary"], hide_index=True)
+        if len(qa_issues) > 0:
+            st.download_button(
+                label="Download QA Issue List (CSV)",
+                data=lambda df=qa_issues: export_csv(df),
+                file_name="JDMP_QA_Issues.csv",
+                mime="text/csv",
+            )
+
+    if stream_result is None and stage_graph is not None:
+        with st.expander("Pipeline cache (click to expand)"):
+            st.caption("Cache hits / misses per stage since the session started.")
+            st.dataframe(stage_graph.stats(), hide_index=True)
 
 # --- preview ---
-    st.dataframe(template_export.head(10))
+    preview_cols = template_export.columns.tolist()
+    # search + paging over the whole output; only the visible page is sent to the browser
+    preview_source = stream_result["csv_path"] if stream_result is not None else template_export
+    preview_rows = stream_result["rows"] if stream_result is not None else len(template_export)
+    with st.expander("Search the populated template (click to expand)"):
+        st.caption("E.g. column Date Description, equals 1900-2025: rows whose dates fell back to the default range.")
+        search_col = st.selectbox("Search column", ["All columns"] + preview_cols)
+        search_how = st.radio("Search match", PREVIEW_MATCHES, horizontal=True)
+        search_text = st.text_input("Search text")
+    positions = None
+    if search_how == "is blank" or search_text.strip():
+        # matching row positions are kept with the result, so paging through them does not search again
+        search_key = (search_col, search_how, search_text.strip())
+        if pipeline_result.get("search", (None,))[0] != search_key:
+            pipeline_result["search"] = (search_key, match_rows(
+                preview_source, search_text, None if search_col == "All columns" else search_col, search_how,
+                columns=preview_cols))
+        positions = pipeline_result["search"][1]
+
+    match_count = preview_rows if positions is None else len(positions)
+    page_rows = st.selectbox("Rows per page", [PREVIEW_PAGE_ROWS, 200, 1000])
+    pages = max(-(-match_count // page_rows), 1)
+    page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1, step=1)
+    st.caption(f"{match_count:,} {'matching ' if positions is not None else ''}rows; row numbers are data rows of "
+               "the populated template.")
+    st.dataframe(output_page(preview_source, int(page) - 1, page_rows, positions=positions, columns=preview_cols))
 
 # --- export / download ---
     if missing_selections:
@@ -553,39 +682,196 @@ if urns_file and desc_file and template_df is not None:
             f"**Please select value(s) for {', '.join(missing_selections)} before downloading the populated template.**"
         )
 
+    elif stream_result is not None:
+        if previous_file:
+            st.info("Delta export is available in the In-memory and Column-pruned execution modes.")
+        # streamed files are served from disk, read only when the button is clicked
+        st.success(f"{stream_result['rows']} rows written in chunks of {pipeline_result['chunk_rows']}.")
+        st.download_button(
+            label="Download Populated SharedShelf Template (Excel)",
+            data=lambda path=stream_result["xlsx_path"]: Path(path).read_bytes(),
+            file_name="JDMP_Populated_Template.xlsx",
+            mime=XLSX_MIME,
+        )
+        st.download_button(
+            label="Download Populated SharedShelf Template (CSV)",
+            data=lambda path=stream_result["csv_path"]: Path(path).read_bytes(),
+            file_name="JDMP_Populated_Template.csv",
+            mime="text/csv",
+        )
+        st.download_button(
+            label="Download Populated SharedShelf Template (gzip CSV)",
+            data=lambda path=stream_result["csv_path"]: Path(gzip_file(path)).read_bytes(),
+            file_name="JDMP_Populated_Template.csv.gz",
+            mime="application/gzip",
+        )
+
     else:
         # - Excel -
-        xlsx_output = io.BytesIO()
-        with pd.ExcelWriter(xlsx_output, engine="openpyxl") as writer:
-            template_export.to_excel(writer, index=False, sheet_name="Sheet1")
-
-            # styling: borders + top alignment + wrap
-            worksheet = writer.sheets["Sheet1"]
-            thin = Side(border_style="thin", color="000000")
-            border = Border(top=thin, left=thin, right=thin, bottom=thin)
-            align_top = Alignment(vertical="top", horizontal="left", wrap_text=True)
-
-            for row in worksheet.iter_rows(
-                min_row=1, max_row=worksheet.max_row, min_col=1, max_col=worksheet.max_column
-            ):
-                for cell in row:
-                    cell.border = border
-                    cell.alignment = align_top
-
         st.download_button(
             label="Download Populated SharedShelf Template (Excel)",
-            data=xlsx_output.getvalue(),
+            data=lambda df=template_export, key=pipeline_result["graph_key"]: stage_graph.export(df, key, "xlsx"),
             file_name="JDMP_Populated_Template.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            mime=XLSX_MIME,
         )
 
         # - CSV -
-        # use UTF-8 with BOM so Excel on Windows opens it without mojibake
-        csv_bytes = template_export.to_csv(index=False).encode("utf-8-sig")
         st.download_button(
             label="Download Populated SharedShelf Template (CSV)",
-            data=csv_bytes,
+            data=lambda df=template_export, key=pipeline_result["graph_key"]: stage_graph.export(df, key, "csv"),
             file_name="JDMP_Populated_Template.csv",
             mime="text/csv",
-    )
+        )
 
+        # - large batches: sharded Excel (ZIP) + gzip CSV, only built when clicked -
+        with st.expander("**📦 Large Batch Export (click to expand)**"):
+            shard_rows = st.number_input("Rows per shard", min_value=100, max_value=100000, value=10000, step=1000)
+            st.download_button(
+                label="Download Sharded Template (ZIP of Excel files)",
+                data=lambda df=template_export, n=int(shard_rows): export_sharded_zip(df, shard_rows=n),
+                file_name="JDMP_Populated_Template_shards.zip",
+                mime="application/zip",
+            )
+            st.download_button(
+                label="Download Populated SharedShelf Template (gzip CSV)",
+                data=lambda df=template_export, key=pipeline_result["graph_key"]: (
+                    stage_graph.export(df, key, "csv.gz")
+                ),
+                file_name="JDMP_Populated_Template.csv.gz",
+                mime="application/gzip",
+            )
+
+        # - delta against a previously submitted file (rows matched on Filename) -
+        if previous_file:
+            st.subheader("Delta Export")
+            # compared once per previous file + result; reruns (download buttons, other widgets) reuse it
+            delta_key = (previous_file.file_id, pipeline_result["graph_key"])
+            if pipeline_result.get("delta_key") != delta_key:
+                try:
+                    pipeline_result["delta"] = delta_export(template_export, read_previous_export(previous_file))
+                    pipeline_result["delta_error"] = None
+                except Exception as e:
+                    pipeline_result["delta"], pipeline_result["delta_error"] = None, str(e)
+                pipeline_result["delta_key"] = delta_key
+            if pipeline_result["delta_error"] is not None:
+                st.error(f"**Could not compare with the previous export: {pipeline_result['delta_error']}**")
+            else:
+                delta_df, delta_status, delta_summary = pipeline_result["delta"]
+                st.info(
+                    f"{delta_summary['new']} new, {delta_summary['changed']} changed, {delta_summary['unchanged']} unchanged, "
+                    f"{len(delta_summary['removed'])} removed since the previous export ({delta_summary['compared_columns']} columns compared)."
+                )
+                if delta_summary["removed"]:
+                    with st.expander("Rows removed since the previous export (click to expand)"):
+                        removed_df = pd.DataFrame({"Filename": delta_summary["removed"]})
+                        st.dataframe(removed_df)
+                        st.download_button(
+                            label="Download Removed Rows (CSV)",
+                            data=export_csv(removed_df),
+                            file_name="JDMP_Removed_Rows.csv",
+                            mime="text/csv",
+                        )
+                st.download_button(
+                    label="Download Delta Template (Excel)",
+                    data=lambda df=delta_df: export_xlsx(df),
+                    file_name="JDMP_Populated_Template_delta.xlsx",
+                    mime=XLSX_MIME,
+                )
+                st.download_button(
+                    label="Download Delta Template (CSV)",
+                    data=lambda df=delta_df: export_csv(df),
+                    file_name="JDMP_Populated_Template_delta.csv",
+                    mime="text/csv",
+                )
+
+# --- background jobs (results kept on disk, visible from every session) ---
+# the queue (worker pool + scheduler thread) is only started by a submitted job or by opening this list
+jobs_expander = st.expander("**⏳ Background Jobs (click to expand)**", key="jobs_expander", on_change="rerun")
+if jobs_expander.open:
+    with jobs_expander:
+        jobs = get_job_queue().list_jobs()
+        st.button("Refresh Job Status")
+        if not jobs:
+            st.caption("No background jobs yet.")
+        else:
+            st.dataframe(
+                pd.DataFrame([{
+                    "Job": job["id"], "File": job["label"], "Columns": "Reduced" if job["reduced"] else "All",
+                    "Status": job["state"], "Stage": job["stage"], "Progress": job["progress"], "Mode": job["mode"],
+                    "Rows": job.get("rows"), "Error": job.get("error", ""),
+                } for job in jobs]),
+                hide_index=True,
+                column_config={"Progress": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0)},
+            )
+
+            finished_jobs = [job["id"] for job in jobs if job["state"] == "done"]
+            if finished_jobs:
+                job_id = st.selectbox("**Select a finished job to download**", finished_jobs)
+                st.download_button(
+                    label="Download Job Result (Excel)",
+                    data=lambda path=get_job_queue().output_path(job_id, "xlsx"): Path(path).read_bytes(),
+                    file_name=f"JDMP_Populated_Template_{job_id}.xlsx",
+                    mime=XLSX_MIME,
+                )
+                st.download_button(
+                    label="Download Job Result (CSV)",
+                    data=lambda path=get_job_queue().output_path(job_id, "csv"): Path(path).read_bytes(),
+                    file_name=f"JDMP_Populated_Template_{job_id}.csv",
+                    mime="text/csv",
+                )
+
+# --- batch history (earlier runs, reloaded from the columnar store without parsing any Excel file) ---
+# the recorded batches are only read while this list is open
+if HISTORY_ENABLED:
+    history_expander = st.expander("**🗂️ Batch History (click to expand)**", key="history_expander",
+                                   on_change="rerun")
+    if history_expander.open:
+        with history_expander:
+            batches = get_batch_history().list_batches()
+            if not batches:
+                st.caption("No batches recorded yet.")
+            else:
+                st.dataframe(pd.DataFrame([{
+                    "Batch": batch["id"], "File": batch["label"], "App": batch["app"], "Mode": batch["mode"],
+                    "Rows": batch["rows"], "Recorded": time.strftime("%Y-%m-%d %H:%M", time.localtime(batch["time"])),
+                    "Metadata Type": batch["options"].get("metadata_type"),
+                    "Cataloging Type": batch["options"].get("cataloging_type"),
+                    "Geographic Type": batch["options"].get("geographic_type"),
+                } for batch in batches]), hide_index=True)
+                history_stats = get_batch_history().stats()
+                st.caption(f"{history_stats['objects']} stored objects, {history_stats['bytes'] / 1e6:.1f} MB on "
+                           "disk: identical uploads and reference tables are stored once.")
+
+                batch_id = st.selectbox("**Select a batch to reload**", [batch["id"] for batch in batches])
+                try:
+                    batch, batch_df = load_batch(batch_id)
+                except Exception as e:
+                    st.error(f"**Could not reload batch {batch_id}: {e}**")
+                else:
+                    upload_hashes = ", ".join(f"{k} {v[:12]}" for k, v in batch["inputs"].items())
+                    st.caption(f"Upload hashes (SHA-256): {upload_hashes}")
+                    st.dataframe(pd.DataFrame([{"Option": k, "Value": v} for k, v in batch["options"].items()]),
+                                 hide_index=True)
+                    st.dataframe(output_page(batch_df, 0))
+                    history = get_batch_history()
+                    st.download_button(
+                        label="Download Batch Result (Excel)",
+                        data=lambda df=batch_df, key=batch["files"].get("xlsx"): (
+                            history.read_bytes(key) if key else export_xlsx(df)
+                        ),
+                        file_name=f"JDMP_Populated_Template_{batch_id}.xlsx",
+                        mime=XLSX_MIME,
+                    )
+                    st.download_button(
+                        label="Download Batch Result (CSV)",
+                        data=lambda df=batch_df: export_csv(df),
+                        file_name=f"JDMP_Populated_Template_{batch_id}.csv",
+                        mime="text/csv",
+                    )
+                    for name, key in batch["inputs"].items():
+                        st.download_button(
+                            label=f"Download Original Upload: {name} (Excel)",
+                            data=lambda key=key: history.read_bytes(key),
+                            file_name=f"JDMP_{batch_id}_{name}.xlsx",
+                            mime=XLSX_MIME,
+                        )
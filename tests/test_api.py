@@ -0,0 +1,86 @@
+import asyncio
+import io
+import json
+import os
+
+import pandas as pd
+
+from starlette.requests import Request
+
+from jdmp_api import create_app, populate, populate_request
+
+OPTIONS = {
+    "metadata_type": "Posters", "cataloging_type": "Provisional Records", "geographic_type": "Israel",
+    "columns": {"title": "Title", "start_date": "Start", "end_date": "End"},
+    "general_note": {"source": "NO GENERAL NOTE"}, "rights": {"source": "STANDARD"},
+    "credit": {"source": "231 Lowe"}, "format": "csv",
+}
+
+
+def _xlsx(df):
+    data = io.BytesIO()
+    df.to_excel(data, index=False)
+    return data.getvalue()
+
+
+def _files(**overrides):
+    files = {
+        "urns": _xlsx(pd.DataFrame({"FILE-URN": ["URN-3:HUL.JUD:1"], "OBJ-OSN": ["jud_1"]})),
+        "desc": _xlsx(pd.DataFrame({"Title": ["A poster"], "Start": [1948], "End": [1950]})),
+        "template": None, "crediting": None,
+    }
+    files.update(overrides)
+    return files
+
+
+def test_valid_request():
+    result = populate_request(_files(), OPTIONS, 1024)
+    assert "errors" not in result
+    assert result["rows"] == 1
+    assert "Israel Poster Collection - A poster" in result["data"].decode("utf-8-sig")
+
+
+def test_options_not_an_object():
+    assert populate_request(_files(), [1, 2], 1024) == {"errors": ["options must be a JSON object"]}
+
+
+def test_wrongly_typed_fields():
+    doc = {**OPTIONS, "credit": {"source": ["231 Lowe"]}, "rights": "STANDARD", "creator": 5, "reduced": "yes"}
+    errors = populate_request(_files(), doc, 1024)["errors"]
+    for expected in ("credit.source must be a JSON string", "rights must be a JSON object",
+                     "creator must be a JSON string", "reduced must be a JSON boolean"):
+        assert expected in errors
+
+
+def test_upload_not_excel():
+    errors = populate_request(_files(urns=b"not a workbook", crediting=b"PK\x03\x04"), OPTIONS, 1024)["errors"]
+    assert [e.split(" (")[0] for e in errors] == ["crediting is not a readable Excel file",
+                                                 "urns is not a readable Excel file"]
+
+
+def _post(app, files, doc):
+    # POST /populate through the route handler, as multipart/form-data
+    boundary = "jdmp-test-boundary"
+    body = b"".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.xlsx"\r\n'
+                    f"Content-Type: application/octet-stream\r\n\r\n".encode() + data + b"\r\n"
+                    for name, data in files.items() if data is not None)
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="options"\r\n\r\n{json.dumps(doc)}\r\n'
+             f"--{boundary}--\r\n").encode()
+    scope = {"type": "http", "method": "POST", "path": "/populate", "app": app, "query_string": b"",
+             "headers": [(b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+                         (b"content-length", str(len(body)).encode())]}
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return asyncio.run(populate(Request(scope, receive)))
+
+
+def test_broken_worker_pool_is_replaced():
+    app = create_app(workers=1)
+    app.state.pool.submit(os._exit, 1).exception()  # the worker dies, as when it is killed out of memory
+
+    response = _post(app, _files(), OPTIONS)
+    assert response.status_code == 503
+    assert _post(app, _files(), OPTIONS).status_code == 200
+    app.state.pool.shutdown()
@@ -0,0 +1,129 @@
+import datetime
+import io
+import json
+
+import pandas as pd
+from openpyxl import load_workbook
+
+import jdmp_core
+import jdmp_metrics
+from jdmp_core import (StageGraph, date_flags, export_csv_gz, export_sharded_zip, export_xlsx, frame_from_arrow,
+                       frame_to_arrow, match_rows, parse_date_text, populate_template, qa_report, read_inputs,
+                       stream_populate)
+
+TEMPLATE_COLS = ["Filename", "Title[34338]", "Culture[34337]", "Artstor Country[34356]", "Description[34357]",
+                 "Creator[34336]", "Materials/Techniques[34345]", "Work Type[34348]",
+                 "Materials Techniques Note[2560408]"]
+
+
+def _inputs():
+    template_df = pd.DataFrame(columns=TEMPLATE_COLS)
+    urns_df = pd.DataFrame({"FILE-URN": ["URN-3:HUL.JUD:1", "URN-3:HUL.JUD:2"], "OBJ-OSN": ["jud_1", "jud_2"]})
+    desc_df = pd.DataFrame({"Title": ["A", "B"], "Country": ["Poland", "Israel"]})
+    return template_df, urns_df, desc_df
+
+
+def _options(geographic_type):
+    return {"metadata_type": "Posters", "cataloging_type": "Full Cataloging", "geographic_type": geographic_type,
+            "desc_title_col": "Title", "artstor_country_col": "Country"}
+
+
+def test_stage_graph_reruns_fields_rule_on_geographic_type(tmp_path, monkeypatch):
+    rules = json.load(open(jdmp_core.RULES_PATH, encoding="utf-8"))
+    rules["fields"].insert(0, {"when": {"metadata_type": "Posters", "geographic_type": "Israel"},
+                               "set": {"Work Type[34348]": "israeli posters"}})
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(json.dumps(rules), encoding="utf-8")
+    monkeypatch.setattr(jdmp_core, "RULES_PATH", str(rules_path))
+
+    template_df, urns_df, desc_df = _inputs()
+    graph = StageGraph()
+    for geographic_type, work_type in (("Israel", "israeli posters"), ("World Judaica", "posters"),
+                                       ("Israel", "israeli posters")):
+        options = _options(geographic_type)
+        graph_out, graph_messages = graph.run(template_df, urns_df, desc_df, options)
+        expected, messages = populate_template(template_df, urns_df, desc_df, options)
+        assert graph_out["Work Type[34348]"].tolist() == [work_type] * 2
+        pd.testing.assert_frame_equal(graph_out, expected)
+        assert graph_messages == messages
+    assert graph.hits["metadata type"] == 1
+
+
+def test_creator_blanked_for_posters_in_full_version_only():
+    template_df, urns_df, desc_df = _inputs()
+    full, _ = populate_template(template_df, urns_df, desc_df, _options("Israel"))
+    reduced, _ = populate_template(template_df, urns_df, desc_df, {**_options("Israel"), "reduced_version": True})
+    assert full["Creator[34336]"].tolist() == ["", ""]
+    assert reduced["Creator[34336]"].isna().all()
+    assert reduced["Work Type[34348]"].tolist() == ["posters", "posters"]
+
+
+def test_match_rows_treats_missing_cells_as_blank():
+    output = pd.DataFrame({"Title[34338]": ["A", None, ""], "Date[34344]": [1898.0, float("nan"), 1902.0]})
+    assert match_rows(output, column="Title[34338]", how="is blank").tolist() == [1, 2]
+    assert match_rows(output, column="Date[34344]", how="is blank").tolist() == [1]
+    assert match_rows(output, "nan", column="Date[34344]").tolist() == []
+
+
+def test_parse_date_text_two_digit_range_end():
+    assert parse_date_text("1948-50") == (1948, 1950, "")
+    assert parse_date_text("1898-02") == (1898, 1902, "")
+    assert parse_date_text("1950-1948") == (1950, 1948, "end year before start year")
+
+
+def test_qa_literal_nan_matches_whole_cells_only():
+    output = pd.DataFrame({"Filename": ["a", "b", "c", "d"],
+                           "Title[34338]": ["nan", " NaN ", "None", "Nan Goldin: portrait"],
+                           "Description[34357]": ["", "", "", "Banana crates"]})
+    matrix, issues = qa_report(output)
+    assert matrix["Literal nan"].tolist() == [True, True, True, False]
+    assert issues.loc[issues["Issue"] == "Literal nan", "Row"].tolist() == [1, 2, 3]
+
+
+def test_arrow_round_trip_keeps_excel_date_cells(tmp_path, monkeypatch):
+    monkeypatch.setattr(jdmp_core, "SHARED_FRAMES_DIR", str(tmp_path))
+    dates = [datetime.datetime(1956, 10, 29), "1948-50", 1950, float("nan"), datetime.date(1960, 1, 2),
+             datetime.time(9, 30)]
+    desc_df = pd.DataFrame({"Start": dates, "End": dates})
+    restored = frame_from_arrow(frame_to_arrow(desc_df))
+    assert restored["Start"].map(type).tolist() == desc_df["Start"].map(type).tolist()
+    assert restored.equals(desc_df)
+
+    workbook = io.BytesIO()
+    desc_df.iloc[:4].to_excel(workbook, index=False)
+    _, in_memory = read_inputs(desc_source=workbook.getvalue(), workers=1)
+    assert isinstance(in_memory["Start"][0], datetime.datetime)
+    assert date_flags(in_memory, "Start", "End").empty
+
+
+def _cell_style(cell):
+    return cell.font.b, cell.border.left.style, cell.alignment.horizontal, cell.alignment.vertical
+
+
+def test_streamed_xlsx_styled_like_in_memory_export(tmp_path):
+    template_df, urns_df, desc_df = _inputs()
+    urns_df.to_excel(tmp_path / "urns.xlsx", index=False)
+    desc_df.to_excel(tmp_path / "desc.xlsx", index=False)
+    streamed = stream_populate(template_df, str(tmp_path / "urns.xlsx"), str(tmp_path / "desc.xlsx"),
+                               _options("Israel"), out_dir=str(tmp_path))
+    in_memory = export_xlsx(pd.read_csv(streamed["csv_path"], encoding="utf-8-sig"))
+
+    streamed_ws = load_workbook(streamed["xlsx_path"]).active
+    in_memory_ws = load_workbook(io.BytesIO(in_memory)).active
+    for row in (1, 2):
+        assert _cell_style(streamed_ws.cell(row, 1)) == _cell_style(in_memory_ws.cell(row, 1))
+    assert streamed_ws.cell(1, 1).font.b and not streamed_ws.cell(2, 1).font.b
+
+
+def test_csv_gz_export_metered_once(monkeypatch):
+    monkeypatch.setattr(jdmp_metrics, "ENABLED", True)
+    monkeypatch.setattr(jdmp_metrics.EXPORT_BYTES, "values", {})
+    data = export_csv_gz(pd.DataFrame({"Title[34338]": ["A", "B"]}))
+    assert jdmp_metrics.EXPORT_BYTES.values == {("csv.gz",): len(data)}
+
+
+def test_sharded_zip_export_metered_once(monkeypatch):
+    monkeypatch.setattr(jdmp_metrics, "ENABLED", True)
+    monkeypatch.setattr(jdmp_metrics.EXPORT_BYTES, "values", {})
+    data = export_sharded_zip(pd.DataFrame({"Title[34338]": ["A", "B", "C"]}), shard_rows=2, workers=1)
+    assert jdmp_metrics.EXPORT_BYTES.values == {("zip",): len(data)}
@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_golden_outputs():
+    # every rules case, in memory and streamed, against the files in golden/ (python jdmp_golden.py --update
+    # rewrites them after an intended output change)
+    run = subprocess.run([sys.executable, "jdmp_golden.py", "--repeat", "1", "--streaming"], cwd=APP_DIR,
+                         capture_output=True, text=True)
+    assert run.returncode == 0, run.stderr[-4000:]
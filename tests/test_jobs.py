@@ -0,0 +1,45 @@
+import io
+import os
+import time
+
+import pandas as pd
+
+from jdmp_jobs import JobQueue
+
+OPTIONS = {"metadata_type": "Posters", "cataloging_type": "Provisional Records", "geographic_type": "Israel",
+           "desc_title_col": "Title"}
+
+
+def _xlsx(df):
+    data = io.BytesIO()
+    df.to_excel(data, index=False)
+    return data.getvalue()
+
+
+def _run(queue):
+    job_id = queue.submit(pd.DataFrame(columns=["Filename", "Title[34338]"]),
+                          _xlsx(pd.DataFrame({"FILE-URN": ["URN-3:HUL.JUD:1"], "OBJ-OSN": ["jud_1"]})),
+                          _xlsx(pd.DataFrame({"Title": ["A poster"]})), OPTIONS, reduced=False)
+    for _ in range(600):
+        job = next(job for job in queue.list_jobs() if job["id"] == job_id)
+        if job["state"] in ("done", "failed"):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"job stuck in {job['state']}")
+
+
+def test_job_queue_replaces_a_broken_pool(tmp_path):
+    queue = JobQueue(root=str(tmp_path), workers=1)
+    queue.pool.submit(os._exit, 1).exception()  # the worker dies, as when it is killed out of memory
+
+    failed = _run(queue)
+    assert failed["state"] == "failed" and "BrokenProcessPool" in failed["error"]
+    assert _run(queue)["state"] == "done"
+
+
+def test_job_directories_are_private(tmp_path):
+    queue = JobQueue(root=str(tmp_path / "jobs"), workers=1)
+    job = _run(queue)
+    assert job["state"] == "done"
+    assert os.stat(tmp_path / "jobs").st_mode & 0o777 == 0o700
+    assert os.stat(tmp_path / "jobs" / job["id"]).st_mode & 0o777 == 0o700
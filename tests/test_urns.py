@@ -0,0 +1,21 @@
+import os
+import time
+
+from jdmp_urns import ThumbnailCache
+
+
+def test_thumbnail_cache_purges_least_recently_used(tmp_path):
+    cache = ThumbnailCache(base_url="http://nrs.invalid/", cache_dir=str(tmp_path), max_mb=2.5 / 1024)
+    now = time.time()
+    for age, urn in enumerate(["new", "older", "oldest"]):
+        path = cache.path(urn)
+        with open(path, "wb") as f:
+            f.write(b"x" * 1024)
+        os.utime(path, (now - age * 60, now - age * 60))
+    stale_tmp = tmp_path / "abandoned.jpg.123.tmp"
+    stale_tmp.write_bytes(b"x")
+    os.utime(stale_tmp, (now - 7200, now - 7200))
+
+    cache.purge(keep={cache.path("oldest")})
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(cache.path(u)) for u in ("new", "oldest"))
+    cache.pool.shutdown()